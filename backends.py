@@ -0,0 +1,251 @@
+import abc
+import json
+import time
+import asyncio
+import logging
+import argparse
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class StateBackend(abc.ABC):
+    """Хранилище состояния, общее для реплик бота
+
+    Все операции выполняются пачкой через execute(ops) - атомарно и за один
+    сетевой запрос. Операции (кортежи):
+        ("get", key)                              -> значение или None
+        ("set", key, value, ttl)                  -> True
+        ("incr", key, amount, ttl)                -> новое значение
+        ("cas", key, expected, value, ttl)        -> True, если значение было expected
+        ("lock", key, owner, ttl)                 -> True, если блокировка получена
+        ("unlock", key, owner)                    -> True, если блокировка была наша
+    ttl - время жизни ключа в секундах или None.
+    """
+
+    # Разделяется ли состояние с другими процессами
+    shared = False
+
+    @abc.abstractmethod
+    async def execute(self, ops: List[tuple]) -> List[Any]:
+        """Выполнение пачки операций; результаты - по одному на операцию"""
+
+    async def close(self):
+        pass
+
+    async def get(self, key: str) -> Any:
+        return (await self.execute([("get", key)]))[0]
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        await self.execute([("set", key, value, ttl)])
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        return (await self.execute([("incr", key, amount, ttl)]))[0]
+
+    async def compare_and_set(self, key: str, expected: Any, value: Any,
+                              ttl: Optional[float] = None) -> bool:
+        return (await self.execute([("cas", key, expected, value, ttl)]))[0]
+
+    async def acquire_lock(self, key: str, owner: str, ttl: float) -> bool:
+        return (await self.execute([("lock", key, owner, ttl)]))[0]
+
+    async def release_lock(self, key: str, owner: str) -> bool:
+        return (await self.execute([("unlock", key, owner)]))[0]
+
+
+class MemoryBackend(StateBackend):
+    """Хранилище в памяти процесса (одна реплика, тесты, сервер KVServer)"""
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[Any, Optional[float]]] = {}
+        self._ops = 0
+
+    def _get(self, key: str, now: float) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and expires <= now:
+            del self._data[key]
+            return None
+        return value
+
+    def _put(self, key: str, value: Any, ttl: Optional[float], now: float):
+        self._data[key] = (value, now + ttl if ttl else None)
+
+    def run(self, op: tuple) -> Any:
+        now = time.time()
+        name, key = op[0], op[1]
+
+        # Периодическая чистка просроченных ключей
+        self._ops += 1
+        if self._ops % 100000 == 0:
+            for k in [k for k, (_, exp) in self._data.items() if exp is not None and exp <= now]:
+                del self._data[k]
+
+        if name == "get":
+            return self._get(key, now)
+        if name == "set":
+            self._put(key, op[2], op[3], now)
+            return True
+        if name == "incr":
+            value = (self._get(key, now) or 0) + op[2]
+            self._put(key, value, op[3], now)
+            return value
+        if name == "cas":
+            if self._get(key, now) != op[2]:
+                return False
+            self._put(key, op[3], op[4], now)
+            return True
+        if name == "lock":
+            current = self._get(key, now)
+            if current is not None and current != op[2]:
+                return False
+            self._put(key, op[2], op[3], now)
+            return True
+        if name == "unlock":
+            if self._get(key, now) != op[2]:
+                return False
+            del self._data[key]
+            return True
+        raise ValueError(f"Неизвестная операция: {name}")
+
+    async def execute(self, ops: List[tuple]) -> List[Any]:
+        return [self.run(op) for op in ops]
+
+
+class NetworkBackend(StateBackend):
+    """Клиент KVServer: JSON-строки по TCP, запросы конвейером по одному соединению"""
+
+    shared = True
+
+    def __init__(self, host: str, port: int, timeout: float = 5):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._waiters: Dict[int, asyncio.Future] = {}
+        self._next_id = 0
+        self._connect_lock = asyncio.Lock()
+
+    async def _connect(self):
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            self._reader_task = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    raise ConnectionError("KV-сервер закрыл соединение")
+                response = json.loads(line)
+                waiter = self._waiters.pop(response["id"], None)
+                if waiter is None or waiter.done():
+                    continue
+                if "error" in response:
+                    waiter.set_exception(RuntimeError(response["error"]))
+                else:
+                    waiter.set_result(response["results"])
+        except Exception as e:
+            self._fail_all(e)
+
+    def _fail_all(self, error: Exception):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        for waiter in self._waiters.values():
+            if not waiter.done():
+                waiter.set_exception(ConnectionError(str(error)))
+        self._waiters.clear()
+
+    async def execute(self, ops: List[tuple]) -> List[Any]:
+        if self._writer is None:
+            await self._connect()
+        self._next_id += 1
+        request_id = self._next_id
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[request_id] = waiter
+        self._writer.write(json.dumps({"id": request_id, "ops": ops}).encode() + b"\n")
+        try:
+            return await asyncio.wait_for(waiter, self.timeout)
+        finally:
+            self._waiters.pop(request_id, None)
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+class KVServer:
+    """Сетевое хранилище для NetworkBackend (и локальная замена для тестов)
+
+    Пачка операций выполняется целиком без переключения задач, поэтому
+    атомарна относительно других клиентов.
+    """
+
+    def __init__(self, backend: Optional[MemoryBackend] = None):
+        self.backend = backend or MemoryBackend()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                try:
+                    response = {
+                        "id": request["id"],
+                        "results": [self.backend.run(tuple(op)) for op in request["ops"]]
+                    }
+                except Exception as e:
+                    response = {"id": request["id"], "error": str(e)}
+                writer.write(json.dumps(response).encode() + b"\n")
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 6400):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+
+def create_backend(url: Optional[str]) -> StateBackend:
+    """memory:// (по умолчанию) или tcp://host:port"""
+    if not url or url.startswith("memory"):
+        return MemoryBackend()
+    if url.startswith("tcp://"):
+        host, _, port = url[len("tcp://"):].rpartition(":")
+        return NetworkBackend(host, int(port))
+    raise ValueError(f"Неизвестное хранилище состояния: {url}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="KV-сервер общего состояния реплик")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6400)
+    args = parser.parse_args()
+
+    async def serve():
+        server = await KVServer().start(args.host, args.port)
+        logger.info(f"KV-сервер слушает {args.host}:{args.port}")
+        async with server:
+            await server.serve_forever()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve())
@@ -0,0 +1,304 @@
+"""Нагрузочный прогон обработки апдейтов без сети
+
+Генерирует поток апдейтов (текст разной длины, приветствия, стикеры,
+голосовые, фото, кружки, геолокация) для множества групп и участников,
+прогоняет его через dp.feed_update с фальшивой сессией бота и сохраняет
+результаты в JSON для сравнения между версиями:
+
+    python bench.py --groups 200 --updates 50000 --output bench-new.json --compare bench-old.json
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+from datetime import timedelta
+from typing import Callable, Dict, List
+
+WORDS = ["привет", "как", "дела", "сегодня", "котик", "солнышко", "люблю", "скучаю",
+         "работа", "кофе", "вечером", "созвон", "фильм", "погода", "ужин"]
+GREETINGS = ["доброе утро!", "Доброго утречка", "спокойной ночи", "сладких снов 💤", "доброй ночи"]
+KINDS = ["text", "long_text", "greeting", "sticker", "voice", "photo", "video_note", "location"]
+KIND_WEIGHTS = [50, 10, 10, 10, 5, 8, 4, 3]
+
+
+def make_groups(groups: int, members: int) -> List[dict]:
+    return [
+        {
+            "chat_id": -1000000000 - g,
+            "admin_id": 1000000 + g * members,
+            "members": [
+                {"user_id": 1000000 + g * members + m, "name": f"u{m}"}
+                for m in range(members)
+            ],
+        }
+        for g in range(groups)
+    ]
+
+
+def make_updates(groups: List[dict], count: int, seed: int, first_id: int = 1) -> List[dict]:
+    """Апдейты в формате Bot API (update_id и message_id с first_id)"""
+    rnd = random.Random(seed)
+    updates = []
+    for update_id in range(first_id, first_id + count):
+        group = rnd.choice(groups)
+        user = rnd.choice(group["members"])
+        message = {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": group["chat_id"], "type": "supergroup", "title": "bench"},
+            "from": {"id": user["user_id"], "is_bot": False, "first_name": user["name"]},
+        }
+        kind = rnd.choices(KINDS, KIND_WEIGHTS)[0]
+        if kind == "text":
+            message["text"] = " ".join(rnd.choices(WORDS, k=rnd.randint(1, 12)))
+        elif kind == "long_text":
+            message["text"] = " ".join(rnd.choices(WORDS, k=rnd.randint(20, 120)))
+        elif kind == "greeting":
+            message["text"] = rnd.choice(WORDS) + " " + rnd.choice(GREETINGS)
+        elif kind == "sticker":
+            message["sticker"] = {"file_id": "s", "file_unique_id": "s", "type": "regular",
+                                  "width": 512, "height": 512, "is_animated": False, "is_video": False}
+        elif kind == "voice":
+            message["voice"] = {"file_id": "v", "file_unique_id": "v", "duration": 3}
+        elif kind == "photo":
+            message["photo"] = [{"file_id": "p", "file_unique_id": "p", "width": 90, "height": 90}]
+        elif kind == "video_note":
+            message["video_note"] = {"file_id": "n", "file_unique_id": "n", "length": 240, "duration": 5}
+        else:
+            message["location"] = {"latitude": 55.75, "longitude": 37.62}
+        updates.append({"update_id": update_id, "message": message})
+    return updates
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(samples: List[float], seconds: float, ops: int) -> dict:
+    return {
+        "ops": ops,
+        "seconds": round(seconds, 6),
+        "ops_per_sec": round(ops / seconds, 1) if seconds else None,
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 4),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 4),
+    }
+
+
+async def measure_allocations(run: Callable, ops: int) -> dict:
+    """Память, выделенная и оставшаяся после прогона (отдельно от замеров времени)"""
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    await run()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "alloc_peak_bytes": peak - before,
+        "retained_bytes_per_op": round((current - before) / ops, 1),
+        "retained_blocks_per_op": round((sys.getallocatedblocks() - blocks) / ops, 2),
+    }
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def setup_environment(groups: List[dict], workdir: str):
+    """Окружение для импорта main: группы из файла, журнал во временном каталоге"""
+    groups_file = os.path.join(workdir, "groups.json")
+    with open(groups_file, "w", encoding="utf-8") as f:
+        json.dump(groups, f)
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCHMARKbenchmarkBENCHMARKbench",
+        "GROUPS_FILE": groups_file,
+        "DATA_DIR": os.path.join(workdir, "data"),
+        "GROUP_ID": "0",
+        "SNAPSHOT_INTERVAL": "100000",
+    })
+    os.environ.pop("STATE_BACKEND", None)
+    os.environ.pop("WEBHOOK_URL", None)
+
+
+def fake_session():
+    """Сессия бота, которая записывает запросы вместо отправки"""
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import SendMessage
+    from aiogram.types import Message
+
+    class FakeSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.calls: Dict[str, int] = {}
+
+        async def make_request(self, bot, method, timeout=None):
+            name = type(method).__name__
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if isinstance(method, SendMessage):
+                return Message.model_validate({
+                    "message_id": sum(self.calls.values()), "date": 0,
+                    "chat": {"id": method.chat_id, "type": "supergroup"}, "text": method.text,
+                })
+            return True
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+    return FakeSession()
+
+
+async def run_benchmarks(args) -> dict:
+    import main
+    from aiogram.types import Update
+    from sender import TokenBucket
+
+    logging.getLogger().setLevel(logging.WARNING)
+    session = fake_session()
+    main.bot.session = session
+
+    # Без лимитов Telegram и окна склейки: меряем обработку, а не ожидание
+    queue = main.send_queue
+    queue.global_bucket = TokenBucket(1e9, 1e9)
+    queue.group_rate = queue.private_rate = queue.chat_burst = 1e9
+    queue.coalesce_window = 0
+    queue.start()
+    main.pipeline.start()
+
+    groups = make_groups(args.groups, args.members)
+    raw = make_updates(groups, args.updates, args.seed)
+    updates = [Update.model_validate(u) for u in raw]
+    states = list(main.registry)
+    results = {}
+
+    # handle_message: апдейт до конца обработки в очереди группы
+    async def feed(batch, samples=None):
+        for update in batch:
+            started = time.perf_counter()
+            await main.dp.feed_update(main.bot, update)
+            await main.pipeline.wait_idle()
+            if samples is not None:
+                samples.append(time.perf_counter() - started)
+
+    samples: List[float] = []
+    started = time.perf_counter()
+    await feed(updates, samples)
+    results["handle_message"] = summarize(samples, time.perf_counter() - started, len(updates))
+    alloc_batch = [Update.model_validate(u) for u in make_updates(groups, min(5000, args.updates), args.seed + 1, args.updates + 1)]
+    results["handle_message"].update(await measure_allocations(lambda: feed(alloc_batch), len(alloc_batch)))
+
+    # get_status_message: полная отрисовка (кэш сброшен) и повторный вызов из кэша
+    def render(cached: bool, samples=None):
+        for state in states:
+            if not cached:
+                state.status_dirty = True
+            t = time.perf_counter()
+            state.get_status_message()
+            if samples is not None:
+                samples.append(time.perf_counter() - t)
+
+    for cached, name in ((False, "get_status_message"), (True, "get_status_message_cached")):
+        samples = []
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            render(cached, samples)
+        results[name] = summarize(samples, time.perf_counter() - started, len(samples))
+
+        async def render_async(cached=cached):
+            render(cached)
+        results[name].update(await measure_allocations(render_async, len(states)))
+
+    # new_day_tasks: смена дня во всех группах сразу
+    async def rollover():
+        for state in states:
+            state.current_date -= timedelta(days=1)
+        await main.new_day_tasks()
+
+    samples = []
+    started = time.perf_counter()
+    for _ in range(args.rounds):
+        t = time.perf_counter()
+        await rollover()
+        samples.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+    results["new_day_tasks"] = summarize(samples, elapsed, args.rounds)
+    results["new_day_tasks"]["groups_per_sec"] = round(args.rounds * len(states) / elapsed, 1)
+    results["new_day_tasks"].update(await measure_allocations(rollover, len(states)))
+
+    await queue.drain(30)
+    main.store.close()
+    results["telegram_calls"] = session.calls
+    return results
+
+
+def compare(current: dict, previous: dict):
+    """Сравнение с сохраненным прогоном"""
+    print(f"\n{'бенчмарк':<28}{'метрика':<24}{'было':>12}{'стало':>12}{'изм.':>9}")
+    for name, result in current["results"].items():
+        old = previous.get("results", {}).get(name)
+        if not isinstance(result, dict) or not isinstance(old, dict):
+            continue
+        for metric in ("ops_per_sec", "p50_ms", "p99_ms", "retained_bytes_per_op"):
+            if result.get(metric) is None or not old.get(metric):
+                continue
+            change = (result[metric] - old[metric]) / old[metric] * 100
+            print(f"{name:<28}{metric:<24}{old[metric]:>12}{result[metric]:>12}{change:>+8.1f}%")
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон обработки апдейтов")
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--members", type=int, default=2)
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=5, help="повторы отрисовки статуса и смены дня")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="bench-results.json")
+    parser.add_argument("--compare", help="JSON предыдущего прогона")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        setup_environment(make_groups(args.groups, args.members), workdir)
+        results = asyncio.run(run_benchmarks(args))
+
+    report = {
+        "version": git_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    for name, result in results.items():
+        print(f"{name}: {json.dumps(result, ensure_ascii=False)}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,80 @@
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Type
+
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import CallbackQuery
+
+Handler = Callable[..., Awaitable[Any]]
+
+
+class _Node:
+    __slots__ = ("children", "route")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.route: Optional[Tuple[Handler, Optional[Type[CallbackData]]]] = None
+
+
+class CallbackRouter:
+    """Маршрутизация callback_data по префиксу через префиксное дерево
+
+    callback_data имеет вид "префикс" или "префикс:поле:поле" (формат
+    aiogram CallbackData). Поиск обработчика - проход по символам префикса,
+    его стоимость не зависит от числа зарегистрированных действий.
+    Обработчик вызывается как handler(callback) для действий без данных и
+    handler(callback, payload) для типизированных.
+    """
+
+    def __init__(self, separator: str = ":"):
+        self.separator = separator
+        self._root = _Node()
+
+    def register(self, prefix: str, handler: Handler, payload: Optional[Type[CallbackData]] = None):
+        if not prefix or self.separator in prefix:
+            raise ValueError(f"Недопустимый префикс callback_data: {prefix!r}")
+        node = self._root
+        for ch in prefix:
+            node = node.children.setdefault(ch, _Node())
+        if node.route is not None:
+            raise ValueError(f"Префикс {prefix!r} уже занят")
+        node.route = (handler, payload)
+
+    def route(self, target):
+        """Декоратор: @router.route("код") или @router.route(КлассCallbackData)"""
+        def decorator(handler: Handler) -> Handler:
+            if isinstance(target, type) and issubclass(target, CallbackData):
+                self.register(target.__prefix__, handler, target)
+            else:
+                self.register(target, handler)
+            return handler
+        return decorator
+
+    def resolve(self, data: str) -> Optional[Tuple[Handler, Optional[CallbackData]]]:
+        node = self._root
+        for ch in data:
+            if ch == self.separator:
+                break
+            node = node.children.get(ch)
+            if node is None:
+                return None
+        if node.route is None:
+            return None
+
+        handler, payload_type = node.route
+        if payload_type is None:
+            return (handler, None) if self.separator not in data else None
+        try:
+            return handler, payload_type.unpack(data)
+        except (ValueError, TypeError):
+            return None
+
+    async def dispatch(self, callback: CallbackQuery) -> bool:
+        """Вызов обработчика; False - callback_data не распознана"""
+        resolved = self.resolve(callback.data or "")
+        if resolved is None:
+            return False
+        handler, payload = resolved
+        if payload is None:
+            await handler(callback)
+        else:
+            await handler(callback, payload)
+        return True
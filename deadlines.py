@@ -0,0 +1,93 @@
+import time
+import heapq
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Обработчик пачки: (вид, [(ключ, плановое время), ...])
+BatchHandler = Callable[[str, List[Tuple[Hashable, float]]], Awaitable[None]]
+
+
+class DeadlineScheduler:
+    """Один таймер на все группы: min-heap ближайших сроков
+
+    На каждую пару (ключ, вид) хранится не больше одного срока. Вставка -
+    O(log n), отмена - O(1): запись помечается недействительной и выбрасывается
+    при извлечении (куча перестраивается, когда таких записей больше половины).
+    Все сроки, наступившие к моменту пробуждения, отдаются обработчику одной
+    пачкой на каждый вид.
+    """
+
+    def __init__(self, handler: BatchHandler, max_sleep: float = 60):
+        self.handler = handler
+        self.max_sleep = max_sleep
+        self._heap: List[list] = []  # [время, порядковый номер, ключ, вид, активна]
+        self._entries: Dict[Tuple[Hashable, str], list] = {}
+        self._counter = 0
+        self._cancelled = 0
+        self._wakeup = asyncio.Event()
+
+    def schedule(self, key: Hashable, kind: str, when: float):
+        """Назначить (или перенести) срок; when - unix time"""
+        self.cancel(key, kind)
+        self._counter += 1
+        entry = [when, self._counter, key, kind, True]
+        self._entries[(key, kind)] = entry
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._wakeup.set()
+
+    def cancel(self, key: Hashable, kind: str):
+        entry = self._entries.pop((key, kind), None)
+        if entry is None:
+            return
+        entry[4] = False
+        self._cancelled += 1
+        if self._cancelled > len(self._heap) // 2:
+            self._heap = [e for e in self._heap if e[4]]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def next_deadline(self, key: Hashable, kind: str):
+        entry = self._entries.get((key, kind))
+        return entry[0] if entry else None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _pop_due(self, now: float) -> Dict[str, List[Tuple[Hashable, float]]]:
+        due: Dict[str, List[Tuple[Hashable, float]]] = {}
+        while self._heap and self._heap[0][0] <= now:
+            when, _, key, kind, active = heapq.heappop(self._heap)
+            if not active:
+                self._cancelled -= 1
+                continue
+            del self._entries[(key, kind)]
+            due.setdefault(kind, []).append((key, when))
+        return due
+
+    async def run(self):
+        while True:
+            while self._heap and not self._heap[0][4]:
+                heapq.heappop(self._heap)
+                self._cancelled -= 1
+
+            delay = self.max_sleep
+            if self._heap:
+                delay = min(delay, self._heap[0][0] - time.time())
+
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for kind, batch in self._pop_due(time.time()).items():
+                try:
+                    await self.handler(kind, batch)
+                except Exception:
+                    logger.exception(f"Ошибка обработки сроков {kind} ({len(batch)} шт.)")
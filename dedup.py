@@ -0,0 +1,80 @@
+from array import array
+from typing import Dict, Hashable, Tuple
+
+
+class RingWindow:
+    """Окно последних size номеров одного потока (update_id)
+
+    Ячейка кольцевого буфера number % size хранит последний записанный в
+    нее номер: номер уже встречался, если лежит в своей ячейке. Проверка -
+    O(1) при любом размере окна, память - 8 * size байт. Номер старше
+    окна - новая нумерация потока (Telegram выбирает update_id заново после
+    недели без апдейтов): окно очищается и начинается с этого номера.
+    """
+
+    def __init__(self, size: int = 4096):
+        self.size = size
+        self.ring = array("q", bytes(8 * size))
+        self.high = 0
+        self.checked = 0
+        self.duplicates = 0
+        self.resets = 0
+
+    def seen(self, number: int) -> bool:
+        """Отметить номер; True - он уже встречался"""
+        self.checked += 1
+        slot = number % self.size
+        if number <= self.high - self.size:
+            self.resets += 1
+            self.ring = array("q", bytes(8 * self.size))
+            self.ring[slot] = self.high = number
+            return False
+        if self.ring[slot] == number:
+            self.duplicates += 1
+            return True
+        self.ring[slot] = number
+        if number > self.high:
+            self.high = number
+        return False
+
+
+class ReplayWindow:
+    """Отсев повторно доставленных апдейтов по возрастающим номерам в каждом чате
+
+    Для каждого ключа (чата) хранится наибольший
+    номер (update_id, message_id) и битовая маска size номеров перед ним,
+    как в окне защиты от повторов IPsec. Проверка с отметкой - O(1),
+    память - size бит на ключ, сколько бы бот ни работал. Номер старше
+    окна считается повтором: Telegram выдает номера по возрастанию, и
+    такой апдейт может быть только давно учтенным.
+    """
+
+    def __init__(self, size: int = 64):
+        self.size = size
+        self._mask = (1 << size) - 1
+        self._windows: Dict[Hashable, Tuple[int, int]] = {}
+        self.checked = 0
+        self.duplicates = 0
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    def seen(self, key: Hashable, number: int) -> bool:
+        """Отметить номер; True - он уже встречался (или старше окна)"""
+        self.checked += 1
+        window = self._windows.get(key)
+        if window is None:
+            self._windows[key] = (number, 1)
+            return False
+        high, mask = window
+        if number > high:
+            shift = number - high
+            mask = ((mask << shift) | 1) & self._mask if shift < self.size else 1
+            self._windows[key] = (number, mask)
+            return False
+        bit = high - number
+        if bit >= self.size or mask >> bit & 1:
+            self.duplicates += 1
+            return True
+        self._windows[key] = (high, mask | 1 << bit)
+        return False
@@ -0,0 +1,266 @@
+import sys
+import time
+import heapq
+import asyncio
+import logging
+import threading
+import traceback
+from collections import Counter
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+current_trace: ContextVar[Optional["UpdateTrace"]] = ContextVar("current_trace", default=None)
+
+
+class UpdateTrace:
+    """Время обработки одного апдейта по этапам"""
+    __slots__ = ("update_id", "kind", "chat_id", "started", "finished", "stages",
+                 "samples", "pending")
+
+    def __init__(self, update_id: int, kind: str, chat_id: Optional[int]):
+        self.update_id = update_id
+        self.kind = kind
+        self.chat_id = chat_id
+        self.started = time.perf_counter()
+        self.finished = 0.0
+        self.stages: Dict[str, float] = {}
+        self.samples: Optional[Counter] = None  # свернутые стеки -> число сэмплов
+        self.pending = 1  # незавершенные части: сам апдейт и задачи в очередях
+
+    @property
+    def duration(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def to_dict(self) -> dict:
+        return {
+            "update_id": self.update_id,
+            "kind": self.kind,
+            "chat_id": self.chat_id,
+            "duration_ms": round(self.duration * 1000, 3),
+            "stages_ms": {stage: round(s * 1000, 3) for stage, s in self.stages.items()},
+            "samples": sum(self.samples.values()) if self.samples else 0,
+        }
+
+
+class _Stage:
+    __slots__ = ("diagnostics", "trace", "name", "started", "outer")
+
+    def __init__(self, diagnostics: "Diagnostics", trace: UpdateTrace, name: str):
+        self.diagnostics = diagnostics
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.outer = self.diagnostics.running
+        self.diagnostics.running = self.trace
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, time.perf_counter() - self.started)
+        self.diagnostics.running = self.outer
+        return False
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_STAGE = _NoStage()
+
+
+class Diagnostics:
+    """Диагностика зависаний: задержка event loop и медленные апдейты
+
+    Апдейт сопровождается UpdateTrace в contextvar: этапы (stage) копят
+    время, задачи в очередях чатов продолжают трассу через bind(). Апдейты
+    дольше threshold секунд попадают в список keep самых медленных.
+
+    Фоновый поток раз в sample_interval секунд снимает стек потока event
+    loop, пока выполняется этап какого-либо апдейта, и приписывает сэмпл
+    этому апдейту - так у медленных апдейтов есть профиль в формате
+    folded stacks (flamegraph.pl, speedscope). Если loop не отвечает
+    дольше stall_threshold, поток сохраняет стек блокирующего вызова.
+    Выключенная диагностика сводится к проверке флага.
+    """
+
+    def __init__(self, enabled: bool = False, threshold: float = 0.2, keep: int = 20,
+                 lag_interval: float = 0.1, stall_threshold: float = 0.5,
+                 sample_interval: float = 0.005, max_depth: int = 40,
+                 on_lag: Optional[Callable[[float], None]] = None):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.keep = keep
+        self.lag_interval = lag_interval
+        self.stall_threshold = stall_threshold
+        self.sample_interval = sample_interval
+        self.max_depth = max_depth
+        self.on_lag = on_lag
+        self.running: Optional[UpdateTrace] = None  # трасса выполняющегося этапа
+        self.slow: List[tuple] = []  # куча (длительность, update_id, трасса)
+        self.slow_total = 0
+        self.updates = 0
+        self.max_lag = 0.0
+        self.stalls: List[dict] = []
+        self._heartbeat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._stop = threading.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    # Трассы апдейтов
+    def begin(self, update_id: int, kind: str, chat_id: Optional[int]) -> Optional[UpdateTrace]:
+        if not self.enabled:
+            return None
+        trace = UpdateTrace(update_id, kind, chat_id)
+        if self.sample_interval:
+            trace.samples = Counter()
+        current_trace.set(trace)
+        return trace
+
+    def mark(self, stage: str):
+        """Этап от начала апдейта до текущего момента (например, фильтры)"""
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add(stage, time.perf_counter() - trace.started - sum(trace.stages.values()))
+
+    def stage(self, name: str):
+        """Контекстный менеджер этапа текущего апдейта"""
+        trace = current_trace.get() if self.enabled else None
+        return NO_STAGE if trace is None else _Stage(self, trace, name)
+
+    def record(self, stage: str, seconds: float):
+        trace = current_trace.get() if self.enabled else None
+        if trace is not None:
+            trace.add(stage, seconds)
+
+    def bind(self, job: Callable[[], Any]) -> Callable[[], Any]:
+        """Продолжение трассы в задаче очереди чата; время ожидания - этап queue"""
+        trace = current_trace.get() if self.enabled else None
+        if trace is None:
+            return job
+        trace.pending += 1
+        queued = time.perf_counter()
+
+        async def run():
+            token = current_trace.set(trace)
+            trace.add("queue", time.perf_counter() - queued)
+            try:
+                result = job()
+                if asyncio.iscoroutine(result):
+                    result = await result
+                return result
+            finally:
+                current_trace.reset(token)
+                self.finish(trace)
+        return run
+
+    def finish(self, trace: Optional[UpdateTrace]):
+        if trace is None:
+            return
+        trace.pending -= 1
+        if trace.pending:
+            return
+        trace.finished = time.perf_counter()
+        self.updates += 1
+        duration = trace.duration
+        if duration < self.threshold:
+            trace.samples = None
+            return
+        self.slow_total += 1
+        entry = (duration, trace.update_id, trace)
+        if len(self.slow) < self.keep:
+            heapq.heappush(self.slow, entry)
+        elif duration > self.slow[0][0]:
+            heapq.heapreplace(self.slow, entry)
+        logger.warning(
+            f"Медленный апдейт {trace.update_id} ({trace.kind}): {duration * 1000:.0f} мс, "
+            + ", ".join(f"{stage} {s * 1000:.1f}" for stage, s in trace.stages.items())
+        )
+
+    # Задержка event loop и сэмплирование
+    async def _measure_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            lag = max(0.0, loop.time() - expected)
+            self._heartbeat = time.monotonic()
+            self.max_lag = max(self.max_lag, lag)
+            if self.on_lag is not None:
+                self.on_lag(lag)
+
+    def _stack(self, frame) -> str:
+        stack = traceback.extract_stack(frame, limit=self.max_depth)
+        return ";".join(f"{f.name} ({f.filename.rsplit('/', 1)[-1]}:{f.lineno})" for f in stack)
+
+    def _sampler(self):
+        interval = self.sample_interval or self.lag_interval
+        stalled = False
+        while not self._stop.wait(interval):
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            trace = self.running
+            samples = trace.samples if trace is not None else None
+            if samples is not None:
+                samples[self._stack(frame)] += 1
+
+            # Loop не возвращался к таймеру: что-то блокирует поток
+            blocked = time.monotonic() - self._heartbeat - self.lag_interval
+            if blocked > self.stall_threshold and not stalled:
+                stalled = True
+                self.stalls.append({"time": time.time(), "blocked_ms": round(blocked * 1000),
+                                    "stack": self._stack(frame)})
+                del self.stalls[:-self.keep]
+                logger.warning(f"Event loop заблокирован {blocked * 1000:.0f} мс:\n"
+                               + "".join(traceback.format_stack(frame, limit=10)))
+            elif blocked <= self.stall_threshold:
+                stalled = False
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._tasks.append(asyncio.create_task(self._measure_lag()))
+        threading.Thread(target=self._sampler, name="diagnostics-sampler", daemon=True).start()
+        logger.info(f"Диагностика включена: медленные апдейты от {self.threshold * 1000:.0f} мс")
+
+    def stop(self):
+        self._stop.set()
+        for task in self._tasks:
+            task.cancel()
+
+    # Отчеты
+    def slowest(self) -> List[UpdateTrace]:
+        return [trace for _, _, trace in sorted(self.slow, reverse=True)]
+
+    def report(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "threshold_ms": self.threshold * 1000,
+            "updates": self.updates,
+            "slow_updates": self.slow_total,
+            "max_loop_lag_ms": round(self.max_lag * 1000, 3),
+            "stalls": self.stalls,
+            "slowest": [trace.to_dict() for trace in self.slowest()],
+        }
+
+    def folded(self, update_id: Optional[int] = None) -> str:
+        """Профиль медленных апдейтов (или одного) в формате folded stacks"""
+        total: Counter = Counter()
+        for trace in self.slowest():
+            if trace.samples and update_id in (None, trace.update_id):
+                total.update(trace.samples)
+        return "".join(f"{stack} {count}\n" for stack, count in total.most_common())
@@ -0,0 +1,271 @@
+"""Локальная замена Telegram Bot API для нагрузочных прогонов
+
+Реализует методы, которые использует бот (getUpdates, sendMessage,
+editMessageText, answerCallbackQuery, pinChatMessage, deleteWebhook,
+setWebhook, getMe), с задержкой ответа, случайными 429 и лимитами
+Telegram. Апдейты генерируются потоком с заданной частотой. Бот
+подключается через TELEGRAM_API_URL:
+
+    python fakeapi.py --groups 500 --rate 3000 --seconds 60 --write-groups groups.json
+    TELEGRAM_API_URL=http://127.0.0.1:8081 GROUPS_FILE=groups.json python main.py
+
+Статистика (запросы по методам, 429, задержка ответа бота на !огонек от
+выдачи апдейта до sendMessage) - на /stats и в выводе по окончании.
+"""
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from aiohttp import web
+
+from bench import make_groups, make_updates
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITED_METHODS = {"sendMessage", "editMessageText"}
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class FakeTelegram:
+    """Сервер Bot API в памяти
+
+    latency - задержка каждого ответа (секунды, случайно от 0.5x до 1.5x),
+    retry_rate - доля sendMessage/editMessageText, получающих 429 с
+    retry_after секунд. С enforce_limits 429 отдается и при превышении
+    лимитов Telegram: 30 сообщений/с на бота, 20 в минуту на группу.
+    """
+
+    def __init__(self, latency: float = 0.0, retry_rate: float = 0.0, retry_after: int = 1,
+                 enforce_limits: bool = False, rng: Optional[random.Random] = None):
+        self.latency = latency
+        self.retry_rate = retry_rate
+        self.retry_after = retry_after
+        self.enforce_limits = enforce_limits
+        self.rng = rng or random.Random()
+        self.updates: Deque[dict] = deque()
+        self.next_update_id = 1
+        self._new_updates = asyncio.Event()
+        self.message_ids: Dict[int, int] = {}
+        self.delivered: Dict[int, float] = {}  # message_id команды -> время выдачи в getUpdates
+        self.reply_latency: List[float] = []
+        self.calls: Dict[str, int] = {}
+        self.retries = 0
+        self.updates_delivered = 0
+        self.started = time.monotonic()
+        self._global_sent: Deque[float] = deque()
+        self._chat_sent: Dict[int, Deque[float]] = {}
+
+    # Апдейты
+    def push(self, update: dict):
+        """Добавить апдейт (update_id и message_id назначаются по порядку)"""
+        update = dict(update, update_id=self.next_update_id)
+        self.next_update_id += 1
+        if "message" in update:
+            # Как в Telegram: номера сообщений чата общие с сообщениями бота
+            chat_id = update["message"]["chat"]["id"]
+            message_id = self.message_ids[chat_id] = self.message_ids.get(chat_id, 0) + 1
+            update["message"] = dict(update["message"], message_id=message_id)
+        self.updates.append(update)
+        self._new_updates.set()
+
+    async def firehose(self, updates: List[dict], rate: float, seconds: float):
+        """Поток апдейтов: rate в секунду в течение seconds (по кругу из updates)"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        sent = 0
+        while loop.time() - started < seconds:
+            due = int((loop.time() - started) * rate) - sent
+            for _ in range(due):
+                self.push(updates[sent % len(updates)])
+                sent += 1
+            await asyncio.sleep(0.01)
+        logger.info(f"Поток апдейтов завершен: {sent}")
+
+    async def get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset") or 0)
+        limit = min(int(params.get("limit") or 100), 100)
+        timeout = float(params.get("timeout") or 0)
+        # Подтверждение: апдейты до offset больше не выдаются
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = [self.updates[i] for i in range(min(limit, len(self.updates)))]
+        now = time.monotonic()
+        for update in batch:
+            message = update.get("message")
+            if message and message.get("text") == "!огонек":
+                self.delivered.setdefault(message["message_id"], now)
+        self.updates_delivered += len(batch)
+        return batch
+
+    # Лимиты
+    def _limited(self, chat_id: int, now: float) -> bool:
+        if self.retry_rate and self.rng.random() < self.retry_rate:
+            return True
+        if not self.enforce_limits:
+            return False
+        chat = self._chat_sent.setdefault(chat_id, deque())
+        for window, sent, limit in ((1, self._global_sent, 30), (60, chat, 20 if chat_id < 0 else 60)):
+            while sent and sent[0] <= now - window:
+                sent.popleft()
+            if len(sent) >= limit:
+                return True
+        self._global_sent.append(now)
+        chat.append(now)
+        return False
+
+    # Методы
+    def _message(self, chat_id: int, text: str, message_id: Optional[int] = None) -> dict:
+        if message_id is None:
+            message_id = self.message_ids.get(chat_id, 0) + 1
+            self.message_ids[chat_id] = message_id
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Огонёк"},
+            "text": text,
+        }
+
+    async def call(self, method: str, params: dict) -> dict:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method != "getUpdates" and self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+
+        if method in RATE_LIMITED_METHODS and self._limited(int(params["chat_id"]), time.monotonic()):
+            self.retries += 1
+            return {
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+
+        if method == "getUpdates":
+            result = await self.get_updates(params)
+        elif method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            reply = json.loads(params["reply_parameters"]).get("message_id") \
+                if "reply_parameters" in params else params.get("reply_to_message_id")
+            if reply is not None and int(reply) in self.delivered:
+                self.reply_latency.append(time.monotonic() - self.delivered.pop(int(reply)))
+            result = self._message(chat_id, params.get("text", ""))
+        elif method == "editMessageText":
+            result = self._message(int(params["chat_id"]), params.get("text", ""), int(params["message_id"]))
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Огонёк", "username": "fake_ogonek_bot"}
+        elif method in ("answerCallbackQuery", "pinChatMessage", "deleteWebhook", "setWebhook", "close"):
+            result = True
+        else:
+            return {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+        return {"ok": True, "result": result}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        params = dict(await request.post()) if request.method == "POST" else {}
+        params.update(request.query)
+        return web.json_response(await self.call(request.match_info["method"], params))
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "seconds": round(elapsed, 1),
+            "updates_delivered": self.updates_delivered,
+            "updates_pending": len(self.updates),
+            "updates_per_sec": round(self.updates_delivered / elapsed, 1) if elapsed else None,
+            "calls": self.calls,
+            "retry_after_sent": self.retries,
+            "replies": len(self.reply_latency),
+            "reply_p50_ms": round(percentile(self.reply_latency, 0.50) * 1000, 2),
+            "reply_p99_ms": round(percentile(self.reply_latency, 0.99) * 1000, 2),
+        }
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+
+def command_updates(groups: List[dict], count: int, seed: int) -> List[dict]:
+    """Команды !огонек вперемешку с обычными сообщениями (для замера ответа)"""
+    updates = make_updates(groups, count, seed)
+    for update in updates[::50]:
+        update["message"]["text"] = "!огонек"
+        for field in ("sticker", "voice", "photo", "video_note", "location"):
+            update["message"].pop(field, None)
+    return updates
+
+
+async def serve(args):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    server = FakeTelegram(args.latency / 1000, args.retry_rate, args.retry_after, args.enforce_limits)
+    runner = web.AppRunner(server.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    logger.info(f"Fake Bot API: http://{args.host}:{args.port}")
+
+    groups = make_groups(args.groups, args.members)
+    if args.write_groups:
+        with open(args.write_groups, "w", encoding="utf-8") as f:
+            json.dump(groups, f)
+    try:
+        if args.rate:
+            await asyncio.sleep(args.warmup)
+            now = int(time.time())
+            updates = command_updates(groups, min(100000, max(1000, int(args.rate * 10))), args.seed)
+            for update in updates:
+                update["message"]["date"] = now
+            await server.firehose(updates, args.rate, args.seconds)
+            while server.updates:
+                await asyncio.sleep(0.5)
+            await asyncio.sleep(args.settle)
+            print(json.dumps(server.stats(), ensure_ascii=False, indent=2))
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--members", type=int, default=2)
+    parser.add_argument("--write-groups", help="записать группы в JSON для GROUPS_FILE бота")
+    parser.add_argument("--rate", type=float, default=0, help="апдейтов в секунду (0 - без потока)")
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=5, help="пауза до потока, пока бот запускается")
+    parser.add_argument("--settle", type=float, default=5, help="ожидание ответов после потока")
+    parser.add_argument("--latency", type=float, default=0, help="задержка ответа, мс")
+    parser.add_argument("--retry-rate", type=float, default=0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--enforce-limits", action="store_true", help="429 при превышении лимитов Telegram")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,375 @@
+import os
+import struct
+import logging
+import argparse
+from array import array
+from datetime import date
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FILE = "history.bin"
+STATUSES = ("alive", "frozen", "dead")
+
+# Заголовок записи дня: chat_id, день (date.toordinal), заданий, участников,
+# флаги (бит 0 - день засчитан), статус до и после смены дня (по 4 бита), серия после
+HEADER = struct.Struct("<qiBBBBI")
+
+
+def _tail_size(tasks: int, members: int) -> int:
+    # id заданий, биты выполнения (задание x участник), user_id и счетчики сообщений
+    return tasks + (tasks * members + 7) // 8 + members * 8 + members * 4
+
+
+def new_streak(chat_id: int) -> dict:
+    return {
+        "chat_id": chat_id, "streak": 0, "status": "alive", "consecutive_misses": 0,
+        "series_start_date": None, "longest_streak": 0, "days": 0,
+    }
+
+
+def advance_streak(info: dict, day: date, success: bool):
+    """Переход серии через день по правилам FireState.update_status:
+    успешный день продлевает серию, три пропуска подряд гасят огонек"""
+    info["days"] += 1
+    if success:
+        info["consecutive_misses"] = 0
+        info["status"] = "alive"
+        info["streak"] += 1
+        if info["streak"] == 1:
+            info["series_start_date"] = day
+        info["longest_streak"] = max(info["longest_streak"], info["streak"])
+    else:
+        info["consecutive_misses"] += 1
+        if info["consecutive_misses"] >= 3:
+            info["status"] = "dead"
+            info["streak"] = 0
+            info["series_start_date"] = None
+        else:
+            info["status"] = "frozen"
+
+
+class DayRecord:
+    """Итог одного дня группы"""
+    __slots__ = ("chat_id", "day", "tasks", "user_ids", "done", "counts",
+                 "success", "status_before", "status_after", "streak")
+
+    def __init__(self, chat_id: int, day: date, tasks: List[int], user_ids: List[int],
+                 done: List[List[bool]], counts: List[int], success: bool,
+                 status_before: str, status_after: str, streak: int):
+        self.chat_id = chat_id
+        self.day = day
+        self.tasks = tasks
+        self.user_ids = user_ids
+        self.done = done  # done[задание][участник]
+        self.counts = counts  # сообщений участника за день
+        self.success = success
+        self.status_before = status_before
+        self.status_after = status_after
+        self.streak = streak
+
+    def encode(self) -> bytes:
+        members = len(self.user_ids)
+        bits = 0
+        for t in range(len(self.tasks)):
+            for m in range(members):
+                if self.done[t][m]:
+                    bits |= 1 << (t * members + m)
+        return encode_day(self.chat_id, self.day.toordinal(), self.tasks, self.user_ids, bits,
+                          self.counts, self.success, self.status_before, self.status_after, self.streak)
+
+
+def encode_day(chat_id: int, day: int, tasks: Sequence[int], user_ids: Sequence[int], bits: int,
+               counts: Sequence[int], success: bool, status_before: str, status_after: str,
+               streak: int) -> bytes:
+    """Запись дня без DayRecord: bits - выполнение, бит задания t участника m - t * members + m"""
+    members = len(user_ids)
+    return b"".join((
+        HEADER.pack(
+            chat_id, day, len(tasks), members, int(success),
+            STATUSES.index(status_before) << 4 | STATUSES.index(status_after), streak
+        ),
+        bytes(tasks),
+        bits.to_bytes((len(tasks) * members + 7) // 8, "little"),
+        struct.pack(f"<{members}q{members}I", *user_ids, *(min(c, 0xFFFFFFFF) for c in counts)),
+    ))
+
+
+class History:
+    """История дней в столбцах (array), для запросов по всем группам
+
+    Уровень дня: d_chat, d_day, d_success, d_streak и начало ячеек дня в
+    столбцах c_*. Ячейка - пара (задание, участник): c_task, c_user,
+    c_done, c_count. Запросы - один проход по столбцам без объектов на день.
+    """
+
+    def __init__(self):
+        self.d_chat = array("q")
+        self.d_day = array("i")
+        self.d_success = array("b")
+        self.d_streak = array("I")
+        self.d_cells = array("I")  # индекс первой ячейки дня
+        self.d_members = array("B")
+        self.c_task = array("B")
+        self.c_user = array("q")
+        self.c_done = array("b")
+        self.c_count = array("I")
+
+    def __len__(self) -> int:
+        return len(self.d_chat)
+
+    def add(self, chat_id: int, day: int, tasks: bytes, members: int, bits: int,
+            user_ids: tuple, counts: tuple, success: bool, streak: int):
+        self.d_chat.append(chat_id)
+        self.d_day.append(day)
+        self.d_success.append(success)
+        self.d_streak.append(streak)
+        self.d_cells.append(len(self.c_task))
+        self.d_members.append(members)
+        for t, task in enumerate(tasks):
+            for m in range(members):
+                self.c_task.append(task)
+                self.c_user.append(user_ids[m])
+                self.c_done.append(bits >> (t * members + m) & 1)
+                self.c_count.append(counts[m])
+
+    def _cells(self, i: int) -> range:
+        end = self.d_cells[i + 1] if i + 1 < len(self.d_cells) else len(self.c_task)
+        return range(self.d_cells[i], end)
+
+    def _order(self, chat_id: Optional[int]) -> List[int]:
+        """Индексы дней, упорядоченные по группе и дате"""
+        days = range(len(self.d_chat)) if chat_id is None else [
+            i for i, chat in enumerate(self.d_chat) if chat == chat_id
+        ]
+        return sorted(days, key=lambda i: (self.d_chat[i], self.d_day[i]))
+
+    def chat_days(self, chat_id: int) -> List[Tuple[int, bool, Tuple[int, ...]]]:
+        """Дни группы по дате: (день, засчитан, задания)"""
+        days = []
+        for i in self._order(chat_id):
+            cells = self._cells(i)
+            tasks = tuple(self.c_task[cells.start:cells.stop:self.d_members[i] or 1])
+            days.append((self.d_day[i], bool(self.d_success[i]), tasks))
+        return days
+
+    def completion_rate_by_type(self, task_types: Dict[int, str],
+                                chat_id: Optional[int] = None) -> Dict[str, float]:
+        """Доля выполненных ячеек (задание x участник) по типам заданий"""
+        done: Dict[str, int] = {}
+        total: Dict[str, int] = {}
+        cells = range(len(self.c_task)) if chat_id is None else [
+            c for i, chat in enumerate(self.d_chat) if chat == chat_id for c in self._cells(i)
+        ]
+        for c in cells:
+            task_type = task_types.get(self.c_task[c], "unknown")
+            total[task_type] = total.get(task_type, 0) + 1
+            done[task_type] = done.get(task_type, 0) + self.c_done[c]
+        return {task_type: done[task_type] / total[task_type] for task_type in total}
+
+    def member_reliability(self, chat_id: Optional[int] = None) -> Dict[Tuple[int, int], float]:
+        """Доля дней, когда участник выполнил все свои задания: (chat_id, user_id) -> доля"""
+        good: Dict[Tuple[int, int], int] = {}
+        days: Dict[Tuple[int, int], int] = {}
+        for i in range(len(self.d_chat)):
+            chat = self.d_chat[i]
+            if chat_id is not None and chat != chat_id:
+                continue
+            members = self.d_members[i]
+            cells = self._cells(i)
+            for m in range(members):
+                key = (chat, self.c_user[cells.start + m])
+                days[key] = days.get(key, 0) + 1
+                if all(self.c_done[c] for c in cells[m::members]):
+                    good[key] = good.get(key, 0) + 1
+        return {key: good.get(key, 0) / days[key] for key in days}
+
+    def recompute_successes(self, required: Callable[[int], Optional[int]]):
+        """Пересчет засчитанности дней из ячеек (после исправления правил)
+
+        required(task_id) - нужное число сообщений для заданий-счетчиков или
+        None для заданий-флагов.
+        """
+        for i in range(len(self.d_chat)):
+            success = True
+            for c in self._cells(i):
+                need = required(self.c_task[c])
+                if not (self.c_count[c] >= need if need is not None else self.c_done[c]):
+                    success = False
+                    break
+            self.d_success[i] = success
+
+    def replay_streaks(self, chat_id: Optional[int] = None) -> Dict[int, dict]:
+        """Серия, статус и рекорд каждой группы по засчитанным дням (advance_streak)"""
+        result: Dict[int, dict] = {}
+        current = None
+        for i in self._order(chat_id):
+            chat = self.d_chat[i]
+            if current is None or current["chat_id"] != chat:
+                current = result[chat] = new_streak(chat)
+            advance_streak(current, date.fromordinal(self.d_day[i]), bool(self.d_success[i]))
+        return result
+
+    def longest_streaks(self) -> Dict[int, int]:
+        """Рекордная серия каждой группы (по записанным значениям серии)"""
+        best: Dict[int, int] = {}
+        for chat, streak in zip(self.d_chat, self.d_streak):
+            if streak > best.get(chat, -1):
+                best[chat] = streak
+        return best
+
+
+class HistoryStore:
+    """Append-only файл итогов дней всех групп
+
+    Запись дня - заголовок HEADER и хвост фиксированной для числа заданий и
+    участников длины (~40 байт на пару с тремя заданиями). Недописанная
+    после падения запись отрезается при открытии. День, смена которого
+    повторилась после падения (до fsync журнала), может быть записан
+    дважды: при чтении из записей одного (chat_id, день) берется последняя.
+    """
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, HISTORY_FILE)
+        os.makedirs(directory, exist_ok=True)
+        self._file = None
+        # Смещения записей каждой группы (8 байт на день): статистика одной
+        # группы читает только ее записи, а не весь файл
+        self._index: Dict[int, array] = {}
+        self._size = 0
+
+    @staticmethod
+    def _decode(data: bytes, offset: int) -> Optional[Tuple[int, tuple]]:
+        """Запись с offset: (смещение конца, поля) или None, если она не дописана"""
+        if offset + HEADER.size > len(data):
+            return None
+        chat_id, day, tasks, members, flags, statuses, streak = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + _tail_size(tasks, members)
+        if end > len(data):
+            return None
+        pos = offset + HEADER.size
+        task_ids = data[pos:pos + tasks]
+        pos += tasks
+        bits_len = (tasks * members + 7) // 8
+        bits = int.from_bytes(data[pos:pos + bits_len], "little")
+        pos += bits_len
+        values = struct.unpack_from(f"<{members}q{members}I", data, pos)
+        return end, (chat_id, day, task_ids, members, bits, values[:members],
+                     values[members:], bool(flags & 1), streak)
+
+    @staticmethod
+    def _scan(data: bytes):
+        """Только заголовки записей: (смещение начала, chat_id, день)"""
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            chat_id, day, tasks, members = HEADER.unpack_from(data, offset)[:4]
+            end = offset + HEADER.size + _tail_size(tasks, members)
+            if end > len(data):
+                break
+            yield offset, chat_id, day
+            offset = end
+
+    def _records(self, data: bytes):
+        """Чтение записей: (смещение начала, смещение конца, поля) до первой поврежденной"""
+        offset = 0
+        while True:
+            decoded = self._decode(data, offset)
+            if decoded is None:
+                break
+            end, fields = decoded
+            yield offset, end, fields
+            offset = end
+
+    def _open(self):
+        if self._file is not None:
+            return
+        valid = 0
+        self._index = {}
+        if os.path.exists(self.path):
+            with open(self.path, "rb+") as f:
+                for start, valid, fields in self._records(f.read()):
+                    self._index.setdefault(fields[0], array("Q")).append(start)
+                if valid != os.path.getsize(self.path):
+                    logger.warning(f"История {self.path} обрезана после поврежденной записи")
+                    f.truncate(valid)
+        self._size = valid
+        self._file = open(self.path, "ab")
+
+    def append(self, record: DayRecord):
+        self.append_encoded([record.encode()])
+
+    def append_many(self, records: List[DayRecord]):
+        """Запись пачки дней одним вызовом write"""
+        self.append_encoded([record.encode() for record in records])
+
+    def append_encoded(self, chunks: List[bytes]):
+        """Запись пачки дней, уже закодированных encode_day"""
+        if not chunks:
+            return
+        self._open()
+        index = self._index
+        for chunk in chunks:
+            chat_id = HEADER.unpack_from(chunk)[0]
+            offsets = index.get(chat_id)
+            if offsets is None:
+                offsets = index[chat_id] = array("Q")
+            offsets.append(self._size)
+            self._size += len(chunk)
+        self._file.write(b"".join(chunks))
+        self._file.flush()
+
+    def load(self) -> History:
+        history = History()
+        if not os.path.exists(self.path):
+            return history
+        with open(self.path, "rb") as f:
+            data = f.read()
+        latest = {(chat_id, day): start for start, chat_id, day in self._scan(data)}
+        for start, _, fields in self._records(data):
+            if latest[fields[0], fields[1]] == start:
+                history.add(*fields)
+        return history
+
+    def load_chat(self, chat_id: int) -> History:
+        """Дни одной группы: чтение только ее записей по индексу смещений"""
+        self._open()
+        if os.path.getsize(self.path) != self._size:
+            # Файл дописан другим процессом: смещения устарели
+            logger.warning(f"История {self.path} изменена извне, индекс строится заново")
+            self.close()
+            self._open()
+        history = History()
+        days: Dict[int, tuple] = {}
+        with open(self.path, "rb") as f:
+            for offset in self._index.get(chat_id, ()):
+                f.seek(offset)
+                header = f.read(HEADER.size)
+                _, _, tasks, members, _, _, _ = HEADER.unpack(header)
+                decoded = self._decode(header + f.read(_tail_size(tasks, members)), 0)
+                if decoded is not None and decoded[1][0] == chat_id:
+                    days[decoded[1][1]] = decoded[1]
+        for fields in days.values():
+            history.add(*fields)
+        return history
+
+    def close(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Статистика по истории дней")
+    parser.add_argument("--data-dir", default=os.environ.get("DATA_DIR", "data"))
+    parser.add_argument("--chat", type=int, help="только одна группа")
+    args = parser.parse_args()
+
+    history = HistoryStore(args.data_dir).load()
+    print(f"Дней в истории: {len(history)}")
+    for chat_id, info in history.replay_streaks(args.chat).items():
+        print(f"Группа {chat_id}: серия {info['streak']}, рекорд {info['longest_streak']}, "
+              f"статус {info['status']}, дней {info['days']}")
+    for (chat_id, user_id), rate in sorted(history.member_reliability(args.chat).items()):
+        print(f"Участник {user_id} в {chat_id}: все задания в {rate:.0%} дней")
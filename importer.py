@@ -0,0 +1,370 @@
+"""Восстановление истории и серии группы по экспорту чата из Telegram Desktop
+
+Экспорт (result.json, "Экспорт истории чата" в формате JSON) читается
+потоком, по сообщению за раз, и не загружается в память целиком.
+Сообщения участников учитываются по тем же правилам, что в
+process_message: тип содержимого, длина текста и фразы пожеланий
+(TASK_EVALUATORS, phrase_matcher). Итоги дней дописываются в историю
+(history.bin), серия считается по ней так же, как History.replay_streaks:
+
+    python importer.py result.json --dry-run
+    python importer.py result.json --policy fixed:0,9,14 --apply
+
+Группа должна быть описана в GROUP_ID/GROUPS_FILE, как для бота. Дни,
+уже записанные ботом, не меняются: в них известны настоящие задания.
+Задания остальных дней - по --policy: plan - план, который составил бы
+планировщик бота (повторяется при каждом запуске), fixed:ids - один
+набор на все дни. Дни без сообщений - пропуски. Сегодняшний день не
+импортируется: его учитывает бот. С --apply серия, статус и рекорд
+переносятся в состояние бота. Бот должен быть остановлен: без --dry-run
+импорт не запускается, пока бот держит каталог данных.
+"""
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import argparse
+from datetime import date, datetime, time as day_time, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from aiogram.enums import ContentType
+
+from history import HistoryStore, DayRecord, new_streak, advance_streak
+from shards import shard_of
+
+# Начало списка сообщений; кавычка внутри строки была бы экранирована
+MESSAGES_START = re.compile(r'(?<!\\)"messages"\s*:\s*\[')
+SEPARATOR = re.compile(r"[\s,]*")
+
+# Медиа экспорта -> тип содержимого сообщения в Bot API
+MEDIA_TYPES = {
+    "voice_message": ContentType.VOICE,
+    "video_message": ContentType.VIDEO_NOTE,
+    "video_file": ContentType.VIDEO,
+    "animation": ContentType.ANIMATION,
+    "sticker": ContentType.STICKER,
+    "audio_file": ContentType.AUDIO,
+}
+
+
+class ChatExport:
+    """Экспорт одного чата (result.json), читаемый потоком
+
+    Заголовок (название, тип, id чата) разбирается сразу, сообщения
+    выдаются итератором: каждое декодируется raw_decode из буфера, который
+    дочитывается кусками по chunk_size символов.
+    """
+
+    def __init__(self, path: str, chunk_size: int = 1 << 20):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._file = open(path, encoding="utf-8")
+        self._buffer = ""
+        self._pos = 0
+        self.header = self._read_header()
+
+    def _read_header(self) -> dict:
+        buffer = ""
+        while True:
+            chunk = self._file.read(self.chunk_size)
+            if not chunk:
+                raise ValueError(f"{self.path}: нет списка сообщений")
+            searched = max(0, len(buffer) - 32)
+            buffer += chunk
+            match = MESSAGES_START.search(buffer, searched)
+            if match:
+                break
+        try:
+            header = json.loads(buffer[:match.start()] + '"messages": []}')
+        except json.JSONDecodeError:
+            raise ValueError(f"{self.path}: нужен экспорт одного чата, а не всего аккаунта") from None
+        self._buffer, self._pos = buffer, match.end()
+        return header
+
+    @property
+    def chat_id(self) -> Optional[int]:
+        """chat_id для Bot API по id и типу чата из экспорта"""
+        chat_type, chat_id = self.header.get("type"), self.header.get("id")
+        if chat_id is None:
+            return None
+        if chat_type in ("private_supergroup", "public_supergroup", "public_channel", "private_channel"):
+            return -(10 ** 12 + chat_id)
+        if chat_type == "private_group":
+            return -chat_id
+        return chat_id
+
+    def __iter__(self) -> Iterator[dict]:
+        decode = json.JSONDecoder().raw_decode
+        buffer, pos = self._buffer, self._pos
+        while True:
+            pos = SEPARATOR.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                message, pos = decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Сообщение не дочитано: дочитываем, отбросив разобранное
+                chunk = self._file.read(self.chunk_size)
+                if not chunk:
+                    raise ValueError(f"{self.path}: экспорт оборван") from None
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield message
+
+    def close(self):
+        self._file.close()
+
+
+class ExportMessage:
+    """Поля сообщения экспорта, которые нужны проверкам заданий"""
+    __slots__ = ("content_type", "text")
+
+    def __init__(self, content_type: str, text: Optional[str]):
+        self.content_type = content_type
+        self.text = text
+
+
+def message_text(message: dict) -> str:
+    text = message.get("text", "")
+    if isinstance(text, str):
+        return text
+    # Текст с разметкой - список строк и фрагментов {"type", "text"}
+    return "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+
+
+def classify(message: dict) -> ExportMessage:
+    """Тип содержимого и текст, как у сообщения Bot API (подпись к медиа - не text)"""
+    if "photo" in message:
+        return ExportMessage(ContentType.PHOTO, None)
+    media = message.get("media_type")
+    if media:
+        return ExportMessage(MEDIA_TYPES.get(media, ContentType.DOCUMENT), None)
+    if "location_information" in message:
+        return ExportMessage(ContentType.VENUE if "place_name" in message else ContentType.LOCATION, None)
+    if "poll" in message:
+        return ExportMessage(ContentType.POLL, None)
+    if "contact_information" in message:
+        return ExportMessage(ContentType.CONTACT, None)
+    if "file" in message:
+        return ExportMessage(ContentType.DOCUMENT, None)
+    return ExportMessage(ContentType.TEXT, message_text(message))
+
+
+def read_days(export: ChatExport, state, stats: dict) -> Dict[int, Tuple[List[int], List[int]]]:
+    """Прогресс участников по дням: {день (toordinal): (маски заданий, сообщений)}
+
+    Маска участника - биты всех заданий каталога, которые он выполнил за
+    день (по ключам индекса TaskPlan, как в process_message), счетчик -
+    его сообщения за день.
+    """
+    import main
+
+    plan = main.TaskPlan(tuple(range(len(main.TASKS))), 1)  # слот = id задания
+    index, tasks, matcher = plan.index, main.TASKS, main.phrase_matcher
+    members = {member.user_id: slot for slot, member in enumerate(state.members)}
+    size = len(state.members)
+    tz = state.tz
+
+    days: Dict[int, Tuple[List[int], List[int]]] = {}
+    day_start = day_end = 0.0
+    progress = None
+    for message in export:
+        stats["messages"] += 1
+        if message.get("type") != "message":
+            continue
+        sender = message.get("from_id")
+        if not isinstance(sender, str) or not sender.startswith("user"):
+            continue
+        member = members.get(int(sender[4:]))
+        if member is None:
+            continue
+        content = classify(message)
+        if main.is_command(content):
+            continue  # забирают обработчики команд, до handle_message не доходят
+
+        if "date_unixtime" in message:
+            moment = float(message["date_unixtime"])
+        else:
+            # Старые экспорты: локальное время без пояса, считаем его временем группы
+            moment = tz.localize(datetime.fromisoformat(message["date"])).timestamp()
+        if not day_start <= moment < day_end:
+            day = datetime.fromtimestamp(moment, tz).date()
+            day_start = tz.localize(datetime.combine(day, day_time.min)).timestamp()
+            day_end = tz.localize(datetime.combine(day + timedelta(days=1), day_time.min)).timestamp()
+            progress = days.get(day.toordinal())
+            if progress is None:
+                progress = days[day.toordinal()] = ([0] * size, [0] * size)
+        stats["counted"] += 1
+
+        masks, counts = progress
+        counts[member] += 1
+        keys = [content.content_type]
+        if content.text and plan.uses_phrases:
+            keys.extend(matcher.match(content.text))
+        mask = masks[member]
+        for key in keys:
+            for idx, check in index.get(key, ()):
+                if mask >> idx & 1:
+                    continue
+                if check is None or check(tasks[idx], content):
+                    mask |= 1 << idx
+        masks[member] = mask
+    return days
+
+
+def day_result(tasks: Tuple[int, ...], masks: List[int], counts: List[int]) -> Tuple[List[List[bool]], bool]:
+    """Выполнение заданий дня участниками (done[задание][участник]) и засчитан ли день"""
+    import main
+
+    done = []
+    for idx in tasks:
+        task = main.TASKS[idx]
+        if task["type"] == "message_count":
+            done.append([count >= task["count"] for count in counts])
+        else:
+            done.append([bool(mask >> idx & 1) for mask in masks])
+    return done, all(all(row) for row in done)
+
+
+def parse_policy(policy: str):
+    """Задания импортируемого дня: функция (недавние дни) -> набор заданий"""
+    import main
+
+    if policy == "plan":
+        return None
+    if policy.startswith("fixed:"):
+        tasks = tuple(sorted({int(idx) for idx in policy[len("fixed:"):].split(",") if idx.strip()}))
+        if not tasks or any(not 0 <= idx < len(main.TASKS) for idx in tasks):
+            raise ValueError(f"Неверный набор заданий: {policy}")
+        return lambda recent: tasks
+    raise ValueError(f"Неизвестная политика: {policy}")
+
+
+def backfill(state, days: Dict[int, Tuple[List[int], List[int]]], history: HistoryStore,
+             policy: str = "plan", until: Optional[date] = None) -> Tuple[dict, List[DayRecord]]:
+    """Итоги дней с первого сообщения экспорта по until и серия после них
+
+    Дни, уже записанные в истории, берутся из нее; серия считается по всем
+    дням группы подряд. Возвращает (серия как в replay_streaks, новые записи).
+    """
+    import main
+    from planner import TaskPlanner
+
+    chat_id, size = state.chat_id, len(state.members)
+    existing = {day: (success, tasks) for day, success, tasks in history.load_chat(chat_id).chat_days(chat_id)}
+
+    choose = parse_policy(policy)
+    if choose is None:
+        # Свой генератор на группу: при повторном запуске план тот же
+        planner = TaskPlanner(main.TASK_CATEGORIES, main.TASK_WEIGHTS, rng=random.Random(chat_id))
+        choose = planner.next_day
+
+    until = until or datetime.now(state.tz).date() - timedelta(days=1)
+    imported = range(min(days), until.toordinal() + 1) if days else range(0)
+    info = new_streak(chat_id)
+    recent: List[Tuple[int, ...]] = []
+    records = []
+    empty = ([0] * size, [0] * size)
+    for ordinal in sorted(set(existing).union(imported)):
+        day = date.fromordinal(ordinal)
+        if ordinal in existing:
+            success, tasks = existing[ordinal]
+            advance_streak(info, day, success)
+        else:
+            tasks = tuple(choose(recent))
+            masks, counts = days.get(ordinal, empty)
+            done, success = day_result(tasks, masks, counts)
+            status_before = info["status"]
+            advance_streak(info, day, success)
+            records.append(DayRecord(
+                chat_id, day, list(tasks), [m.user_id for m in state.members], done,
+                list(counts), success, status_before, info["status"], info["streak"]
+            ))
+        recent.append(tasks)
+        del recent[:-7]
+    return info, records
+
+
+def run(args):
+    export = ChatExport(args.export)
+    chat_id = args.chat_id or export.chat_id
+    if chat_id is None:
+        raise SystemExit("Не удалось определить chat_id: укажите --chat-id")
+    shards = int(os.environ.get("SHARDS", 0))
+    if shards:
+        # Данные группы лежат в каталоге ее шарда (DATA_DIR/shard-N)
+        os.environ["SHARD_INDEX"] = str(shard_of(chat_id, shards))
+    # Токен не используется: импорт не обращается к Telegram
+    os.environ.setdefault("BOT_TOKEN", "123456:IMPORTimportIMPORTimportIMPORTimport")
+    import main
+
+    state = main.registry.get(chat_id)
+    if state is None:
+        raise SystemExit(f"Группа {chat_id} не описана в GROUP_ID/GROUPS_FILE")
+    if not args.dry_run and not main.store.lock():
+        # Запущенный бот сам дописывает history.bin и журнал
+        raise SystemExit(f"Бот работает с каталогом {main.DATA_DIR}: остановите его перед импортом")
+
+    started = time.perf_counter()
+    stats = {"messages": 0, "counted": 0}
+    try:
+        days = read_days(export, state, stats)
+    finally:
+        export.close()
+    elapsed = time.perf_counter() - started
+    size = os.path.getsize(args.export)
+    print(f"Экспорт {export.header.get('name', chat_id)}: сообщений {stats['messages']}, "
+          f"учтено {stats['counted']}, дней с сообщениями {len(days)} "
+          f"({elapsed:.1f} с, {size / 2 ** 20 / max(elapsed, 1e-9):.0f} МБ/с)")
+
+    until = date.fromisoformat(args.until) if args.until else None
+    info, records = backfill(state, days, main.history, args.policy, until)
+    successes = sum(record.success for record in records)
+    print(f"Новых дней: {len(records)}, засчитано {successes}")
+    start = info["series_start_date"]
+    print(f"Серия {info['streak']} (с {start.isoformat() if start else '-'}), "
+          f"статус {info['status']}, рекорд {info['longest_streak']}, дней в истории {info['days']}")
+    if args.dry_run:
+        return
+
+    main.history.append_many(records)
+    main.history.close()
+    if args.apply:
+        asyncio.run(apply_streak(state, info))
+        print("Серия перенесена в состояние бота")
+
+
+async def apply_streak(state, info: dict):
+    """Серия в состояние бота: журнал и снапшот, с общим хранилищем - и в него"""
+    import main
+
+    main.restore_state(main.registry, main.store)
+    await main.attach_backend()
+    main.apply_streak_info(state, info)
+    # save_state публикует состояние в общее хранилище фоновой задачей
+    while main.background_tasks:
+        await asyncio.gather(*main.background_tasks, return_exceptions=True)
+    main.store.close(main.registry.snapshot)
+    await main.backend.close()
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Импорт истории группы из экспорта Telegram Desktop")
+    parser.add_argument("export", help="result.json экспорта чата")
+    parser.add_argument("--chat-id", type=int, help="chat_id группы (по умолчанию из экспорта)")
+    parser.add_argument("--policy", default="plan", help="задания дней вне истории: plan или fixed:id,id,...")
+    parser.add_argument("--until", help="последний импортируемый день, ГГГГ-ММ-ДД (по умолчанию вчера)")
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать, ничего не записывать")
+    parser.add_argument("--apply", action="store_true", help="перенести серию в состояние бота")
+    args = parser.parse_args()
+    try:
+        run(args)
+    except ValueError as error:
+        raise SystemExit(str(error))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,200 @@
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+def _check(value: int):
+    # В дереве Фенвика значение v - индекс v + 1: при v < 0 обход не закончится
+    if value < 0:
+        raise ValueError(f"Значение рейтинга не может быть отрицательным: {value}")
+
+
+class RankIndex:
+    """Упорядоченный индекс групп по целому значению (серии)
+
+    Число групп с каждым значением хранится в дереве Фенвика, сами группы -
+    в корзинах по значению. Перемещение группы, место ("сколько групп
+    выше") и k-е по величине значение - O(log V), где V - наибольшее
+    значение; топ из n групп - O(n log V). Группы с равным значением
+    делят место.
+    """
+
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self.tree = array("i", bytes(4 * (size + 1)))
+        self.buckets: Dict[int, Dict[int, None]] = {}
+        self.total = 0
+
+    def __len__(self) -> int:
+        return self.total
+
+    def _update(self, value: int, delta: int):
+        i = value + 1
+        tree, size = self.tree, self.size
+        while i <= size:
+            tree[i] += delta
+            i += i & -i
+
+    def _grow(self, value: int):
+        size = self.size
+        while size <= value:
+            size *= 2
+        self.size = size
+        self.tree = array("i", bytes(4 * (size + 1)))
+        for bucket_value, bucket in self.buckets.items():
+            self._update(bucket_value, len(bucket))
+
+    def add(self, key: int, value: int):
+        _check(value)
+        if value >= self.size:
+            self._grow(value)
+        self.buckets.setdefault(value, {})[key] = None
+        self._update(value, 1)
+        self.total += 1
+
+    def remove(self, key: int, value: int):
+        bucket = self.buckets[value]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[value]
+        self._update(value, -1)
+        self.total -= 1
+
+    def move(self, key: int, old: int, new: int):
+        _check(new)
+        if old != new:
+            self.remove(key, old)
+            self.add(key, new)
+
+    def move_many(self, moves: List[Tuple[int, int, int]]):
+        """Пачка перемещений (ключ, старое, новое): дерево обновляется один раз на значение"""
+        for _, _, new in moves:
+            _check(new)
+        deltas: Dict[int, int] = {}
+        buckets = self.buckets
+        for key, old, new in moves:
+            if old == new:
+                continue
+            bucket = buckets[old]
+            del bucket[key]
+            if not bucket:
+                del buckets[old]
+            bucket = buckets.get(new)
+            if bucket is None:
+                bucket = buckets[new] = {}
+            bucket[key] = None
+            deltas[old] = deltas.get(old, 0) - 1
+            deltas[new] = deltas.get(new, 0) + 1
+        top = max(deltas, default=0)
+        if top >= self.size:
+            self._grow(top)  # дерево пересобрано по корзинам
+            return
+        for value, delta in deltas.items():
+            if delta:
+                self._update(value, delta)
+
+    def count_at_most(self, value: int) -> int:
+        i = min(value + 1, self.size)
+        count = 0
+        tree = self.tree
+        while i > 0:
+            count += tree[i]
+            i -= i & -i
+        return count
+
+    def rank(self, value: int) -> int:
+        """Место значения: 1 + число групп со значением больше"""
+        return 1 + self.total - self.count_at_most(value)
+
+    def kth_largest(self, k: int) -> int:
+        """Значение k-й по величине группы (k с 1)"""
+        # Наименьшее v, у которого count_at_most(v) >= total - k + 1
+        target = self.total - k + 1
+        pos = 0
+        step = 1 << self.size.bit_length()
+        tree = self.tree
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and tree[nxt] < target:
+                pos = nxt
+                target -= tree[nxt]
+            step >>= 1
+        return pos  # индекс pos + 1 соответствует значению pos
+
+    def top(self, n: int) -> Iterator[Tuple[int, int]]:
+        """До n групп с наибольшими значениями: (ключ, значение)"""
+        seen = 0
+        while seen < min(n, self.total):
+            value = self.kth_largest(seen + 1)
+            for key in self.buckets[value]:
+                yield key, value
+                seen += 1
+                if seen >= n:
+                    return
+
+
+class Leaderboard:
+    """Рейтинг групп по текущей и рекордной серии
+
+    Обновляется при каждом изменении серии (update), запросы не сортируют
+    группы заново.
+    """
+
+    def __init__(self):
+        self.current = RankIndex()
+        self.best = RankIndex()
+        self._values: Dict[int, Tuple[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def update(self, chat_id: int, streak: int, best: int):
+        _check(streak)
+        _check(best)
+        old = self._values.get(chat_id)
+        if old is None:
+            self.current.add(chat_id, streak)
+            self.best.add(chat_id, best)
+        elif old != (streak, best):
+            self.current.move(chat_id, old[0], streak)
+            self.best.move(chat_id, old[1], best)
+        else:
+            return
+        self._values[chat_id] = (streak, best)
+
+    def update_many(self, items: List[Tuple[int, int, int]]):
+        """Пачка обновлений (chat_id, серия, рекорд) - для массовой смены дня"""
+        for _, streak, record in items:
+            _check(streak)
+            _check(record)
+        current, best, fresh = [], [], []
+        values = self._values
+        for chat_id, streak, record in items:
+            old = values.get(chat_id)
+            if old is None:
+                fresh.append((chat_id, streak, record))
+                continue
+            if old[0] != streak:
+                current.append((chat_id, old[0], streak))
+            if old[1] != record:
+                best.append((chat_id, old[1], record))
+            values[chat_id] = (streak, record)
+        self.current.move_many(current)
+        self.best.move_many(best)
+        for chat_id, streak, record in fresh:
+            self.update(chat_id, streak, record)
+
+    def _index(self, by: str) -> RankIndex:
+        return self.best if by == "best" else self.current
+
+    def top(self, n: int = 10, by: str = "current") -> List[Tuple[int, int]]:
+        """Первые n групп: [(chat_id, серия)]"""
+        return list(self._index(by).top(n))
+
+    def rank(self, chat_id: int, by: str = "current") -> Optional[Tuple[int, int, int]]:
+        """(место, серия, всего групп) или None"""
+        values = self._values.get(chat_id)
+        if values is None:
+            return None
+        value = values[1] if by == "best" else values[0]
+        index = self._index(by)
+        return index.rank(value), value, len(index)
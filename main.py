@@ -1,20 +1,47 @@
 import os
+import gc
+import sys
+import json
+import time
+import socket
+import asyncio
 import random
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Union
-from aiohttp import web
+from functools import lru_cache
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple, Union
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
 
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import Command, CommandObject
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import Message, ChatMemberUpdated, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.enums import ChatMemberStatus
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.enums import ChatMemberStatus, ContentType
 from aiogram.filters import ChatMemberUpdatedFilter, IS_MEMBER, IS_NOT_MEMBER
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
+from aiogram.fsm.storage.base import StorageKey
 import pytz
 
+from backends import create_backend
+from callbacks import CallbackRouter
+from diagnostics import Diagnostics
+from deadlines import DeadlineScheduler
+from dedup import ReplayWindow, RingWindow
+from history import DayRecord, HistoryStore, encode_day
+from leaderboard import Leaderboard
+from metrics import MetricsRegistry
+from phrases import PhraseMatcher
+from planner import DAY_BITS, DAY_MASK, TaskPlanner, pack_day, pack_days, planned_days, pop_day, unpack_day, unpack_days
+from pipeline import ChatPipeline
+from rollover import RolloverBatch
+from sender import SendQueue
+from sessions import SessionStorage
+from shards import ShardRouter, shard_of
+from storage import StateStore
+
 # Настройка логгирования
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", 
@@ -24,23 +51,131 @@ logger = logging.getLogger(__name__)
 
 # Конфигурация
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
-MATTHEW_ID = int(os.environ['MATTHEW_ID'])
-YANA_ID = int(os.environ['YANA_ID'])
-GROUP_ID = int(os.environ['GROUP_ID'])
+REMINDER_HOURS = [10, 14, 18, 22]
 BOT_TOKEN = os.environ['BOT_TOKEN']
+# Пара по умолчанию (необязательна, если группы описаны в GROUPS_FILE)
+MATTHEW_ID = int(os.environ.get('MATTHEW_ID', 0))
+YANA_ID = int(os.environ.get('YANA_ID', 0))
+GROUP_ID = int(os.environ.get('GROUP_ID', 0))
+# JSON-файл со списком групп:
+# [{"chat_id": ..., "admin_id": ..., "timezone": "Europe/Moscow", "reminder_hours": [10, 14, 18, 22],
+#   "members": [{"user_id": ..., "name": ..., "cute_name": ...}]}]
+GROUPS_FILE = os.environ.get('GROUPS_FILE')
+# Каталог со снапшотом и журналом состояния
+DATA_DIR = os.environ.get('DATA_DIR', 'data')
+SNAPSHOT_INTERVAL = int(os.environ.get('SNAPSHOT_INTERVAL', 600))
+# Вебхук: если задан WEBHOOK_URL, апдейты приходят на keep-alive сервер
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+PORT = int(os.environ.get('PORT', 8080))
+# Другой сервер Bot API: локальный telegram-bot-api или fakeapi.py для нагрузочных прогонов
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+# Закреплённое сообщение со статусом, которое правится вместо новых уведомлений
+PINNED_STATUS = os.environ.get('PINNED_STATUS', '0') == '1'
+PINNED_STATUS_INTERVAL = float(os.environ.get('PINNED_STATUS_INTERVAL', 10))
+# Окно (секунды), в котором уведомления о выполнении склеиваются в одно
+NOTICE_COALESCE_WINDOW = float(os.environ.get('NOTICE_COALESCE_WINDOW', 2))
+# Очереди событий чатов: воркеры, лимит очереди чата и общий лимит
+PIPELINE_WORKERS = int(os.environ.get('PIPELINE_WORKERS', 8))
+CHAT_QUEUE_SIZE = int(os.environ.get('CHAT_QUEUE_SIZE', 100))
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 10000))
+# Время жизни сессии админ-панели (секунды) и максимум одновременных сессий
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 900))
+SESSION_LIMIT = int(os.environ.get('SESSION_LIMIT', 1000))
+# Наибольшая серия, которую можно установить вручную (рейтинг держит массив до серии)
+MAX_STREAK = 100000
+# На сколько дней вперед составляется план заданий
+PLAN_DAYS = int(os.environ.get('PLAN_DAYS', 7))
+# Веса заданий при составлении плана, JSON {"id задания": вес}; вес 0 исключает задание
+TASK_WEIGHTS = {int(k): float(v) for k, v in json.loads(os.environ.get('TASK_WEIGHTS', '{}')).items()}
+# Обработать апдейты, накопившиеся за время перезапуска, вместо их сброса
+CATCH_UP = os.environ.get('CATCH_UP', '1') == '1'
+CATCH_UP_BATCH = 100  # максимум апдейтов в одном getUpdates
+# Диагностика зависаний (задержка event loop, медленные апдейты, профили
+# на /debug/diagnostics и /debug/profile); DIAGNOSTICS_TOKEN - ?token= для доступа
+DIAGNOSTICS = os.environ.get('DIAGNOSTICS', '0') == '1'
+DIAGNOSTICS_TOKEN = os.environ.get('DIAGNOSTICS_TOKEN')
+SLOW_UPDATE_MS = float(os.environ.get('SLOW_UPDATE_MS', 200))
+SLOW_UPDATES_KEEP = int(os.environ.get('SLOW_UPDATES_KEEP', 20))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))  # 0 - без профилирования
+# Массовая смена дня: от скольких групп сразу, и сколько поздравлений
+# держать в очереди отправки (остальные подаются по мере отправки)
+BULK_ROLLOVER_MIN = int(os.environ.get('BULK_ROLLOVER_MIN', 50))
+ANNOUNCE_BACKLOG = int(os.environ.get('ANNOUNCE_BACKLOG', 1000))
+# Пересчитать серии групп по истории дней при запуске (после исправления правил)
+RECOMPUTE_STREAKS = os.environ.get('RECOMPUTE_STREAKS', '0') == '1'
+# Общее хранилище для нескольких реплик: memory:// (одна реплика) или tcp://host:port
+STATE_BACKEND = os.environ.get('STATE_BACKEND')
+REPLICA_ID = os.environ.get('REPLICA_ID', f"{socket.gethostname()}:{os.getpid()}")
+PROGRESS_TTL = 3 * 24 * 3600  # время жизни прогресса дня в хранилище
+ROLLOVER_LOCK_TTL = 120
+ROLLOVER_RETRY_MAX = 300  # наибольшая пауза перед повтором неудавшейся смены дня, с
+# JSON-файл с дополнительными фразами: {"morning": [...], "evening": [...]}
+PHRASES_FILE = os.environ.get('PHRASES_FILE')
+# Отсев повторно доставленных апдейтов: окно по update_id и по message_id в каждой группе
+UPDATE_WINDOW = int(os.environ.get('UPDATE_WINDOW', 4096))
+MESSAGE_WINDOW = int(os.environ.get('MESSAGE_WINDOW', 64))
+# Несколько процессов: SHARDS воркеров, у каждого свои группы (по chat_id),
+# состояние в DATA_DIR/shard-N и очередь отправки; основной процесс только
+# принимает апдейты. SHARD_INDEX воркерам задается автоматически.
+SHARDS = int(os.environ.get('SHARDS', 0))
+SHARD_INDEX = int(os.environ['SHARD_INDEX']) if 'SHARD_INDEX' in os.environ else None
+if SHARD_INDEX is not None:
+    DATA_DIR = os.path.join(DATA_DIR, f"shard-{SHARD_INDEX}")
+    PORT += 1 + SHARD_INDEX  # keep-alive и метрики воркера
 
 # Keep-alive сервер
 async def handle(request):
     return web.Response(text="Bot is alive")
 
-async def keep_alive():
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+def diagnostics_allowed(request) -> bool:
+    return not DIAGNOSTICS_TOKEN or request.query.get("token") == DIAGNOSTICS_TOKEN
+
+async def handle_diagnostics(request):
+    if not diagnostics_allowed(request):
+        raise web.HTTPForbidden()
+    return web.json_response(diagnostics.report())
+
+async def handle_profile(request):
+    """Профиль медленных апдейтов (folded stacks) для flamegraph.pl или speedscope"""
+    if not diagnostics_allowed(request):
+        raise web.HTTPForbidden()
+    update_id = request.query.get("update_id") or None
+    if update_id is not None:
+        try:
+            update_id = int(update_id)
+        except ValueError:
+            raise web.HTTPBadRequest(text="update_id должен быть целым числом")
+    return web.Response(
+        text=diagnostics.folded(update_id),
+        content_type="text/plain", charset="utf-8",
+        headers={"Content-Disposition": "attachment; filename=ogonek-profile.folded"}
+    )
+
+async def keep_alive(webhook=None) -> web.AppRunner:
     app = web.Application()
     app.router.add_get('/', handle)
+    app.router.add_get('/metrics', handle_metrics)
+    if DIAGNOSTICS:
+        app.router.add_get('/debug/diagnostics', handle_diagnostics)
+        app.router.add_get('/debug/profile', handle_profile)
+    if webhook is not None:
+        app.router.add_post(WEBHOOK_PATH, webhook)
+    elif WEBHOOK_URL:
+        # Диспетчер на том же приложении; чужие запросы отсекаются по
+        # заголовку X-Telegram-Bot-Api-Secret-Token
+        SimpleRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', 8080)
+    site = web.TCPSite(runner, '0.0.0.0', PORT)
     await site.start()
     print("Keep-alive server started")
+    return runner
 
 # ... (остальной код FireState и обработчики остаются без изменений) ...
 
@@ -64,46 +199,380 @@ TASKS = [
     {"id": 15, "type": "evening", "desc": "пожелать спокойной ночи"},
 ]
 
+# Категории заданий (меню выбора и баланс плана)
+TASK_CATEGORIES = [
+    ("Сообщения", [0, 1, 2, 3, 4, 10, 11]),
+    ("Медиа", [5, 6, 7, 8, 9, 12, 13]),
+    ("Пожелания", [14, 15]),
+]
+planner = TaskPlanner(TASK_CATEGORIES, TASK_WEIGHTS)
+# Рейтинг групп по сериям, обновляется при каждом изменении серии
+leaderboard = Leaderboard()
+
+# Проверки заданий по содержимому сообщения
+def check_long_text(task: dict, message: Message) -> bool:
+    return len(message.text) >= task["min_len"]
+
+# Словари пожеланий: категория совпадает с типом задания
+GREETING_PHRASES = {
+    "morning": ["доброго утра", "доброе утро", "доброе утречко", "доброго утречка"],
+    "evening": ["спокойной ночи", "спок", "спокойной ночки", "сладких снов"],
+}
+
+def load_phrase_matcher() -> PhraseMatcher:
+    """Сборка автомата фраз из встроенных словарей и PHRASES_FILE"""
+    lexicons = {category: list(phrases) for category, phrases in GREETING_PHRASES.items()}
+    if PHRASES_FILE:
+        with open(PHRASES_FILE, encoding="utf-8") as f:
+            for category, phrases in json.load(f).items():
+                lexicons.setdefault(category, []).extend(phrases)
+    return PhraseMatcher(lexicons)
+
+phrase_matcher = load_phrase_matcher()
+
+# Тип задания -> (ключи индекса, дополнительная проверка).
+# Ключ - тип содержимого сообщения или категория фраз из phrase_matcher
+TASK_EVALUATORS = {
+    "voice": ((ContentType.VOICE,), None),
+    "video_note": ((ContentType.VIDEO_NOTE,), None),
+    "location": ((ContentType.LOCATION, ContentType.VENUE), None),
+    "video": ((ContentType.VIDEO,), None),
+    "photo": ((ContentType.PHOTO,), None),
+    "long_text": ((ContentType.TEXT,), check_long_text),
+    "sticker": ((ContentType.STICKER,), None),
+    "gif": ((ContentType.ANIMATION,), None),
+    "morning": (("morning",), None),
+    "evening": (("evening",), None),
+}
+
+# Участники пары
+class Member:
+    __slots__ = ("user_id", "key", "name", "cute_name")
+
+    def __init__(self, user_id: int, key: str, name: str, cute_name: str):
+        self.user_id = user_id
+        self.key = key  # ключ участника в журнале и снапшоте
+        self.name = name
+        self.cute_name = cute_name
+
+# Ширина счетчика сообщений в упакованном FireState.counters
+COUNTER_BITS = 32
+COUNTER_MASK = (1 << COUNTER_BITS) - 1
+
+class TaskPlan:
+    """Неизменяемые данные набора заданий дня, общие для всех групп с ним
+
+    Прогресс группы хранится в двух целых числах: completed - битовая маска,
+    counters - упакованный массив счетчиков по COUNTER_BITS бит. Ячейка
+    (слот задания, слот участника) имеет номер slot * members + member.
+    """
+    __slots__ = ("tasks", "members", "index", "uses_phrases",
+                 "count_slots", "count_cells", "flag_mask", "count_increments",
+                 "count_low", "count_guard", "count_floor")
+
+    def __init__(self, tasks: tuple, members: int):
+        self.tasks = tasks
+        self.members = members
+
+        # Тип содержимого -> [(слот задания, проверка)]
+        self.index: Dict[str, List[tuple]] = {}
+        self.count_slots: List[int] = []
+        self.flag_mask = 0
+        for slot, idx in enumerate(tasks):
+            task = TASKS[idx]
+            if task["type"] == "message_count":
+                self.count_slots.append(slot)
+            else:
+                for member in range(members):
+                    self.flag_mask |= 1 << (slot * members + member)
+
+            if task["type"] not in TASK_EVALUATORS:
+                continue
+            content_types, check = TASK_EVALUATORS[task["type"]]
+            for content_type in content_types:
+                self.index.setdefault(content_type, []).append((slot, check))
+
+        self.uses_phrases = any(
+            category in self.index for category in phrase_matcher.categories
+        )
+        # Одно сложение увеличивает все счетчики сообщений участника
+        self.count_increments = [
+            sum(1 << ((slot * members + member) * COUNTER_BITS) for slot in self.count_slots)
+            for member in range(members)
+        ]
+        # Проверка всех счетчиков сразу (SWAR): к полю без старшего бита
+        # добавляется старший бит и вычитается норма - бит остается, только
+        # если счетчик не меньше нормы; заимствование между полями невозможно
+        self.count_low = self.count_guard = self.count_floor = 0
+        self.count_cells = [slot * members + member for slot in self.count_slots for member in range(members)]
+        for slot in self.count_slots:
+            required = TASKS[tasks[slot]]["count"]
+            for member in range(members):
+                shift = (slot * members + member) * COUNTER_BITS
+                self.count_low |= (COUNTER_MASK >> 1) << shift
+                self.count_guard |= 1 << (shift + COUNTER_BITS - 1)
+                self.count_floor |= required << shift
+
+    def counts_met(self, counters: int) -> bool:
+        """Все счетчики сообщений достигли нормы"""
+        guard = self.count_guard
+        return ((counters & self.count_low | guard) - self.count_floor) & guard == guard
+
+    def done_bits(self, completed: int, counters: int) -> int:
+        """Выполнение всех ячеек одной маской (бит ячейки slot * members + member)"""
+        bits = completed & self.flag_mask
+        if self.count_cells:
+            guard = self.count_guard
+            met = ((counters & self.count_low | guard) - self.count_floor) & guard
+            for cell in self.count_cells:
+                if met >> (cell * COUNTER_BITS + COUNTER_BITS - 1) & 1:
+                    bits |= 1 << cell
+        return bits
+
+    def slots_of(self, task_idx: int) -> List[int]:
+        return [slot for slot, idx in enumerate(self.tasks) if idx == task_idx]
+
+_task_plans: Dict[tuple, TaskPlan] = {}
+
+_packed_plans: Dict[tuple, TaskPlan] = {}  # (planner.pack_day, участников) -> план
+
+def get_task_plan(tasks: tuple, members: int) -> TaskPlan:
+    plan = _task_plans.get((tasks, members))
+    if plan is None:
+        plan = TaskPlan(tasks, members)
+        _task_plans[(tasks, members)] = plan
+    return plan
+
+def get_packed_plan(day: int, members: int) -> TaskPlan:
+    plan = _packed_plans.get((day, members))
+    if plan is None:
+        plan = _packed_plans[(day, members)] = get_task_plan(unpack_day(day), members)
+    return plan
+
 # Состояние бота
 class FireState:
-    def __init__(self):
+    __slots__ = (
+        "chat_id", "admin_id", "members", "tz", "reminder_hours",
+        "streak", "best_streak", "status", "consecutive_misses", "last_message_id", "series_start_date", "current_date",
+        "plan", "schedule", "completed", "counters", "epoch", "version",
+        "status_message_id", "status_dirty", "_status_text",
+    )
+
+    def __init__(self, chat_id: int, members: List[Member], admin_id: int,
+                 tz=MOSCOW_TZ, reminder_hours: Optional[List[int]] = None):
+        self.chat_id = chat_id
+        self.admin_id = admin_id
+        self.members = members
+        self.tz = tz
+        self.reminder_hours = sorted(reminder_hours) if reminder_hours else REMINDER_HOURS
         self.streak = 0
+        self.best_streak = 0  # рекордная серия
         self.status = "alive"  # alive, frozen, dead
         self.consecutive_misses = 0
+        self.last_message_id = 0  # последнее учтенное сообщение (граница повторов после перезапуска)
         self.series_start_date: Optional[datetime] = None
-        self.current_date: datetime = datetime.now(MOSCOW_TZ).date()
-        self.task_indices: List[int] = []
-        self.tomorrow_tasks: List[int] = []
-        self.completed_tasks: Dict[int, Dict[str, bool]] = {}
-        self.message_counters: Dict[int, Dict[str, int]] = {}
+        self.current_date: date = datetime.now(tz).date()
+        self.schedule = 0  # план на следующие дни (planner.pack_days)
+        self.completed = 0  # битовая маска выполненных заданий
+        self.counters = 0  # упакованные счетчики сообщений
+        # Номер набора заданий (пространство ключей прогресса в хранилище)
+        # и версия состояния, опубликованного в хранилище
+        self.epoch = 0
+        self.version = 0
+        # Закреплённое сообщение со статусом (режим PINNED_STATUS)
+        self.status_message_id: Optional[int] = None
+        # Кэш отрисованного статуса, сбрасывается при изменении состояния
+        self.status_dirty = True
+        self._status_text = ""
         self.initialize_new_day()
-        
-    def initialize_new_day(self):
+
+    @property
+    def task_indices(self) -> tuple:
+        return self.plan.tasks
+
+    @property
+    def tomorrow_tasks(self) -> tuple:
+        return self.planned_days()[0] if self.schedule else ()
+
+    def planned_days(self) -> List[tuple]:
+        return unpack_days(self.schedule)
+
+    def set_planned_day(self, offset: int, tasks: List[int]):
+        """Задания на день offset после сегодняшнего (0 - завтра)"""
+        if planned_days(self.schedule) <= offset:
+            self.schedule = planner.extend(self.schedule, self.plan.tasks, offset + 1)
+        days = self.planned_days()
+        days[offset] = tuple(tasks)
+        self.schedule = pack_days(days)
+
+    def replan(self):
+        self.schedule = planner.extend(0, self.plan.tasks, PLAN_DAYS)
+
+    def refill_schedule(self, force: bool = False):
+        """Дополнение плана пачкой, когда от него остается половина"""
+        if force or planned_days(self.schedule) <= PLAN_DAYS // 2:
+            self.schedule = planner.extend(self.schedule, self.plan.tasks, PLAN_DAYS)
+
+    def initialize_new_day(self, task_indices: Optional[List[int]] = None):
         """Инициализация нового дня с заданиями"""
-        if self.tomorrow_tasks:
-            self.task_indices = self.tomorrow_tasks
-            self.tomorrow_tasks = []
+        if task_indices:
+            tasks = task_indices
+        elif self.schedule:
+            tasks, self.schedule = pop_day(self.schedule)
         else:
-            self.task_indices = random.sample(range(len(TASKS)), 3)
-        
-        self.completed_tasks = {}
-        self.message_counters = {}
-        
-        for idx in self.task_indices:
-            task = TASKS[idx]
-            self.completed_tasks[idx] = {"matthew": False, "yana": False}
-            
-            if task["type"] == "message_count":
-                self.message_counters[idx] = {"matthew": 0, "yana": 0}
-    
-    def update_status(self, yesterday_success: bool):
-        """Обновление статуса огонька"""
+            tasks = planner.pooled_day()
+
+        self.plan = get_task_plan(tuple(tasks), len(self.members))
+        self.completed = 0
+        self.counters = 0
+        self.epoch += 1
+        self.status_dirty = True
+
+    def member_slot(self, user_id: int) -> Optional[int]:
+        for slot, member in enumerate(self.members):
+            if member.user_id == user_id:
+                return slot
+        return None
+
+    def get_member(self, user_id: int) -> Optional[Member]:
+        slot = self.member_slot(user_id)
+        return self.members[slot] if slot is not None else None
+
+    def cute_names(self) -> str:
+        return " и ".join(m.cute_name for m in self.members)
+
+    def is_done(self, slot: int, member: int) -> bool:
+        return bool(self.completed >> (slot * len(self.members) + member) & 1)
+
+    def get_count(self, slot: int, member: int) -> int:
+        return self.counters >> ((slot * len(self.members) + member) * COUNTER_BITS) & COUNTER_MASK
+
+    def member_count(self, member: int) -> int:
+        """Сообщений участника за день (одинаково во всех заданиях-счетчиках)"""
+        if not self.plan.count_slots:
+            return 0
+        return self.get_count(self.plan.count_slots[0], member)
+
+    def set_member_count(self, member: int, count: int):
+        increment = self.plan.count_increments[member]
+        self.counters = (self.counters & ~(increment * COUNTER_MASK)) | increment * min(count, COUNTER_MASK)
+
+    def mark_done(self, task_idx: int, member: int):
+        n = len(self.members)
+        for slot in self.plan.slots_of(task_idx):
+            self.completed |= 1 << (slot * n + member)
+
+    def to_dict(self) -> dict:
+        """Изменяемая часть состояния для снапшота"""
+        completed_tasks = {}
+        message_counters = {}
+        members = range(len(self.members))
+        for slot, idx in enumerate(self.plan.tasks):
+            if slot in self.plan.count_slots:
+                message_counters[str(idx)] = [self.get_count(slot, m) for m in members]
+            completed_tasks[str(idx)] = [self.is_done(slot, m) for m in members]
+
+        return {
+            "streak": self.streak,
+            "best_streak": self.best_streak,
+            "status": self.status,
+            "consecutive_misses": self.consecutive_misses,
+            "series_start_date": self.series_start_date.isoformat() if self.series_start_date else None,
+            "current_date": self.current_date.isoformat(),
+            "task_indices": list(self.plan.tasks),
+            "tomorrow_tasks": list(self.tomorrow_tasks),
+            "schedule": [list(day) for day in self.planned_days()],
+            "completed_tasks": completed_tasks,
+            "message_counters": message_counters,
+            "status_message_id": self.status_message_id,
+            "epoch": self.epoch,
+            "last_message_id": self.last_message_id,
+        }
+
+    def load_dict(self, data: dict):
+        """Восстановление состояния из снапшота"""
+        self.streak = data["streak"]
+        self.best_streak = max(data.get("best_streak", 0), self.streak)
+        self.status = data["status"]
+        self.consecutive_misses = data["consecutive_misses"]
+        series_start = data["series_start_date"]
+        self.series_start_date = datetime.fromisoformat(series_start) if series_start else None
+        self.current_date = date.fromisoformat(data["current_date"])
+        self.plan = get_task_plan(tuple(data["task_indices"]), len(self.members))
+        if "schedule" in data:
+            self.schedule = pack_days(data["schedule"])
+        else:
+            self.schedule = pack_day(data["tomorrow_tasks"]) if data["tomorrow_tasks"] else 0
+        self.completed = 0
+        self.counters = 0
+        n = len(self.members)
+        for slot, idx in enumerate(self.plan.tasks):
+            for member, done in enumerate(data["completed_tasks"].get(str(idx), ())):
+                if done:
+                    self.completed |= 1 << (slot * n + member)
+            for member, count in enumerate(data["message_counters"].get(str(idx), ())):
+                self.counters |= min(count, COUNTER_MASK) << ((slot * n + member) * COUNTER_BITS)
+        self.status_message_id = data.get("status_message_id")
+        self.epoch = data.get("epoch", 0)
+        self.last_message_id = data.get("last_message_id", 0)
+        self.status_dirty = True
+
+    def apply(self, op: dict):
+        """Применение записи журнала"""
+        if op["op"] == "message":
+            member = next((i for i, m in enumerate(self.members) if m.key == op["user"]), None)
+            if member is None:
+                return
+            self.counters += self.plan.count_increments[member]
+            self.last_message_id = max(self.last_message_id, op.get("message_id", 0))
+            for idx in op["done"]:
+                self.mark_done(idx, member)
+            if self.plan.count_slots or op["done"]:
+                self.status_dirty = True
+        elif op["op"] == "progress":
+            # Абсолютные значения из общего хранилища
+            member = next((i for i, m in enumerate(self.members) if m.key == op["user"]), None)
+            if member is None:
+                return
+            if op.get("count") is not None:
+                self.set_member_count(member, op["count"])
+            for idx in op["done"]:
+                self.mark_done(idx, member)
+            self.status_dirty = True
+        elif op["op"] == "state":
+            self.load_dict(op["data"])
+            self.update_rank()
+        elif op["op"] == "schedule":
+            self.schedule = op["schedule"]
+
+    def update_rank(self):
+        """Рекорд и место группы в рейтинге по текущей серии"""
+        self.best_streak = max(self.best_streak, self.streak)
+        leaderboard.update(self.chat_id, self.streak, self.best_streak)
+
+    def set_streak(self, streak: int):
+        """Ручная установка серии из админ-панели"""
+        self.streak = streak
+        self.series_start_date = datetime.now(self.tz) - timedelta(days=streak)
+        self.status = "alive"
+        self.consecutive_misses = 0
+        self.status_dirty = True
+        self.update_rank()
+
+    def update_status(self, yesterday_success: bool, series_start: Optional[datetime] = None,
+                      rank: bool = True):
+        """Обновление статуса огонька
+
+        rank=False - без обновления рейтинга: массовая смена дня обновляет
+        его одной пачкой (Leaderboard.update_many).
+        """
+        self.status_dirty = True
         if yesterday_success:
             self.consecutive_misses = 0
             self.status = "alive"
             self.streak += 1
             if self.streak == 1:
-                self.series_start_date = datetime.now(MOSCOW_TZ) - timedelta(days=1)
+                self.series_start_date = series_start or datetime.now(self.tz) - timedelta(days=1)
         else:
             self.consecutive_misses += 1
             if self.consecutive_misses >= 3:
@@ -112,399 +581,1302 @@ class FireState:
                 self.series_start_date = None
             else:
                 self.status = "frozen"
-    
+        if rank:
+            self.update_rank()
+        else:
+            self.best_streak = max(self.best_streak, self.streak)
+
+    def start_day(self, today: date, success: bool, day: int, series_start: datetime):
+        """Переход на новый день с заданиями day (planner.pack_day) без лишних объектов
+
+        Используется массовой сменой дня и при ее повторе из журнала; план
+        сдвигается на день, если в нем что-то было.
+        """
+        self.update_status(success, series_start, rank=False)
+        if self.schedule:
+            self.schedule >>= DAY_BITS
+        self.plan = get_packed_plan(day, len(self.members))
+        self.current_date = today
+        self.completed = 0
+        self.counters = 0
+        self.epoch += 1
+
+    def day_record(self, success: bool, status_before: str) -> DayRecord:
+        """Итог текущего дня для истории (после update_status)"""
+        return make_day_record(self, self.current_date, self.plan, self.completed, self.counters,
+                               success, status_before)
+
     def check_daily_completion(self) -> bool:
         """Проверка выполнения всех заданий"""
-        for task_idx in self.task_indices:
-            task = TASKS[task_idx]
-            
-            for user in ["matthew", "yana"]:
-                if task["type"] == "message_count":
-                    if self.message_counters[task_idx][user] < task["count"]:
-                        return False
-                elif not self.completed_tasks[task_idx][user]:
-                    return False
-        return True
-    
+        plan = self.plan
+        return self.completed & plan.flag_mask == plan.flag_mask and plan.counts_met(self.counters)
+
     def get_status_emoji(self) -> str:
         return {
             "alive": "🔥",
             "frozen": "🧊",
             "dead": "😭"
         }[self.status]
-    
+
+    def format_task_statuses(self, slot: int) -> str:
+        """Прогресс участников по одному заданию дня"""
+        task = TASKS[self.plan.tasks[slot]]
+        statuses = []
+
+        for member_slot, member in enumerate(self.members):
+            if task["type"] == "message_count":
+                count = self.get_count(slot, member_slot)
+                required = task["count"]
+                status = f"{count}/{required}"
+                if count >= required:
+                    status = f"✅ {status}"
+            else:
+                status = "✅" if self.is_done(slot, member_slot) else "❌"
+
+            statuses.append(f"{member.name}: {status}")
+
+        return ", ".join(statuses)
+
     def format_tasks(self) -> str:
         """Форматирование списка заданий"""
         result = []
-        for i, task_idx in enumerate(self.task_indices):
-            task = TASKS[task_idx]
-            statuses = []
-            
-            for user in ["matthew", "yana"]:
-                if task["type"] == "message_count":
-                    count = self.message_counters[task_idx][user]
-                    required = task["count"]
-                    status = f"{count}/{required}"
-                    if count >= required:
-                        status = f"✅ {status}"
-                else:
-                    status = "✅" if self.completed_tasks[task_idx][user] else "❌"
-                
-                statuses.append(status)
-            
+        for slot, task_idx in enumerate(self.plan.tasks):
             result.append(
-                f"{i+1}. {task['desc']} - "
-                f"Матвей: {statuses[0]}, Яна: {statuses[1]}"
+                f"{slot+1}. {TASKS[task_idx]['desc']} - "
+                + self.format_task_statuses(slot)
             )
-        
+
         return "\n".join(result)
-    
+
     def get_status_message(self) -> str:
+        """Сообщение о статусе (перерисовывается только после изменений)"""
+        if self.status_dirty:
+            with diagnostics.stage("render"):
+                self._status_text = self.render_status_message()
+            self.status_dirty = False
+        return self._status_text
+
+    def render_status_message(self) -> str:
         """Формирование сообщения о статусе"""
         emoji = self.get_status_emoji()
         message = f"<b>{emoji} Статус Огонька:</b>\n\n"
-        
+
         if self.status != "dead":
             message += f"🔥 Серия: {self.streak} дней\n"
             if self.series_start_date:
                 start_date = self.series_start_date.strftime("%d.%m.%Y")
                 message += f"📅 Дата начала: {start_date}\n"
-        
+
         message += "\n<b>🎯 Задания на сегодня:</b>\n"
         message += self.format_tasks()
-        
+
         return message
 
+def make_day_record(state: FireState, day: date, plan: TaskPlan, completed: int, counters: int,
+                    success: bool, status_before: str) -> DayRecord:
+    """Итог дня по сохраненному прогрессу (статус и серия - текущие)"""
+    n = len(state.members)
+    members = range(n)
+    done = []
+    for slot, idx in enumerate(plan.tasks):
+        task = TASKS[idx]
+        if task["type"] == "message_count":
+            done.append([
+                (counters >> ((slot * n + m) * COUNTER_BITS) & COUNTER_MASK) >= task["count"]
+                for m in members
+            ])
+        else:
+            done.append([bool(completed >> (slot * n + m) & 1) for m in members])
+    first = plan.count_slots[0] if plan.count_slots else None
+    counts = [
+        counters >> ((first * n + m) * COUNTER_BITS) & COUNTER_MASK if first is not None else 0
+        for m in members
+    ]
+    return DayRecord(
+        state.chat_id, day, list(plan.tasks), [m.user_id for m in state.members], done,
+        counts, success, status_before, state.status, state.streak
+    )
+
+def encode_day_record(state: FireState, day: date, plan: TaskPlan, completed: int, counters: int,
+                      success: bool, status_before: str) -> bytes:
+    """То же, что make_day_record(...).encode(), без промежуточных списков (массовая смена дня)"""
+    n = plan.members
+    first = plan.count_slots[0] if plan.count_slots else None
+    counts = [
+        counters >> ((first * n + m) * COUNTER_BITS) & COUNTER_MASK if first is not None else 0
+        for m in range(n)
+    ]
+    return encode_day(
+        state.chat_id, day.toordinal(), plan.tasks, [m.user_id for m in state.members],
+        plan.done_bits(completed, counters), counts, success, status_before, state.status, state.streak
+    )
+
+# Реестр групп
+class GroupRegistry:
+    """Состояния всех групп с поиском по chat_id за O(1)"""
+    def __init__(self):
+        self.groups: Dict[int, FireState] = {}
+        self.admins: Dict[int, List[int]] = {}  # admin_id -> [chat_id, ...]
+
+    def register(self, state: FireState):
+        self.groups[state.chat_id] = state
+        chat_ids = self.admins.setdefault(state.admin_id, [])
+        if state.chat_id not in chat_ids:
+            chat_ids.append(state.chat_id)
+
+    def get(self, chat_id: int) -> Optional[FireState]:
+        return self.groups.get(chat_id)
+
+    def admin_groups(self, user_id: int) -> List[int]:
+        return self.admins.get(user_id, [])
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self.groups
+
+    def __iter__(self):
+        return iter(list(self.groups.values()))
+
+    def __len__(self) -> int:
+        return len(self.groups)
+
+    def snapshot(self) -> Dict[int, dict]:
+        return {chat_id: state.to_dict() for chat_id, state in self.groups.items()}
+
+def group_configs() -> List[dict]:
+    """Описания групп из переменных окружения и GROUPS_FILE"""
+    groups = []
+    if GROUP_ID and MATTHEW_ID and YANA_ID:
+        groups.append({
+            "chat_id": GROUP_ID,
+            "admin_id": MATTHEW_ID,
+            "members": [
+                {"user_id": MATTHEW_ID, "key": "matthew", "name": "Матвей", "cute_name": "Матвейчик"},
+                {"user_id": YANA_ID, "key": "yana", "name": "Яна", "cute_name": "Янчик"},
+            ],
+        })
+
+    if GROUPS_FILE:
+        with open(GROUPS_FILE, encoding="utf-8") as f:
+            groups.extend(json.load(f))
+    return groups
+
+def in_shard(chat_id: int) -> bool:
+    """Обрабатывается ли группа этим процессом"""
+    return not SHARDS or SHARD_INDEX is not None and shard_of(chat_id, SHARDS) == SHARD_INDEX
+
+def load_groups(registry: GroupRegistry):
+    """Загрузка групп из переменных окружения и GROUPS_FILE (только своего шарда)"""
+    for group in group_configs():
+        chat_id = int(group["chat_id"])
+        if not in_shard(chat_id):
+            continue
+        members = [
+            Member(
+                int(m["user_id"]),
+                m.get("key", str(m["user_id"])),
+                m["name"],
+                m.get("cute_name", m["name"])
+            )
+            for m in group["members"]
+        ]
+        admin_id = int(group.get("admin_id", members[0].user_id))
+        registry.register(FireState(
+            chat_id,
+            members,
+            admin_id,
+            tz=pytz.timezone(group.get("timezone", MOSCOW_TZ.zone)),
+            reminder_hours=group.get("reminder_hours")
+        ))
+
+    logger.info(f"Загружено групп: {len(registry)}")
+
+def restore_state(registry: GroupRegistry, store: StateStore):
+    """Восстановление состояния групп: снапшот + хвост журнала"""
+    started = datetime.now()
+    groups, tail = store.load()
+
+    restored = set()
+    for chat_id, data in groups.items():
+        state = registry.get(chat_id)
+        if state is not None:
+            state.load_dict(data)
+            restored.add(chat_id)
+
+    for chat_id, op in tail:
+        if op["op"] == "rollover":
+            replay_rollover(registry, op)
+            continue
+        state = registry.get(chat_id)
+        if state is not None:
+            state.apply(op)
+            if op["op"] == "state":
+                restored.add(chat_id)
+
+    # Задания новой группы выбраны случайно: без записи в журнал после
+    # перезапуска до снапшота ее прогресс лег бы на другие задания
+    for state in registry:
+        if state.chat_id not in restored:
+            save_state(state, publish=False)
+    replay_floor.update((state.chat_id, state.last_message_id) for state in registry)
+    leaderboard.update_many([(state.chat_id, state.streak, state.best_streak) for state in registry])
+
+    elapsed = (datetime.now() - started).total_seconds() * 1000
+    logger.info(
+        f"Состояние восстановлено за {elapsed:.0f} мс "
+        f"(групп в снапшоте: {len(groups)}, записей журнала: {len(tail)})"
+    )
+
+def required_messages(task_idx: int) -> Optional[int]:
+    task = TASKS[task_idx]
+    return task["count"] if task["type"] == "message_count" else None
+
+def apply_streak_info(state: FireState, info: dict):
+    """Серия группы из повтора истории (History.replay_streaks)"""
+    state.streak = info["streak"]
+    state.best_streak = info["longest_streak"]
+    state.status = info["status"]
+    state.consecutive_misses = info["consecutive_misses"]
+    start = info["series_start_date"]
+    state.series_start_date = state.tz.localize(datetime.combine(start, datetime.min.time())) if start else None
+    state.status_dirty = True
+    state.update_rank()
+    save_state(state)
+
+def recompute_streaks(registry: GroupRegistry, history: HistoryStore):
+    """Пересчет серий всех групп по истории дней без повторной обработки сообщений
+
+    Засчитанность дней определяется заново по прогрессу участников, серия
+    считается с первого записанного дня (ручные установки серии не учитываются).
+    """
+    days = history.load()
+    days.recompute_successes(required_messages)
+    replayed = days.replay_streaks()
+    for chat_id, info in replayed.items():
+        state = registry.get(chat_id)
+        if state is not None:
+            apply_streak_info(state, info)
+    logger.info(f"Серии пересчитаны по истории: групп {len(replayed)}, дней {len(days)}")
+
 # Глобальное состояние
-fire_state = FireState()
-bot = Bot(token=BOT_TOKEN)
+registry = GroupRegistry()
+load_groups(registry)
+store = StateStore(DATA_DIR, snapshot_interval=SNAPSHOT_INTERVAL)
+backend = create_backend(STATE_BACKEND)
+history = HistoryStore(DATA_DIR)
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
+# Лимит Telegram на бота делится между воркерами-шардами
+send_queue = SendQueue(bot, global_rate=30 / max(SHARDS, 1), coalesce_window=NOTICE_COALESCE_WINDOW, observer=lambda *args: observe_request(*args))
 dp = Dispatcher()
-scheduler = AsyncIOScheduler(timezone=MOSCOW_TZ)
-user_state = {}  # Для хранения состояния админ-меню
+admin_callbacks = CallbackRouter()  # Кнопки админ-панели
+pipeline = ChatPipeline(PIPELINE_WORKERS, CHAT_QUEUE_SIZE, PIPELINE_QUEUE_SIZE)
 
-# Вспомогательные функции
-def get_user_type(user_id: int) -> Optional[str]:
-    if user_id == MATTHEW_ID:
-        return "matthew"
-    elif user_id == YANA_ID:
-        return "yana"
-    return None
+# Метрики (/metrics на keep-alive сервере)
+metrics = MetricsRegistry()
+UPDATES = metrics.counter("ogonek_updates_total", "Полученные апдейты", ["type"])
+DUPLICATES = metrics.counter(
+    "ogonek_duplicate_updates_total", "Отброшенные повторы апдейтов по проверке", ["check"]
+)
+HANDLER_SECONDS = metrics.histogram("ogonek_handler_seconds", "Время работы обработчиков", ["handler"])
+TELEGRAM_SECONDS = metrics.histogram(
+    "ogonek_telegram_request_seconds", "Время исходящих запросов к Telegram", ["method"]
+)
+TELEGRAM_REQUESTS = metrics.counter(
+    "ogonek_telegram_requests_total", "Исходящие запросы к Telegram по результату", ["method", "result"]
+)
+SCHEDULER_LAG = metrics.histogram(
+    "ogonek_scheduler_lag_seconds", "Опоздание запуска задач относительно срока", ["job"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 3600)
+)
+metrics.gauge("ogonek_groups", "Группы по состоянию огонька", lambda: group_counts(), ["status"])
+metrics.gauge("ogonek_scheduled_jobs", "Запланированные смены дня и напоминания", lambda: len(deadlines))
+metrics.gauge("ogonek_pipeline_pending", "События в очередях чатов", lambda: pipeline.pending)
+metrics.gauge("ogonek_send_queue_pending", "Сообщения в очереди отправки", lambda: send_queue.pending)
+metrics.gauge("ogonek_asyncio_tasks", "Задачи asyncio", lambda: len(asyncio.all_tasks()))
+LOOP_LAG = metrics.histogram(
+    "ogonek_event_loop_lag_seconds", "Задержка event loop (при включенной диагностике)",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+)
+diagnostics = Diagnostics(
+    DIAGNOSTICS, SLOW_UPDATE_MS / 1000, SLOW_UPDATES_KEEP,
+    sample_interval=PROFILE_INTERVAL_MS / 1000, on_lag=LOOP_LAG.observe
+)
+
+def observe_request(method: str, seconds: float, result: str):
+    # Вызывается в контексте кода, поставившего сообщение в очередь
+    diagnostics.record("send", seconds)
+    TELEGRAM_SECONDS.observe(seconds, (method,))
+    TELEGRAM_REQUESTS.inc((method, result))
 
+def group_counts() -> Dict[tuple, int]:
+    counts = {("alive",): 0, ("frozen",): 0, ("dead",): 0}
+    for state in registry:
+        counts[(state.status,)] += 1
+    return counts
+
+def timed(name: str):
+    """Замер времени корутины в ogonek_handler_seconds"""
+    labels = (name,)
+
+    def decorator(func):
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - started, labels)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+@dp.update.outer_middleware()
+async def count_updates(handler, event: types.Update, data: dict):
+    UPDATES.inc((event.event_type,))
+    chat = getattr(event.event, "chat", None)
+    trace = diagnostics.begin(event.update_id, event.event_type, chat.id if chat else None)
+    try:
+        return await handler(event, data)
+    finally:
+        # Воркер шарда отмечает апдейт сам, когда выполнены его задачи (run_shard)
+        if SHARD_INDEX is None:
+            store.set_offset(event.update_id)
+        diagnostics.finish(trace)
+
+@dp.update.outer_middleware()
+async def drop_duplicates(handler, event: types.Update, data: dict):
+    """Повторно доставленный апдейт (ретрай вебхука, повтор пачки после сбоя) не обрабатывается"""
+    resets = update_window.resets
+    if update_window.seen(event.update_id):
+        DUPLICATES.inc(("update_id",))
+        return None
+    if update_window.resets != resets:
+        logger.warning(f"Новая нумерация апдейтов с {event.update_id}")
+        store.reset_offset(event.update_id - 1)
+    return await handler(event, data)
+
+async def time_handler(handler, event, data: dict):
+    diagnostics.mark("filters")
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        elapsed = time.perf_counter() - started
+        diagnostics.record("handler", elapsed)
+        HANDLER_SECONDS.observe(elapsed, (data["handler"].callback.__name__,))
+
+dp.message.middleware(time_handler)
+dp.callback_query.middleware(time_handler)
+dp.chat_member.middleware(time_handler)
+sessions = SessionStorage(SESSION_TTL, SESSION_LIMIT)  # Состояние админ-меню
+update_window = RingWindow(UPDATE_WINDOW)  # update_id всего потока
+message_window = ReplayWindow(MESSAGE_WINDOW)  # message_id по группам
+metrics.gauge(
+    "ogonek_duplicate_ratio", "Доля повторов среди проверенных апдейтов",
+    lambda: {(check,): window.duplicates / max(window.checked, 1)
+             for check, window in (("update_id", update_window), ("message", message_window))},
+    ["check"]
+)
+pinning_groups = set()  # Группы, где закреплённый статус ещё отправляется
+catch_up_stats: Dict[int, dict] = {}  # Группы в режиме догонялки: учтено сообщений и дней
+# Последнее учтенное сообщение групп на момент запуска: сообщения не новее
+# уже были в журнале до перезапуска; более поздние могут приходить не по порядку
+replay_floor: Dict[int, int] = {}
+rollover_failures: Dict[int, int] = {}  # Группы, где смена дня не удалась: попыток подряд
+background_tasks = set()  # Ссылки на фоновые задачи, чтобы их не собрал GC
+
+# Вспомогательные функции
 def is_group_chat(message: types.Message) -> bool:
-    return message.chat.id == GROUP_ID
+    return message.chat.id in registry
 
-def get_cute_name(user_type: str) -> str:
-    return "Матвейчик" if user_type == "matthew" else "Янчик"
+def apply_op(state: FireState, op: dict):
+    """Изменение состояния с записью в журнал"""
+    with diagnostics.stage("state"):
+        state.apply(op)
+        store.append(state.chat_id, op)
+    if state.status_dirty:
+        refresh_pinned_status(state)
 
-async def send_task_completion_notice(task_idx: int):
-    """Уведомление о выполнении задания"""
-    task = TASKS[task_idx]
-    statuses = []
-    
-    for user in ["matthew", "yana"]:
-        if task["type"] == "message_count":
-            count = fire_state.message_counters[task_idx][user]
-            required = task["count"]
-            status = f"{count}/{required}"
-            if count >= required:
-                status = f"✅ {status}"
-        else:
-            status = "✅" if fire_state.completed_tasks[task_idx][user] else "❌"
-        
-        statuses.append(status)
-    
-    message = (
-        f"🎯 Задание выполнено!\n"
-        f"<b>{task['desc']}</b>\n"
-        f"Матвей: {statuses[0]}, Яна: {statuses[1]}"
+def save_state(state: FireState, publish: bool = True):
+    """Запись полного состояния группы в журнал (смена дня, действия админа)"""
+    store.append(state.chat_id, {"op": "state", "data": state.to_dict()})
+    if state.status_dirty:
+        refresh_pinned_status(state)
+    if publish and backend.shared:
+        spawn(publish_state(state))
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+# Общее хранилище состояния (несколько реплик)
+def shared_key(state: FireState, *parts) -> str:
+    return ":".join(map(str, ("g", state.chat_id) + parts))
+
+def progress_keys(state: FireState):
+    """Ключи прогресса дня: счетчики участников и флаги выполнения заданий"""
+    counters = [shared_key(state, state.epoch, "m", m.key) for m in state.members]
+    flags = [
+        (idx, member, shared_key(state, state.epoch, "d", idx, m.key))
+        for idx in sorted(set(state.task_indices)) if TASKS[idx]["type"] != "message_count"
+        for member, m in enumerate(state.members)
+    ]
+    return counters, flags
+
+async def publish_state(state: FireState):
+    """Публикация состояния группы для других реплик"""
+    results = await backend.execute([
+        ("incr", shared_key(state, "version"), 1, None),
+        ("set", shared_key(state, "state"), json.dumps(state.to_dict()), None),
+    ])
+    state.version = results[0]
+
+async def seed_progress(state: FireState):
+    """Перенос локального прогресса дня в хранилище, если там его еще нет"""
+    counters, flags = progress_keys(state)
+    ops = [
+        ("cas", key, None, state.member_count(member), PROGRESS_TTL)
+        for member, key in enumerate(counters) if state.member_count(member)
+    ]
+    ops.extend(
+        ("cas", key, None, 1, PROGRESS_TTL)
+        for idx, member, key in flags if state.is_done(state.plan.slots_of(idx)[0], member)
     )
-    
-    await bot.send_message(
-        chat_id=GROUP_ID,
-        text=message,
+    if ops:
+        await backend.execute(ops)
+
+async def load_progress(state: FireState):
+    """Обновление локального прогресса дня из хранилища"""
+    epoch = state.epoch
+    counters, flags = progress_keys(state)
+    results = await backend.execute([("get", key) for key in counters] + [("get", key) for *_, key in flags])
+    if state.epoch != epoch:
+        return
+    for member, count in enumerate(results[:len(counters)]):
+        state.set_member_count(member, count or 0)
+    for (idx, member, _), value in zip(flags, results[len(counters):]):
+        if value:
+            state.mark_done(idx, member)
+    state.status_dirty = True
+
+async def reload_group(state: FireState) -> bool:
+    """Загрузка состояния группы, опубликованного другой репликой"""
+    version, data = await backend.execute([
+        ("get", shared_key(state, "version")),
+        ("get", shared_key(state, "state")),
+    ])
+    if data is None:
+        return False
+    if version != state.version:
+        status_message_id = state.status_message_id
+        state.load_dict(json.loads(data))
+        state.status_message_id = state.status_message_id or status_message_id
+        state.version = version
+        state.update_rank()
+        await load_progress(state)
+        save_state(state, publish=False)
+    return True
+
+async def attach_backend():
+    """Согласование локального состояния с хранилищем при запуске"""
+    if not backend.shared:
+        return
+    for state in registry:
+        if await reload_group(state):
+            continue
+        await publish_state(state)
+        await seed_progress(state)
+
+def session_key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
+
+async def get_session(user_id: int) -> dict:
+    """Сессия админ-панели ({} - нет или истекла)"""
+    return await sessions.get_data(session_key(user_id))
+
+async def set_session(user_id: int, data: dict):
+    await sessions.set_data(session_key(user_id), data)
+
+async def session_expired(callback: CallbackQuery):
+    await callback.answer("⌛ Сессия истекла, откройте /admin заново", show_alert=True)
+
+def get_admin_state(user_id: int, session: dict) -> Optional[FireState]:
+    """Группа из сессии админа (None - в сессии нет группы или она чужая)
+
+    Группу по умолчанию выбирает только /admin: без сессии действие
+    могло бы попасть не в ту группу, которой управлял админ.
+    """
+    chat_id = session.get("chat_id")
+    if chat_id is None or chat_id not in registry.admin_groups(user_id):
+        return None
+    return registry.get(chat_id)
+
+async def callback_admin_state(callback: CallbackQuery) -> Optional[FireState]:
+    """Группа для кнопки админ-панели; при отказе сам отвечает на нажатие"""
+    user_id = callback.from_user.id
+    if not registry.admin_groups(user_id):
+        await callback.answer("Доступ запрещен")
+        return None
+    session = await get_session(user_id)
+    if not session:
+        await session_expired(callback)
+        return None
+    state = get_admin_state(user_id, session)
+    if state is None:
+        await callback.answer("Доступ запрещен")
+    return state
+
+def merge_completion_notices(parts: List[str]) -> str:
+    """Одно сообщение на несколько выполненных подряд заданий"""
+    if len(parts) == 1:
+        return "🎯 Задание выполнено!\n" + parts[0]
+    return "🎯 Задания выполнены!\n\n" + "\n\n".join(parts)
+
+def send_task_completion_notice(state: FireState, slot: int):
+    """Уведомление о выполнении задания"""
+    if state.chat_id in catch_up_stats:
+        # Итог догонялки придет одним сообщением
+        return
+
+    if PINNED_STATUS and state.status_message_id:
+        # Прогресс виден в закреплённом статусе
+        return
+
+    message = f"<b>{TASKS[state.task_indices[slot]]['desc']}</b>\n" + state.format_task_statuses(slot)
+
+    send_queue.notify(
+        state.chat_id,
+        "completion",
+        message,
+        merge_completion_notices,
         parse_mode="HTML"
     )
 
-async def send_reminder():
-    """Отправка напоминания"""
-    if fire_state.status == "frozen" and not fire_state.check_daily_completion():
-        cute_matthew = get_cute_name("matthew")
-        cute_yana = get_cute_name("yana")
-        
+def refresh_pinned_status(state: FireState):
+    """Обновление закреплённого статуса группы (не чаще PINNED_STATUS_INTERVAL)"""
+    if not PINNED_STATUS:
+        return
+
+    if state.status_message_id:
+        send_queue.edit(
+            state.chat_id,
+            state.status_message_id,
+            state.get_status_message,
+            min_interval=PINNED_STATUS_INTERVAL,
+            on_failed=lambda error: forget_pinned_status(state),
+            parse_mode="HTML"
+        )
+    elif state.chat_id not in pinning_groups:
+        pinning_groups.add(state.chat_id)
+        send_queue.send(
+            state.chat_id,
+            state.get_status_message(),
+            on_sent=lambda message: pin_status_message(state, message),
+            parse_mode="HTML"
+        )
+
+async def pin_status_message(state: FireState, message: Message):
+    """Запоминание и закрепление нового сообщения со статусом"""
+    pinning_groups.discard(state.chat_id)
+    state.status_message_id = message.message_id
+    save_state(state)
+    try:
+        await bot.pin_chat_message(state.chat_id, message.message_id, disable_notification=True)
+    except Exception as e:
+        logger.warning(f"Не удалось закрепить статус в {state.chat_id}: {e}")
+
+def forget_pinned_status(state: FireState):
+    """Закреплённое сообщение удалено - при следующем изменении будет новое"""
+    state.status_message_id = None
+    save_state(state)
+
+async def send_group_reminder(state: FireState):
+    """Отправка напоминания в группу"""
+    if state.status == "frozen" and not state.check_daily_completion():
+        cute_names = state.cute_names()
+
         reminder_messages = [
-            f"🚨 {cute_matthew} и {cute_yana}! Огонёк сейчас не горит... "
+            f"🚨 {cute_names}! Огонёк сейчас не горит... "
             f"Напоминаю, что нужно выполнить сегодняшние задания, чтобы он снова засиял! 💫",
-            
+
             f"✨ Здрасьте-забор покрасьте! Огонёк ждёт вашего внимания. "
             f"Не забыли про задания на сегодня?",
-            
-            f"{cute_matthew} и {cute_yana}, ваш огонёк скучает! "
+
+            f"{cute_names}, ваш огонёк скучает! "
             f"Подарите ему немного тепла, выполнив задания 🔥",
-            
+
             f"⏰ Тик-так, время идёт! Огонёк напоминает: "
             f"сегодняшние задания ждут вашего выполнения!",
         ]
-        
-        await bot.send_message(
-            chat_id=GROUP_ID,
-            text=random.choice(reminder_messages)
+
+        send_queue.send(
+            state.chat_id,
+            random.choice(reminder_messages)
         )
 
-async def new_day_tasks():
-    """Обновление заданий в 00:00"""
-    global fire_state
-    
-    yesterday_success = fire_state.check_daily_completion()
-    fire_state.update_status(yesterday_success)
-    fire_state.current_date = datetime.now(MOSCOW_TZ).date()
-    fire_state.initialize_new_day()
-    
-    status_emoji = fire_state.get_status_emoji()
+async def send_reminder(states: Optional[List[FireState]] = None):
+    """Отправка напоминаний в группы (по умолчанию во все)"""
+    for state in states if states is not None else registry:
+        await pipeline.post(state.chat_id, lambda state=state: send_group_reminder(state))
+
+async def follow_rollover(state: FireState, today: date, attempts: int = 10):
+    """Ожидание смены дня, которую выполняет другая реплика"""
+    for _ in range(attempts):
+        await reload_group(state)
+        if state.current_date >= today:
+            return
+        await asyncio.sleep(1)
+    logger.warning(f"Смена дня в {state.chat_id} не опубликована другой репликой")
+
+@timed("start_new_day")
+async def start_new_day(state: FireState, today: Optional[date] = None):
+    """Смена дня в одной группе (today - для догонялки, по умолчанию текущая дата)"""
+    today = today or datetime.now(state.tz).date()
+    if backend.shared:
+        await reload_group(state)
+    if state.current_date >= today:
+        return  # день уже сменен (догонялкой, другой репликой или по журналу)
+    if backend.shared:
+        # День меняет только реплика, получившая блокировку
+        lock = shared_key(state, "rollover", state.current_date.isoformat())
+        if not await backend.acquire_lock(lock, REPLICA_ID, ROLLOVER_LOCK_TTL):
+            await follow_rollover(state, today)
+            return
+        await load_progress(state)
+
+    status_before = state.status
+    yesterday_success = state.check_daily_completion()
+    state.update_status(yesterday_success)
+    history.append(state.day_record(yesterday_success, status_before))
+    state.current_date = today
+    state.initialize_new_day()
+    state.refill_schedule()
+    save_state(state, publish=False)
+    if backend.shared:
+        await publish_state(state)
+
+    if state.chat_id in catch_up_stats:
+        catch_up_stats[state.chat_id]["days"] += 1
+        return
+
+    send_queue.send(state.chat_id, new_day_message(state), parse_mode="HTML")
+
+def new_day_message(state: FireState) -> str:
+    status_emoji = state.get_status_emoji()
     message = (
         f"{status_emoji} <b>Новый день! Новые задания!</b> {status_emoji}\n\n"
-        f"{fire_state.get_status_message()}"
+        f"{state.get_status_message()}"
     )
-    
-    if fire_state.status == "frozen":
-        cute_matthew = get_cute_name("matthew")
-        cute_yana = get_cute_name("yana")
+
+    if state.status == "frozen":
         message += (
             "\n\n💔 Огонёк потускнел... "
-            f"{cute_matthew} и {cute_yana}, сегодня нужно обязательно "
+            f"{state.cute_names()}, сегодня нужно обязательно "
             "выполнить все задания, чтобы он снова загорелся!"
         )
-    
-    await bot.send_message(
-        chat_id=GROUP_ID,
-        text=message,
-        parse_mode="HTML"
-    )
+    return message
+
+@lru_cache(maxsize=1024)
+def series_start(tz, today: date) -> datetime:
+    """Начало серии, если она начинается вчерашним днем"""
+    return tz.localize(datetime.combine(today - timedelta(days=1), datetime.min.time()))
+
+def bulk_rollover(states: List[FireState]) -> Tuple[RolloverBatch, List[bytes], List[FireState]]:
+    """Смена дня в пачке групп одним проходом, без await
+
+    Дата считается один раз на часовой пояс, засчитанность дня - парой
+    операций над упакованным прогрессом, задания берутся сдвигом
+    упакованного плана (или из пула планировщика). Возвращает пачку для
+    журнала, итоги прошедших дней для истории и группы для finish_rollover.
+    """
+    days: Dict[object, tuple] = {}
+    batch = RolloverBatch()
+    records = []
+    finished = []
+    for state in states:
+        tz = state.tz
+        info = days.get(tz)
+        if info is None:
+            today = datetime.now(tz).date()
+            info = days[tz] = (today, today.toordinal(), series_start(tz, today))
+        today, ordinal, start = info
+        if state.current_date >= today:
+            continue
+
+        plan, completed, counters = state.plan, state.completed, state.counters
+        success = completed & plan.flag_mask == plan.flag_mask and plan.counts_met(counters)
+        previous, status_before = state.current_date, state.status
+        day = state.schedule & DAY_MASK or pack_day(planner.pooled_day(plan.tasks))
+        state.start_day(today, success, day, start)
+        batch.add(state.chat_id, ordinal, success, day)
+        records.append(encode_day_record(state, previous, plan, completed, counters, success, status_before))
+        finished.append(state)
+    leaderboard.update_many([(state.chat_id, state.streak, state.best_streak) for state in finished])
+    return batch, records, finished
+
+def replay_rollover(registry: GroupRegistry, op: dict):
+    """Повтор массовой смены дня из журнала"""
+    for chat_id, ordinal, success, day in RolloverBatch.from_op(op):
+        state = registry.get(chat_id)
+        if state is not None:
+            today = date.fromordinal(ordinal)
+            state.start_day(today, bool(success), day, series_start(state.tz, today))
+
+async def finish_rollover(finished: List[FireState], chunk: int = 100):
+    """Хвост массовой смены дня: пополнение планов, поздравления
+
+    Планы пополняются пачками по chunk групп с передачей управления loop.
+    Поздравления подаются в очередь отправки по мере ее освобождения (не
+    больше ANNOUNCE_BACKLOG), текст - на момент подачи.
+    """
+    for start in range(0, len(finished), chunk):
+        for state in finished[start:start + chunk]:
+            if planned_days(state.schedule) <= PLAN_DAYS // 2:
+                state.refill_schedule()
+                store.append(state.chat_id, {"op": "schedule", "schedule": state.schedule})
+            refresh_pinned_status(state)
+        await asyncio.sleep(0)
+
+    for state in finished:
+        while send_queue.pending >= ANNOUNCE_BACKLOG:
+            await asyncio.sleep(0.5)
+        send_queue.send(state.chat_id, new_day_message(state), parse_mode="HTML")
+
+async def new_day_tasks(states: Optional[List[FireState]] = None):
+    """Обновление заданий в 00:00 (по умолчанию во всех группах)
+
+    Смена дня встает в очередь группы после уже принятых сообщений;
+    функция ждет, пока день сменится во всех группах. Для многих групп
+    сразу (и без общего хранилища) - массовая смена дня: после событий,
+    уже стоящих в очередях чатов (pipeline.barrier), все группы
+    переводятся одним проходом, в том же шаге - журнал и история.
+    """
+    states = list(states if states is not None else registry)
+    if len(states) >= BULK_ROLLOVER_MIN and not backend.shared:
+        # Обработчики без общего хранилища не уступают loop посреди события,
+        # поэтому от барьера до прохода ни одно событие не выполнится наполовину
+        await pipeline.barrier()
+        started = time.perf_counter()
+        # Сотни тысяч кортежей итогов запускали бы сборщик мусора посреди прохода
+        gc.disable()
+        try:
+            batch, records, finished = bulk_rollover(states)
+        finally:
+            gc.enable()
+        if batch:
+            store.append(0, batch.to_op())
+            history.append_encoded(records)
+        elapsed = time.perf_counter() - started
+        HANDLER_SECONDS.observe(elapsed, ("bulk_rollover",))
+        logger.info(f"День сменился в {len(batch)} группах за {elapsed * 1000:.0f} мс")
+        spawn(finish_rollover(finished))
+        return
+
+    futures = [
+        await pipeline.submit(state.chat_id, lambda state=state: start_new_day(state), wait=True)
+        for state in states
+    ]
+    for future in futures:
+        try:
+            await future
+        except Exception:
+            logger.exception("Не удалось сменить день")
+
+# Планировщик
+@lru_cache(maxsize=4096)
+def local_timestamp(tz, day: date, hour: int) -> float:
+    """Unix time для часа hour дня day в часовом поясе tz"""
+    naive = datetime.combine(day, datetime.min.time()) + timedelta(hours=hour)
+    return tz.localize(naive).timestamp()
+
+def schedule_group(state: FireState, kind: Optional[str] = None):
+    """Назначение следующей смены дня и/или напоминания группы"""
+    if kind in (None, "rollover"):
+        # Полночь после текущего дня группы: если бот был выключен
+        # в полночь, смена дня произойдет сразу после запуска
+        deadlines.schedule(
+            state.chat_id,
+            "rollover",
+            local_timestamp(state.tz, state.current_date + timedelta(days=1), 0)
+        )
+
+    if kind in (None, "reminder") and state.reminder_hours:
+        now = datetime.now(state.tz)
+        for day in (now.date(), now.date() + timedelta(days=1)):
+            upcoming = [
+                ts for ts in (local_timestamp(state.tz, day, h) for h in state.reminder_hours)
+                if ts > now.timestamp()
+            ]
+            if upcoming:
+                deadlines.schedule(state.chat_id, "reminder", upcoming[0])
+                break
+
+async def on_deadlines(kind: str, due: List[tuple]):
+    """Обработка пачки наступивших сроков"""
+    now = time.time()
+    job = {"rollover": "new_day_tasks", "reminder": "send_reminder"}.get(kind, kind)
+    for _, when in due:
+        SCHEDULER_LAG.observe(now - when, (job,))
+
+    states = [registry.get(chat_id) for chat_id, _ in due]
+    states = [state for state in states if state is not None]
+    try:
+        if kind == "rollover":
+            await new_day_tasks(states)
+        elif kind == "reminder":
+            owned = states
+            if backend.shared:
+                # Напоминание отправляет только одна реплика
+                owned = []
+                for chat_id, when in due:
+                    state = registry.get(chat_id)
+                    lock = f"g:{chat_id}:reminder:{int(when)}"
+                    if state and await backend.acquire_lock(lock, REPLICA_ID, 3600):
+                        owned.append(state)
+            await send_reminder(owned)
+    finally:
+        for state in states:
+            schedule_group(state, kind)
+        if kind == "rollover":
+            retry_failed_rollovers(states)
+
+def retry_failed_rollovers(states: List[FireState]):
+    """Повтор смены дня с растущей паузой (2^n с, не больше ROLLOVER_RETRY_MAX)
+
+    Если день в группе не сменился, полночь ее текущего дня уже прошла и
+    срок сработал бы снова на следующем же тике планировщика.
+    """
+    now = time.time()
+    failed = 0
+    for state in states:
+        when = deadlines.next_deadline(state.chat_id, "rollover")
+        if when is None or when > now:
+            rollover_failures.pop(state.chat_id, None)
+            continue
+        attempts = rollover_failures[state.chat_id] = rollover_failures.get(state.chat_id, 0) + 1
+        deadlines.schedule(state.chat_id, "rollover", now + min(2 ** attempts, ROLLOVER_RETRY_MAX))
+        if attempts == 1:
+            failed += 1
+    if failed:
+        logger.error(f"Смена дня не удалась в {failed} группах, повтор с паузой до {ROLLOVER_RETRY_MAX} с")
+
+deadlines = DeadlineScheduler(on_deadlines)
 
 # Админ-панель
+# Короткие коды кнопок без данных (callback_data ограничена 64 байтами)
+class AdminAction:
+    SELECT_TODAY = "td"
+    SELECT_TOMORROW = "tm"
+    SET_STREAK = "ss"
+    SEND_MESSAGE = "sm"
+    REFRESH_STATUS = "rs"
+    HISTORY = "hs"
+    LEADERBOARD = "lb"
+    PLAN = "pl"
+    REPLAN = "rp"
+    BACK_TO_ADMIN = "ba"
+    BACK_TO_TASK_SELECTION = "bs"
+
+# day - день, для которого выбираются задания: 0 - сегодня, 1 - завтра и т.д.
+class CategoryCallback(CallbackData, prefix="c"):
+    day: int
+    category: int
+
+class TaskCallback(CallbackData, prefix="k"):
+    task: int
+
+class RandomCallback(CallbackData, prefix="r"):
+    day: int
+
+class PlanDayCallback(CallbackData, prefix="p"):
+    day: int
+
+def day_title(state: FireState, day: int) -> str:
+    """Название дня для админ-панели"""
+    if day == 0:
+        return "сегодня"
+    if day == 1:
+        return "завтра"
+    return (state.current_date + timedelta(days=day)).strftime("%d.%m")
+
 def get_admin_keyboard():
     """Клавиатура админ-панели"""
     builder = InlineKeyboardBuilder()
-    builder.button(text="📝 Выбрать задания на сегодня", callback_data="select_today_tasks")
-    builder.button(text="📅 Выбрать задания на завтра", callback_data="select_tomorrow_tasks")
-    builder.button(text="🔥 Установить серию", callback_data="set_streak")
-    builder.button(text="📨 Отправить сообщение", callback_data="send_message")
-    builder.button(text="🔄 Обновить статус", callback_data="refresh_status")
+    builder.button(text="📝 Выбрать задания на сегодня", callback_data=AdminAction.SELECT_TODAY)
+    builder.button(text="📅 Выбрать задания на завтра", callback_data=AdminAction.SELECT_TOMORROW)
+    builder.button(text="🔥 Установить серию", callback_data=AdminAction.SET_STREAK)
+    builder.button(text="📨 Отправить сообщение", callback_data=AdminAction.SEND_MESSAGE)
+    builder.button(text="🔄 Обновить статус", callback_data=AdminAction.REFRESH_STATUS)
+    builder.button(text="🗓 План на неделю", callback_data=AdminAction.PLAN)
+    builder.button(text="📊 История", callback_data=AdminAction.HISTORY)
+    builder.button(text="🏆 Рейтинг", callback_data=AdminAction.LEADERBOARD)
     builder.adjust(1)
     return builder.as_markup()
 
-def get_task_selection_keyboard(target: str):
+def get_task_selection_keyboard(day: int):
     """Клавиатура для выбора заданий"""
     builder = InlineKeyboardBuilder()
-    
-    # Группируем задания по категориям
-    categories = {
-        "Сообщения": [0, 1, 2, 3, 4, 10, 11],
-        "Медиа": [5, 6, 7, 8, 9, 12, 13],
-        "Пожелания": [14, 15]
-    }
-    
-    for category, task_ids in categories.items():
+
+    for category, (name, _) in enumerate(TASK_CATEGORIES):
         builder.button(
-            text=f"📌 {category}",
-            callback_data=f"category_{target}_{'_'.join(map(str, task_ids))}"
+            text=f"📌 {name}",
+            callback_data=CategoryCallback(day=day, category=category)
         )
-    
-    builder.button(text="🎲 Случайные 3 задания", callback_data=f"random_{target}")
-    builder.button(text="⬅️ Назад", callback_data="back_to_admin")
+
+    builder.button(text="🎲 Случайные 3 задания", callback_data=RandomCallback(day=day))
+    builder.button(text="⬅️ Назад", callback_data=AdminAction.BACK_TO_ADMIN)
     builder.adjust(1)
     return builder.as_markup()
 
-def get_tasks_from_category(category_tasks: str):
+def get_tasks_from_category(task_ids: List[int]):
     """Получение клавиатуры с заданиями из категории"""
-    task_ids = list(map(int, category_tasks.split('_')))
     builder = InlineKeyboardBuilder()
-    
+
     for task_id in task_ids:
         task = TASKS[task_id]
         builder.button(
             text=task["desc"],
-            callback_data=f"task_{task_id}"
+            callback_data=TaskCallback(task=task_id)
         )
-    
-    builder.button(text="⬅️ Назад", callback_data="back_to_task_selection")
+
+    builder.button(text="⬅️ Назад", callback_data=AdminAction.BACK_TO_TASK_SELECTION)
     builder.adjust(1)
     return builder.as_markup()
 
 @dp.message(Command("admin"))
-async def admin_panel(message: Message):
-    """Обработка команды /admin"""
-    if message.from_user.id == MATTHEW_ID and message.chat.type == "private":
-        user_state[message.from_user.id] = {"mode": "admin"}
-        await message.answer(
-            "🔧 <b>Админ-панель</b>\n\n"
-            "Выберите действие:",
-            reply_markup=get_admin_keyboard(),
-            parse_mode="HTML"
-        )
+async def admin_panel(message: Message, command: Optional[CommandObject] = None):
+    """Обработка команды /admin [chat_id]"""
+    if message.chat.type != "private":
+        return
+
+    chat_ids = registry.admin_groups(message.from_user.id)
+    if not chat_ids:
+        return
+
+    chat_id = chat_ids[0]
+    if command and command.args:
+        try:
+            chat_id = int(command.args.strip())
+        except ValueError:
+            pass
+        if chat_id not in chat_ids:
+            await message.answer("❌ Вы не управляете этой группой")
+            return
 
-@dp.callback_query(F.data.startswith("category_"))
-async def select_category(callback: CallbackQuery):
+    await set_session(message.from_user.id, {"mode": "admin", "chat_id": chat_id})
+    group_line = f"Группа: <code>{chat_id}</code>\n" if len(chat_ids) > 1 else ""
+    await message.answer(
+        "🔧 <b>Админ-панель</b>\n\n"
+        f"{group_line}"
+        "Выберите действие:",
+        reply_markup=get_admin_keyboard(),
+        parse_mode="HTML"
+    )
+
+@admin_callbacks.route(CategoryCallback)
+async def select_category(callback: CallbackQuery, data: CategoryCallback):
     """Выбор категории заданий"""
-    if callback.from_user.id != MATTHEW_ID:
-        await callback.answer("Доступ запрещен")
+    state = await callback_admin_state(callback)
+    if state is None:
+        return
+    if not 0 <= data.category < len(TASK_CATEGORIES) or not 0 <= data.day <= PLAN_DAYS:
+        await callback.answer("Категория не найдена")
         return
-    
-    _, target, category_tasks = callback.data.split('_', 2)
-    user_state[callback.from_user.id] = {
+
+    await set_session(callback.from_user.id, {
         "mode": "select_tasks",
-        "target": target,
+        "chat_id": state.chat_id,
+        "day": data.day,
         "selected_tasks": []
-    }
-    
+    })
+
     await callback.message.edit_text(
         "Выберите задания из категории:",
-        reply_markup=get_tasks_from_category(category_tasks)
+        reply_markup=get_tasks_from_category(TASK_CATEGORIES[data.category][1])
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("task_"))
-async def select_task(callback: CallbackQuery):
+def change_today_tasks(state: FireState, task_indices: List[int]):
+    """Замена заданий текущего дня (в очереди группы)"""
+    state.initialize_new_day(task_indices)
+    save_state(state)
+
+def change_planned_tasks(state: FireState, day: int, task_indices: List[int]):
+    """Замена заданий одного из следующих дней плана (в очереди группы)"""
+    state.set_planned_day(day - 1, task_indices)
+    save_state(state)
+
+def fill_plan(state: FireState):
+    """Дополнение плана до PLAN_DAYS дней (в очереди группы)"""
+    state.refill_schedule(force=True)
+    save_state(state)
+
+def replan_tasks(state: FireState):
+    """Новый план на PLAN_DAYS дней (в очереди группы)"""
+    state.replan()
+    save_state(state)
+
+async def apply_tasks(state: FireState, day: int, task_indices: List[int]) -> str:
+    """Установка заданий на день; возвращает текст ответа админу"""
+    if day == 0:
+        await pipeline.call(state.chat_id, lambda: change_today_tasks(state, task_indices))
+        return state.get_status_message()
+    await pipeline.call(state.chat_id, lambda: change_planned_tasks(state, day, task_indices))
+    return "\n".join([f"• {TASKS[idx]['desc']}" for idx in task_indices])
+
+def change_streak(state: FireState, streak: int):
+    """Ручная установка серии (в очереди группы)"""
+    state.set_streak(streak)
+    save_state(state)
+
+@admin_callbacks.route(TaskCallback)
+async def select_task(callback: CallbackQuery, data: TaskCallback):
     """Выбор конкретного задания"""
-    if callback.from_user.id != MATTHEW_ID:
-        await callback.answer("Доступ запрещен")
+    state = await callback_admin_state(callback)
+    if state is None:
         return
-    
-    task_id = int(callback.data.split('_')[1])
-    user_state[callback.from_user.id]["selected_tasks"].append(task_id)
-    
-    if len(user_state[callback.from_user.id]["selected_tasks"]) >= 3:
-        target = user_state[callback.from_user.id]["target"]
-        
-        if target == "today":
-            fire_state.task_indices = user_state[callback.from_user.id]["selected_tasks"][:3]
-            fire_state.initialize_new_day()
-            await callback.message.edit_text(
-                "✅ Задания на сегодня обновлены!\n\n" + fire_state.get_status_message(),
-                parse_mode="HTML"
-            )
-        else:
-            fire_state.tomorrow_tasks = user_state[callback.from_user.id]["selected_tasks"][:3]
-            tasks_list = "\n".join([f"• {TASKS[idx]['desc']}" for idx in fire_state.tomorrow_tasks])
-            await callback.message.edit_text(
-                f"✅ Задания на завтра установлены:\n{tasks_list}",
-                parse_mode="HTML"
-            )
-        
-        user_state[callback.from_user.id] = {"mode": "admin"}
-    else:
-        await callback.answer(f"Выбрано задание: {TASKS[task_id]['desc']}")
 
-@dp.callback_query(F.data.startswith("random_"))
-async def select_random_tasks(callback: CallbackQuery):
-    """Выбор случайных заданий"""
-    if callback.from_user.id != MATTHEW_ID:
-        await callback.answer("Доступ запрещен")
+    session = await get_session(callback.from_user.id)
+    if session.get("mode") != "select_tasks":
+        await session_expired(callback)
         return
-    
-    target = callback.data.split('_')[1]
-    
-    if target == "today":
-        fire_state.task_indices = random.sample(range(len(TASKS)), 3)
-        fire_state.initialize_new_day()
+
+    task_id = data.task
+    if not 0 <= task_id < len(TASKS):
+        await callback.answer("Задание не найдено")
+        return
+    selected = session["selected_tasks"] + [task_id]
+
+    if len(selected) >= 3:
+        day = session["day"]
+        text = await apply_tasks(state, day, selected[:3])
         await callback.message.edit_text(
-            "🎲 Случайные задания на сегодня:\n\n" + fire_state.get_status_message(),
+            f"✅ Задания на {day_title(state, day)} установлены:\n\n{text}",
             parse_mode="HTML"
         )
+
+        await set_session(callback.from_user.id, {"mode": "admin", "chat_id": state.chat_id})
     else:
-        fire_state.tomorrow_tasks = random.sample(range(len(TASKS)), 3)
-        tasks_list = "\n".join([f"• {TASKS[idx]['desc']}" for idx in fire_state.tomorrow_tasks])
-        await callback.message.edit_text(
-            f"🎲 Случайные задания на завтра:\n{tasks_list}",
-            parse_mode="HTML"
-        )
-    
+        await set_session(callback.from_user.id, dict(session, selected_tasks=selected))
+        await callback.answer(f"Выбрано задание: {TASKS[task_id]['desc']}")
+
+@admin_callbacks.route(RandomCallback)
+async def select_random_tasks(callback: CallbackQuery, data: RandomCallback):
+    """Выбор случайных заданий"""
+    state = await callback_admin_state(callback)
+    if state is None:
+        return
+
+    if not 0 <= data.day <= PLAN_DAYS:
+        await callback.answer("День вне плана")
+        return
+
+    # Учитываются соседние дни, чтобы задания не повторялись подряд
+    days = [state.task_indices] + state.planned_days()
+    tasks = list(planner.next_day(days[:data.day]))
+    text = await apply_tasks(state, data.day, tasks)
+    await callback.message.edit_text(
+        f"🎲 Случайные задания на {day_title(state, data.day)}:\n\n{text}",
+        parse_mode="HTML"
+    )
     await callback.answer()
 
-@dp.callback_query(F.data == "select_today_tasks")
+@admin_callbacks.route(AdminAction.SELECT_TODAY)
 async def select_today_tasks(callback: CallbackQuery):
     """Выбор заданий на сегодня"""
-    if callback.from_user.id != MATTHEW_ID:
-        await callback.answer("Доступ запрещен")
+    state = await callback_admin_state(callback)
+    if state is None:
         return
-    
-    user_state[callback.from_user.id] = {
+
+    await set_session(callback.from_user.id, {
         "mode": "select_tasks",
-        "target": "today",
+        "chat_id": state.chat_id,
+        "day": 0,
         "selected_tasks": []
-    }
-    
+    })
+
     await callback.message.edit_text(
         "📝 Выберите 3 задания на сегодня:",
-        reply_markup=get_task_selection_keyboard("today")
+        reply_markup=get_task_selection_keyboard(0)
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "select_tomorrow_tasks")
+@admin_callbacks.route(AdminAction.SELECT_TOMORROW)
 async def select_tomorrow_tasks(callback: CallbackQuery):
     """Выбор заданий на завтра"""
-    if callback.from_user.id != MATTHEW_ID:
-        await callback.answer("Доступ запрещен")
+    state = await callback_admin_state(callback)
+    if state is None:
         return
-    
-    user_state[callback.from_user.id] = {
+
+    await set_session(callback.from_user.id, {
         "mode": "select_tasks",
-        "target": "tomorrow",
+        "chat_id": state.chat_id,
+        "day": 1,
         "selected_tasks": []
-    }
-    
+    })
+
     await callback.message.edit_text(
         "📅 Выберите 3 задания на завтра:",
-        reply_markup=get_task_selection_keyboard("tomorrow")
+        reply_markup=get_task_selection_keyboard(1)
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "set_streak")
+@admin_callbacks.route(AdminAction.SET_STREAK)
 async def set_streak(callback: CallbackQuery):
     """Установка серии"""
-    if callback.from_user.id != MATTHEW_ID:
-        await callback.answer("Доступ запрещен")
+    state = await callback_admin_state(callback)
+    if state is None:
         return
-    
-    user_state[callback.from_user.id] = {"mode": "set_streak"}
+
+    await set_session(callback.from_user.id, {"mode": "set_streak", "chat_id": state.chat_id})
     await callback.message.answer(
         "Введите новую длину серии (число дней):"
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "send_message")
+@admin_callbacks.route(AdminAction.SEND_MESSAGE)
 async def prepare_send_message(callback: CallbackQuery):
     """Подготовка к отправке сообщения"""
-    if callback.from_user.id != MATTHEW_ID:
-        await callback.answer("Доступ запрещен")
+    state = await callback_admin_state(callback)
+    if state is None:
         return
-    
-    user_state[callback.from_user.id] = {"mode": "send_message"}
+
+    await set_session(callback.from_user.id, {"mode": "send_message", "chat_id": state.chat_id})
     await callback.message.answer(
         "Введите сообщение, которое я отправлю в группу:"
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "refresh_status")
+@admin_callbacks.route(AdminAction.REFRESH_STATUS)
 async def refresh_status(callback: CallbackQuery):
     """Обновление статуса"""
-    if callback.from_user.id != MATTHEW_ID:
-        await callback.answer("Доступ запрещен")
+    state = await callback_admin_state(callback)
+    if state is None:
         return
-    
+
     await callback.message.edit_text(
-        fire_state.get_status_message(),
+        state.get_status_message(),
         parse_mode="HTML"
     )
     await callback.answer("Статус обновлен")
 
-@dp.callback_query(F.data == "back_to_admin")
+@admin_callbacks.route(AdminAction.HISTORY)
+async def history_stats(callback: CallbackQuery):
+    """Статистика группы по истории дней"""
+    state = await callback_admin_state(callback)
+    if state is None:
+        return
+
+    days = history.load_chat(state.chat_id)
+    info = days.replay_streaks(state.chat_id).get(state.chat_id)
+    if info is None:
+        await callback.answer("История пока пуста")
+        return
+
+    rates = days.completion_rate_by_type({task["id"]: task["type"] for task in TASKS}, state.chat_id)
+    reliability = days.member_reliability(state.chat_id)
+    lines = [
+        "📊 <b>История огонька</b>",
+        "",
+        f"Дней в истории: {info['days']}",
+        f"🏆 Рекордная серия: {info['longest_streak']} дней",
+        "",
+        "<b>Выполнение по типам заданий:</b>",
+    ]
+    lines.extend(f"• {task_type}: {rate:.0%}" for task_type, rate in sorted(rates.items(), key=lambda x: -x[1]))
+    lines.append("")
+    lines.append("<b>Все задания выполнены:</b>")
+    for member in state.members:
+        rate = reliability.get((state.chat_id, member.user_id))
+        if rate is not None:
+            lines.append(f"• {member.name}: {rate:.0%} дней")
+
+    builder = InlineKeyboardBuilder()
+    builder.button(text="⬅️ Назад", callback_data=AdminAction.BACK_TO_ADMIN)
+    await callback.message.edit_text("\n".join(lines), parse_mode="HTML", reply_markup=builder.as_markup())
+    await callback.answer()
+
+@admin_callbacks.route(AdminAction.LEADERBOARD)
+async def leaderboard_view(callback: CallbackQuery):
+    """Рейтинг групп по сериям"""
+    state = await callback_admin_state(callback)
+    if state is None:
+        return
+
+    builder = InlineKeyboardBuilder()
+    builder.button(text="⬅️ Назад", callback_data=AdminAction.BACK_TO_ADMIN)
+    await callback.message.edit_text(leaderboard_message(state), parse_mode="HTML", reply_markup=builder.as_markup())
+    await callback.answer()
+
+async def show_plan(callback: CallbackQuery, state: FireState):
+    lines = ["🗓 <b>План заданий</b>", ""]
+    builder = InlineKeyboardBuilder()
+    for day, tasks in enumerate(state.planned_days(), 1):
+        title = day_title(state, day)
+        lines.append(f"<b>{title}:</b>")
+        lines.extend(f"• {TASKS[idx]['desc']}" for idx in tasks)
+        builder.button(text=f"✏️ {title}", callback_data=PlanDayCallback(day=day))
+    builder.button(text="🔀 Составить заново", callback_data=AdminAction.REPLAN)
+    builder.button(text="⬅️ Назад", callback_data=AdminAction.BACK_TO_ADMIN)
+    builder.adjust(3)
+    await callback.message.edit_text("\n".join(lines), parse_mode="HTML", reply_markup=builder.as_markup())
+
+@admin_callbacks.route(AdminAction.PLAN)
+async def plan_view(callback: CallbackQuery):
+    """План заданий на следующие дни"""
+    state = await callback_admin_state(callback)
+    if state is None:
+        return
+
+    if planned_days(state.schedule) < PLAN_DAYS:
+        await pipeline.call(state.chat_id, lambda: fill_plan(state))
+    await show_plan(callback, state)
+    await callback.answer()
+
+@admin_callbacks.route(AdminAction.REPLAN)
+async def replan(callback: CallbackQuery):
+    """Составление плана заново"""
+    state = await callback_admin_state(callback)
+    if state is None:
+        return
+
+    await pipeline.call(state.chat_id, lambda: replan_tasks(state))
+    await show_plan(callback, state)
+    await callback.answer("План составлен заново")
+
+@admin_callbacks.route(PlanDayCallback)
+async def select_plan_day(callback: CallbackQuery, data: PlanDayCallback):
+    """Выбор заданий на день из плана"""
+    state = await callback_admin_state(callback)
+    if state is None:
+        return
+    if not 1 <= data.day <= PLAN_DAYS:
+        await callback.answer("День вне плана")
+        return
+
+    await set_session(callback.from_user.id, {
+        "mode": "select_tasks",
+        "chat_id": state.chat_id,
+        "day": data.day,
+        "selected_tasks": []
+    })
+    await callback.message.edit_text(
+        f"🗓 Выберите 3 задания на {day_title(state, data.day)}:",
+        reply_markup=get_task_selection_keyboard(data.day)
+    )
+    await callback.answer()
+
+@admin_callbacks.route(AdminAction.BACK_TO_ADMIN)
 async def back_to_admin(callback: CallbackQuery):
     """Возврат в админ-панель"""
-    if callback.from_user.id != MATTHEW_ID:
-        await callback.answer("Доступ запрещен")
+    state = await callback_admin_state(callback)
+    if state is None:
         return
-    
-    user_state[callback.from_user.id] = {"mode": "admin"}
+
+    await set_session(callback.from_user.id, {"mode": "admin", "chat_id": state.chat_id})
     await callback.message.edit_text(
         "🔧 <b>Админ-панель</b>\n\nВыберите действие:",
         reply_markup=get_admin_keyboard(),
@@ -512,177 +1884,558 @@ async def back_to_admin(callback: CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "back_to_task_selection")
+@admin_callbacks.route(AdminAction.BACK_TO_TASK_SELECTION)
 async def back_to_task_selection(callback: CallbackQuery):
     """Возврат к выбору заданий"""
-    if callback.from_user.id != MATTHEW_ID:
-        await callback.answer("Доступ запрещен")
+    state = await callback_admin_state(callback)
+    if state is None:
+        return
+
+    session = await get_session(callback.from_user.id)
+    if session.get("mode") != "select_tasks":
+        await session_expired(callback)
         return
-    
-    target = user_state[callback.from_user.id]["target"]
+
+    day = session["day"]
     await callback.message.edit_text(
-        f"Выберите задания на {'сегодня' if target == 'today' else 'завтра'}:",
-        reply_markup=get_task_selection_keyboard(target)
+        f"Выберите задания на {day_title(state, day)}:",
+        reply_markup=get_task_selection_keyboard(day)
     )
     await callback.answer()
 
-@dp.message(F.chat.type == "private", F.from_user.id == MATTHEW_ID)
+@dp.callback_query()
+async def admin_callback(callback: CallbackQuery):
+    """Кнопки админ-панели: один обработчик, выбор действия по префиксу"""
+    if not await admin_callbacks.dispatch(callback):
+        await callback.answer("Кнопка устарела, откройте /admin заново")
+
+@dp.message(F.chat.type == "private")
 async def handle_admin_commands(message: Message):
     """Обработка команд админа"""
     user_id = message.from_user.id
-    
-    if user_id not in user_state:
+
+    session = await get_session(user_id)
+    if not session:
         return
-    
-    if user_state[user_id].get("mode") == "set_streak":
+
+    state = get_admin_state(user_id, session)
+    if state is None:
+        return
+
+    if session.get("mode") == "set_streak":
         try:
             new_streak = int(message.text)
-            fire_state.streak = new_streak
-            fire_state.series_start_date = datetime.now(MOSCOW_TZ) - timedelta(days=new_streak)
-            fire_state.status = "alive"
-            fire_state.consecutive_misses = 0
-            
-            await message.answer(
-                f"✅ Серия установлена: {new_streak} дней\n\n"
-                f"{fire_state.get_status_message()}",
-                parse_mode="HTML"
-            )
-            user_state[user_id] = {"mode": "admin"}
         except ValueError:
             await message.answer("❌ Пожалуйста, введите число")
-    
-    elif user_state[user_id].get("mode") == "send_message":
-        await bot.send_message(
-            chat_id=GROUP_ID,
-            text=message.text
+            return
+        if not 0 <= new_streak <= MAX_STREAK:
+            await message.answer(f"❌ Серия должна быть от 0 до {MAX_STREAK}")
+            return
+        await pipeline.call(state.chat_id, lambda: change_streak(state, new_streak))
+
+        await message.answer(
+            f"✅ Серия установлена: {new_streak} дней\n\n"
+            f"{state.get_status_message()}",
+            parse_mode="HTML"
         )
-        await message.answer("✅ Сообщение отправлено в группу")
-        user_state[user_id] = {"mode": "admin"}
+        await set_session(user_id, {"mode": "admin", "chat_id": state.chat_id})
+
+    elif session.get("mode") == "send_message":
+        send_queue.send(state.chat_id, message.text)
+        await message.answer("✅ Сообщение поставлено в очередь на отправку в группу")
+        await set_session(user_id, {"mode": "admin", "chat_id": state.chat_id})
 
 # Основные обработчики
+# Команды в группе: такие сообщения забирают их обработчики, в прогресс они не идут
+FIRE_COMMAND = "!огонек"
+TOP_COMMAND = "!топ"
+SLASH_COMMANDS = ("start", "admin")
+
+def is_command(message: Message) -> bool:
+    """Сообщение для обработчика команды, а не для handle_message"""
+    text = message.text
+    if not text:
+        return False
+    if text in (FIRE_COMMAND, TOP_COMMAND):
+        return True
+    return text.startswith("/") and text.split(maxsplit=1)[0][1:].split("@")[0] in SLASH_COMMANDS
+
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
     """Обработка команды /start"""
     if is_group_chat(message):
-        await message.reply(
+        send_queue.send(
+            message.chat.id,
             "Привет! Я - Огонёк! "
-            "Напишите !огонек чтобы узнать текущий статус."
+            "Напишите !огонек чтобы узнать текущий статус.",
+            reply_to_message_id=message.message_id
         )
-    elif message.from_user.id == MATTHEW_ID:
+    elif message.chat.type == "private" and registry.admin_groups(message.from_user.id):
         await admin_panel(message)
 
-@dp.message(F.text == "!огонек")
+@dp.message(F.text == FIRE_COMMAND)
 async def fire_command(message: Message):
     """Обработка команды !огонек"""
-    if is_group_chat(message):
-        await message.reply(
-            fire_state.get_status_message(),
-            parse_mode="HTML"
+    state = registry.get(message.chat.id)
+    if state is None:
+        return
+    await pipeline.post(state.chat_id, diagnostics.bind(lambda: send_fire_status(state, message)))
+
+async def send_fire_status(state: FireState, message: Message):
+
+    if PINNED_STATUS and state.status_message_id:
+        send_queue.send(
+            state.chat_id,
+            "📌 Актуальный статус - в закреплённом сообщении",
+            reply_to_message_id=state.status_message_id,
+            allow_sending_without_reply=True
         )
+        return
+
+    if backend.shared:
+        await reload_group(state)
+        await load_progress(state)
+
+    send_queue.send(
+        state.chat_id,
+        state.get_status_message(),
+        parse_mode="HTML",
+        reply_to_message_id=message.message_id
+    )
+
+@dp.message(F.text == TOP_COMMAND)
+async def top_command(message: Message):
+    """Обработка команды !топ"""
+    state = registry.get(message.chat.id)
+    if state is None:
+        return
+    send_queue.send(
+        state.chat_id,
+        leaderboard_message(state),
+        parse_mode="HTML",
+        reply_to_message_id=message.message_id
+    )
+
+def leaderboard_message(state: FireState, size: int = 10) -> str:
+    """Топ групп по текущей и рекордной серии и место группы state
 
-@dp.message(F.chat.id == GROUP_ID)
+    Другие группы не называются: в рейтинге видно только их серии.
+    """
+    lines = ["🏆 <b>Рейтинг огоньков</b>"]
+    for by, title in (("current", "Текущая серия"), ("best", "Рекордная серия")):
+        lines += ["", f"<b>{title}:</b>"]
+        for chat_id, value in leaderboard.top(size, by):
+            place = leaderboard.rank(chat_id, by)[0]
+            mark = " ← вы" if chat_id == state.chat_id else ""
+            lines.append(f"{place}. 🔥 {value} дн.{mark}")
+        own = leaderboard.rank(state.chat_id, by)
+        if own is not None:
+            place, value, total = own
+            lines.append(f"Ваше место: {place} из {total} ({value} дн.)")
+    return "\n".join(lines)
+
+@dp.message(F.chat.type.in_({"group", "supergroup"}))
 async def handle_message(message: Message):
-    """Обработка всех сообщений в чате"""
-    user_type = get_user_type(message.from_user.id)
-    if not user_type:
-        return
-    
-    # Проверяем все задания
-    for task_idx in fire_state.task_indices:
-        task = TASKS[task_idx]
-        was_completed = fire_state.completed_tasks[task_idx][user_type]
-        
-        # Подсчет сообщений
-        if task["type"] == "message_count":
-            fire_state.message_counters[task_idx][user_type] += 1
-        
-        # Голосовые сообщения
-        elif task["type"] == "voice" and message.voice:
-            fire_state.completed_tasks[task_idx][user_type] = True
-        
-        # Видеосообщения (кружки)
-        elif task["type"] == "video_note" and message.video_note:
-            fire_state.completed_tasks[task_idx][user_type] = True
-        
-        # Геолокация
-        elif task["type"] == "location" and message.location:
-            fire_state.completed_tasks[task_idx][user_type] = True
-        
-        # Видео
-        elif task["type"] == "video" and message.video:
-            fire_state.completed_tasks[task_idx][user_type] = True
-        
-        # Фото
-        elif task["type"] == "photo" and message.photo:
-            fire_state.completed_tasks[task_idx][user_type] = True
-        
-        # Длинные сообщения
-        elif task["type"] == "long_text" and message.text:
-            if len(message.text) >= task["min_len"]:
-                fire_state.completed_tasks[task_idx][user_type] = True
-        
-        # Стикеры
-        elif task["type"] == "sticker" and message.sticker:
-            fire_state.completed_tasks[task_idx][user_type] = True
-        
-        # GIF
-        elif task["type"] == "gif" and message.animation:
-            fire_state.completed_tasks[task_idx][user_type] = True
-        
-        # Приветствия утром
-        elif task["type"] == "morning" and message.text:
-            text = message.text.lower()
-            phrases = ["доброго утра", "доброе утро", "доброе утречко", "доброго утречка"]
-            if any(phrase in text for phrase in phrases):
-                fire_state.completed_tasks[task_idx][user_type] = True
-        
-        # Пожелания спокойной ночи
-        elif task["type"] == "evening" and message.text:
-            text = message.text.lower()
-            phrases = ["спокойной ночи", "спок", "спокойной ночки", "сладких снов"]
-            if any(phrase in text for phrase in phrases):
-                fire_state.completed_tasks[task_idx][user_type] = True
-        
-        # Уведомление о выполнении задания
-        if not was_completed and fire_state.completed_tasks[task_idx][user_type]:
-            await send_task_completion_notice(task_idx)
+    """Обработка всех сообщений в чате
+
+    Апдейт только ставится в очередь группы: сообщения одной группы
+    учитываются строго по порядку и не пересекаются со сменой дня.
+    """
+    if message.chat.id not in registry or message.from_user is None:
+        return
+    if message_window.seen(message.chat.id, message.message_id):
+        DUPLICATES.inc(("message",))
+        return
+    await pipeline.post(message.chat.id, diagnostics.bind(lambda: process_message(message)))
+
+@timed("process_message")
+async def process_message(message: Message):
+    """Учет сообщения участника (в очереди группы)"""
+    state = registry.get(message.chat.id)
+    member = state.member_slot(message.from_user.id)
+    if member is None:
+        return
+    if message.message_id <= replay_floor.get(state.chat_id, 0):
+        # Уже учтено в журнале: повтор апдейта после перезапуска
+        DUPLICATES.inc(("journal",))
+        return
+
+    # Проверяем только задания, подходящие по типу содержимого
+    # и найденным в тексте фразам; счетчики сообщений увеличиваются
+    # в FireState.apply
+    plan = state.plan
+    with diagnostics.stage("tasks"):
+        keys = [message.content_type]
+        if message.text and plan.uses_phrases:
+            keys.extend(phrase_matcher.match(message.text))
+
+        done = []
+        for key in keys:
+            for slot, check in plan.index.get(key, ()):
+                if state.is_done(slot, member) or slot in done:
+                    continue
+                if check is None or check(TASKS[plan.tasks[slot]], message):
+                    done.append(slot)
+
+    if backend.shared:
+        done = await record_shared_progress(state, member, done)
+        if done is None:
+            # Набор заданий сменился, пока шел запрос: проверяем заново
+            return await process_message(message)
+    else:
+        apply_op(state, {
+            "op": "message",
+            "user": state.members[member].key,
+            "done": sorted({plan.tasks[slot] for slot in done}),
+            "message_id": message.message_id,
+        })
+
+    # Уведомления о выполнении заданий
+    for slot in done:
+        send_task_completion_notice(state, slot)
+
+async def record_shared_progress(state: FireState, member: int, done: List[int]) -> Optional[List[int]]:
+    """Запись прогресса в общее хранилище одной пачкой
+
+    Счетчик увеличивается атомарно, а задание отмечается через CAS, поэтому
+    уведомление о нем отправит только одна реплика. Возвращает слоты, которые
+    выполнила эта реплика, или None, если день сменился во время запроса.
+    """
+    plan, epoch = state.plan, state.epoch
+    key = state.members[member].key
+    tasks = sorted({plan.tasks[slot] for slot in done})
+    ops = [("get", shared_key(state, "version"))]
+    if plan.count_slots:
+        ops.append(("incr", shared_key(state, epoch, "m", key), 1, PROGRESS_TTL))
+    ops.extend(("cas", shared_key(state, epoch, "d", idx, key), None, 1, PROGRESS_TTL) for idx in tasks)
+    results = await backend.execute(ops)
+
+    if state.epoch != epoch:
+        return None
+    if results[0] != state.version:
+        # Другая реплика изменила состояние группы (например, сменила день)
+        await reload_group(state)
+        if state.epoch != epoch:
+            return None
+
+    won = [idx for idx, ok in zip(tasks, results[-len(tasks):] if tasks else ()) if ok]
+    apply_op(state, {
+        "op": "progress",
+        "user": key,
+        "count": results[1] if plan.count_slots else None,
+        "done": won
+    })
+    return [slot for slot in done if plan.tasks[slot] in won]
 
 @dp.chat_member(ChatMemberUpdatedFilter(IS_NOT_MEMBER >> IS_MEMBER))
 async def on_user_join(event: ChatMemberUpdated):
-    """Приветствие при добавлении Яны в группу"""
-    if event.chat.id == GROUP_ID and event.new_chat_member.user.id == YANA_ID:
-        await bot.send_message(
-            chat_id=GROUP_ID,
-            text=(
-                f"Привет, Яна! Я - Огонёк, общайся с Матвеем каждый день, "
-                f"чтобы я продолжал гореть.\n\n{fire_state.get_status_message()}"
-            ),
-            parse_mode="HTML"
-        )
+    """Приветствие при добавлении участника пары в группу"""
+    state = registry.get(event.chat.id)
+    if state is None:
+        return
 
+    member = state.get_member(event.new_chat_member.user.id)
+    if member is None or member.user_id == state.admin_id:
+        return
 
-async def main():
-    # Запускаем keep-alive сервер
-    asyncio.create_task(keep_alive())
-    
-    # Настройка планировщика
-    scheduler.add_job(
-        new_day_tasks,
-        CronTrigger(hour=0, minute=0, timezone=MOSCOW_TZ)
+    send_queue.send(
+        state.chat_id,
+        f"Привет, {member.name}! Я - Огонёк, общайтесь здесь каждый день, "
+        f"чтобы я продолжал гореть.\n\n{state.get_status_message()}",
+        parse_mode="HTML"
     )
-    
-    for hour in [10, 14, 18, 22]:
-        scheduler.add_job(
-            send_reminder,
-            CronTrigger(hour=hour, minute=0, timezone=MOSCOW_TZ)
+
+
+# Догонялка после перезапуска
+async def catch_up_message(state: FireState, message: Message):
+    """Учет пропущенного сообщения в его день (в очереди группы)"""
+    day = message.date.astimezone(state.tz).date()
+    if day > state.current_date:
+        await start_new_day(state, day)
+    if day == state.current_date:
+        catch_up_stats[state.chat_id]["messages"] += 1
+        await process_message(message)
+
+async def catch_up():
+    """Обработка апдейтов, накопившихся, пока бот был выключен
+
+    Апдейты забираются getUpdates пачками с update_id после сохраненного в
+    журнале; учитываются только сообщения в группах (команды и кнопки
+    устарели). Сообщение попадает в день, когда было отправлено: при
+    переходе через полночь день группы сменяется по ходу. Уведомления о
+    заданиях и смене дня не отправляются, вместо них - одна сводка на
+    группу. Пачка подтверждается Telegram следующим запросом только после
+    того, как ее сообщения учтены.
+    """
+    await bot.delete_webhook(drop_pending_updates=False)
+    started = time.perf_counter()
+    offset = store.update_offset + 1 if store.update_offset else None
+    total = 0
+    catch_up_stats.update({state.chat_id: {"messages": 0, "days": 0} for state in registry})
+    try:
+        while True:
+            updates = await bot.get_updates(
+                offset=offset, limit=CATCH_UP_BATCH, timeout=0,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            if not updates:
+                break
+            for update in updates:
+                offset = update.update_id + 1
+                message = update.message
+                if (update.update_id <= store.update_offset or message is None
+                        or message.from_user is None or message.chat.id not in registry
+                        or is_command(message)):
+                    continue
+                state = registry.get(message.chat.id)
+                await pipeline.post(state.chat_id, lambda state=state, message=message: catch_up_message(state, message))
+            await pipeline.wait_idle()
+            store.set_offset(offset - 1)
+            total += len(updates)
+    finally:
+        stats = {chat_id: info for chat_id, info in catch_up_stats.items() if info["messages"] or info["days"]}
+        catch_up_stats.clear()
+
+    for chat_id, info in stats.items():
+        state = registry.get(chat_id)
+        lines = ["⏳ <b>Пока я перезагружался:</b>"]
+        if info["messages"]:
+            lines.append(f"• учтено сообщений: {info['messages']}")
+        if info["days"]:
+            lines.append("• наступил новый день, задания обновлены")
+        send_queue.send(chat_id, "\n".join(lines) + "\n\n" + state.get_status_message(), parse_mode="HTML")
+    logger.info(
+        f"Догонялка: апдейтов {total}, групп с сообщениями {len(stats)}, "
+        f"{time.perf_counter() - started:.1f} с"
+    )
+
+async def run_webhook():
+    """Приём апдейтов через вебхук на keep-alive сервере"""
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET не задан: вебхук примет запросы от кого угодно")
+    runner = await keep_alive()
+    try:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=not CATCH_UP
         )
-    
-    scheduler.start()
-    
-    # Запуск бота
-    await bot.delete_webhook(drop_pending_updates=True)
+        logger.info(f"Вебхук установлен: {WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def run_polling():
+    """Приём апдейтов long polling'ом"""
+    asyncio.create_task(keep_alive())
+    await bot.delete_webhook(drop_pending_updates=not CATCH_UP)
     await dp.start_polling(bot)
 
+# Шарды
+SHARDS_FILE = "shards.json"  # число шардов, с которым записано состояние в DATA_DIR
+
+def check_shard_layout():
+    """Состояние в DATA_DIR/shard-N привязано к числу шардов: другое число
+    перемешало бы группы между воркерами, а состояние одного процесса в
+    DATA_DIR воркеры не читают"""
+    path = os.path.join(DATA_DIR, SHARDS_FILE)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            shards = json.load(f)["shards"]
+        if shards != SHARDS:
+            raise SystemExit(f"Состояние в {DATA_DIR} записано для SHARDS={shards}, задано {SHARDS}")
+        return
+    if os.path.exists(os.path.join(DATA_DIR, "snapshot.json")):
+        raise SystemExit(f"В {DATA_DIR} состояние запуска без шардов: воркеры начали бы с нуля")
+    os.makedirs(DATA_DIR, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"shards": SHARDS}, f)
+
+def update_route(update: dict, admin_chats: Dict[int, int]) -> int:
+    """chat_id, по которому выбирается шард апдейта
+
+    Личные чаты и кнопки админа идут в шард его первой группы - туда, где
+    админ-панель найдет ее состояние.
+    """
+    for field in ("message", "edited_message", "callback_query", "my_chat_member", "chat_member"):
+        event = update.get(field)
+        if event is None:
+            continue
+        if field == "callback_query":
+            user_id = event["from"]["id"]
+            return admin_chats.get(user_id, user_id)
+        chat = event["chat"]
+        if chat["type"] == "private":
+            return admin_chats.get(chat["id"], chat["id"])
+        return chat["id"]
+    return 0
+
+async def fetch_updates(router: ShardRouter, admin_chats: Dict[int, int]):
+    """Long polling в основном процессе без разбора апдейтов в модели aiogram
+
+    Пачка подтверждается Telegram следующим запросом, после передачи
+    воркерам; апдейты, потерянные упавшим воркером, передаются ему заново
+    (ShardWorker).
+    """
+    url = bot.session.api.api_url(token=bot.token, method="getUpdates")
+    allowed = json.dumps(dp.resolve_used_update_types())
+    offset = None
+    async with ClientSession(timeout=ClientTimeout(total=60)) as session:
+        while True:
+            params = {"timeout": 30, "allowed_updates": allowed}
+            if offset is not None:
+                params["offset"] = offset
+            try:
+                async with session.post(url, data=params) as response:
+                    result = await response.json()
+            except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.warning(f"getUpdates не удался: {e!r}")
+                await asyncio.sleep(1)
+                continue
+            if not result.get("ok"):
+                logger.warning(f"getUpdates: {result.get('description')}")
+                await asyncio.sleep(result.get("parameters", {}).get("retry_after", 1))
+                continue
+            for update in result["result"]:
+                offset = update["update_id"] + 1
+                UPDATES.inc((next(field for field in update if field != "update_id"),))
+                await router.route(update_route(update, admin_chats), update)
+
+async def run_fetcher():
+    """Основной процесс при SHARDS > 0: прием апдейтов и надзор за воркерами"""
+    check_shard_layout()
+    admin_chats: Dict[int, int] = {}
+    for group in group_configs():
+        admin_id = int(group.get("admin_id", group["members"][0]["user_id"]))
+        admin_chats.setdefault(admin_id, int(group["chat_id"]))
+
+    env = dict(os.environ)
+    env.pop("WEBHOOK_URL", None)
+    router = ShardRouter(SHARDS, [sys.executable, os.path.abspath(__file__)], env)
+    metrics.gauge("ogonek_shard_forwarded", "Апдейты, переданные воркеру шарда",
+                  lambda: router.counts("forwarded"), ["shard"])
+    metrics.gauge("ogonek_shard_restarts", "Перезапуски воркера шарда",
+                  lambda: router.counts("restarts"), ["shard"])
+    await router.start()
+    logger.info(f"Запущено воркеров: {SHARDS}")
+
+    async def handle_update(request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            raise web.HTTPUnauthorized()
+        update = await request.json()
+        await router.route(update_route(update, admin_chats), update)
+        return web.Response()
+
+    runner = await keep_alive(webhook=handle_update if WEBHOOK_URL else None)
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+                drop_pending_updates=not CATCH_UP
+            )
+            await asyncio.Event().wait()
+        else:
+            await bot.delete_webhook(drop_pending_updates=not CATCH_UP)
+            await fetch_updates(router, admin_chats)
+    finally:
+        await router.stop()
+        await runner.cleanup()
+        await bot.session.close()
+
+async def run_shard():
+    """Воркер шарда: апдейты от основного процесса, строка JSON в stdin
+
+    Как и при polling, каждый апдейт - отдельная задача; порядок сообщений
+    группы держит ее очередь. В журнал пишется update_id, до которого все
+    апдейты обработаны вместе с задачами в очередях групп: после
+    перезапуска основной процесс передает последние апдейты заново, и
+    учтенные до этой отметки пропускаются. Обработанные после нее
+    сообщения отсекаются по message_id (process_message). Конец stdin -
+    остановка.
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=1 << 20)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    inflight: Dict[int, None] = {}  # update_id в обработке, по возрастанию
+    received = store.update_offset
+
+    async def feed(update: types.Update):
+        try:
+            await dp.feed_update(bot, update)
+            chat = getattr(update.event, "chat", None)
+            if chat is not None and chat.id in registry:
+                # Очередь группы - FIFO: пустая задача выполнится после задач апдейта
+                await pipeline.call(chat.id, lambda: None)
+        except Exception:
+            logger.exception(f"Ошибка обработки апдейта {update.update_id}")
+        finally:
+            del inflight[update.update_id]
+            store.set_offset(next(iter(inflight), received + 1) - 1)
+
+    runner = await keep_alive()
+    try:
+        while line := await reader.readline():
+            update = types.Update.model_validate_json(line, context={"bot": bot})
+            if update.update_id <= received:
+                if received - update.update_id < UPDATE_WINDOW:
+                    continue  # уже учтен до перезапуска воркера
+                # Telegram выбрал нумерацию заново (неделя без апдейтов)
+                logger.warning(f"Новая нумерация апдейтов с {update.update_id}")
+                store.reset_offset(update.update_id - 1)
+            received = update.update_id
+            inflight[received] = None
+            spawn(feed(update))
+        while background_tasks:
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+    finally:
+        await runner.cleanup()
+
+async def main():
+    if SHARDS and SHARD_INDEX is None:
+        await run_fetcher()
+        return
+
+    # Восстановление состояния и фоновая запись журнала
+    if not store.lock():
+        raise SystemExit(f"Каталог {DATA_DIR} занят другим процессом бота или импортом")
+    restore_state(registry, store)
+    await attach_backend()
+    if RECOMPUTE_STREAKS:
+        recompute_streaks(registry, history)
+    asyncio.create_task(store.run(registry.snapshot))
+    send_queue.start()
+    pipeline.start()
+    diagnostics.start()
+
+    # Пропущенные сообщения учитываются до смены дня по расписанию
+    if CATCH_UP and SHARD_INDEX is None:
+        try:
+            await catch_up()
+        except Exception:
+            logger.exception("Не удалось обработать накопившиеся апдейты")
+    # Смена дня и напоминания по часовым поясам групп - от дня после догонялки
+    for state in registry:
+        schedule_group(state)
+    asyncio.create_task(deadlines.run())
+
+    # Запуск бота
+    try:
+        if SHARD_INDEX is not None:
+            await run_shard()
+        elif WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        diagnostics.stop()
+        await pipeline.drain()
+        await send_queue.drain()
+        store.close(registry.snapshot)
+        history.close()
+        await backend.close()
+
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
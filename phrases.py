@@ -0,0 +1,79 @@
+from typing import Dict, FrozenSet, Iterable, List
+
+
+class PhraseMatcher:
+    """Поиск фраз из нескольких словарей за один проход по тексту
+
+    Автомат Ахо-Корасик строится один раз; время проверки сообщения зависит
+    только от длины текста, а не от количества фраз. Фраза ищется как
+    подстрока без учёта регистра, как и раньше в handle_message.
+    """
+
+    def __init__(self, lexicons: Dict[str, Iterable[str]]):
+        self.categories: List[str] = list(lexicons)
+        self._all_mask = (1 << len(self.categories)) - 1
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[int] = [0]
+        self._names: Dict[int, FrozenSet[str]] = {0: frozenset()}
+
+        for bit, category in enumerate(self.categories):
+            for phrase in lexicons[category]:
+                self._add(phrase.lower(), 1 << bit)
+        self._build_fail_links()
+
+    def _add(self, phrase: str, mask: int):
+        if not phrase:
+            return
+        state = 0
+        for ch in phrase:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(0)
+            state = next_state
+        self._out[state] |= mask
+
+    def _build_fail_links(self):
+        # Обход в ширину: у каждого состояния выход объединяется с выходом
+        # его fail-состояния, чтобы при поиске не ходить по цепочке ссылок
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                self._out[next_state] |= self._out[self._fail[next_state]]
+                queue.append(next_state)
+
+    def match_mask(self, text: str) -> int:
+        """Битовая маска найденных категорий"""
+        goto, fail, out = self._goto, self._fail, self._out
+        all_mask = self._all_mask
+        state = 0
+        mask = 0
+        for ch in text.lower():
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                mask |= out[state]
+                if mask == all_mask:
+                    break
+        return mask
+
+    def match(self, text: str) -> FrozenSet[str]:
+        """Названия всех категорий, фразы которых есть в тексте"""
+        mask = self.match_mask(text)
+        names = self._names.get(mask)
+        if names is None:
+            names = frozenset(
+                category for bit, category in enumerate(self.categories)
+                if mask & (1 << bit)
+            )
+            self._names[mask] = names
+        return names
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class _Mailbox:
+    __slots__ = ("jobs", "waiters")
+
+    def __init__(self):
+        self.jobs: Deque[tuple] = deque()  # (задача, future или None)
+        self.waiters: Deque[asyncio.Future] = deque()  # ждут места в очереди
+
+
+class ChatPipeline:
+    """Обработка событий чатов: у каждого чата своя упорядоченная очередь
+
+    События одного чата выполняются строго по очереди, разные чаты -
+    параллельно пулом воркеров, по одному событию чата за ход, чтобы
+    активный чат не занимал воркеры. Очереди ограничены: max_per_chat на
+    чат и max_pending на всех; при переполнении submit ждёт освобождения
+    места, и это замедляет приём апдейтов.
+    """
+
+    def __init__(self, workers: int = 8, max_per_chat: int = 100, max_pending: int = 10000):
+        self.workers = workers
+        self.max_per_chat = max_per_chat
+        self._slots = asyncio.Semaphore(max_pending)
+        self._boxes: Dict[Hashable, _Mailbox] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._scheduled: Set[Hashable] = set()  # чаты в _ready или в обработке
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def pending(self) -> int:
+        """Событий в очередях и в обработке"""
+        return self._pending
+
+    async def submit(self, chat_id: Hashable, job: Callable[[], Any],
+                     wait: bool = False) -> Optional[asyncio.Future]:
+        """Поставить job() в очередь чата
+
+        job может быть обычной функцией или возвращать корутину. С wait=True
+        возвращается future с результатом, иначе ошибки только логируются.
+        """
+        await self._slots.acquire()
+        while True:
+            box = self._boxes.get(chat_id)
+            if box is None:
+                box = self._boxes[chat_id] = _Mailbox()
+            if len(box.jobs) < self.max_per_chat:
+                break
+            waiter = asyncio.get_running_loop().create_future()
+            box.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                self._slots.release()
+                raise
+
+        future = asyncio.get_running_loop().create_future() if wait else None
+        box.jobs.append((job, future))
+        self._pending += 1
+        self._idle.clear()
+        if chat_id not in self._scheduled:
+            self._scheduled.add(chat_id)
+            self._ready.put_nowait(chat_id)
+        return future
+
+    async def post(self, chat_id: Hashable, job: Callable[[], Any]):
+        """Поставить в очередь, не дожидаясь выполнения"""
+        await self.submit(chat_id, job)
+
+    async def call(self, chat_id: Hashable, job: Callable[[], Any]) -> Any:
+        """Выполнить в очереди чата и вернуть результат"""
+        return await (await self.submit(chat_id, job, wait=True))
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            box = self._boxes[chat_id]
+            job, future = box.jobs.popleft()
+            while box.waiters:
+                waiter = box.waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    break
+
+            try:
+                result = job()
+                if asyncio.iscoroutine(result):
+                    result = await result
+            except Exception as e:
+                if future is None:
+                    logger.exception(f"Ошибка обработки события чата {chat_id}")
+                elif not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if future is not None and not future.cancelled():
+                    future.set_result(result)
+            finally:
+                self._pending -= 1
+                self._slots.release()
+
+            if box.jobs:
+                self._ready.put_nowait(chat_id)
+            else:
+                self._scheduled.discard(chat_id)
+                if not box.waiters:
+                    del self._boxes[chat_id]
+                if not self._pending:
+                    self._idle.set()
+
+    async def barrier(self):
+        """Дождаться событий, уже стоящих в очередях (поставленные позже не ждем)
+
+        В каждую непустую очередь ставится пустое событие: очереди чатов
+        упорядочены, и когда оно выполнено, выполнены и все до него.
+        """
+        futures = [await self.submit(chat_id, lambda: None, wait=True) for chat_id in list(self._boxes)]
+        if futures:
+            await asyncio.gather(*futures, return_exceptions=True)
+
+    async def wait_idle(self):
+        """Дождаться, пока очереди опустеют (воркеры продолжают работать)"""
+        await self._idle.wait()
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def drain(self, timeout: float = 10):
+        """Дождаться обработки очередей (при остановке бота)"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не обработано событий при остановке: {self._pending}")
+        for task in self._tasks:
+            task.cancel()
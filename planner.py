@@ -0,0 +1,132 @@
+import random
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# День плана упакован в DAY_BITS бит: по байту на задание (id + 1, 0 - пусто)
+TASK_BITS = 8
+TASKS_PER_DAY = 3
+DAY_BITS = TASK_BITS * TASKS_PER_DAY
+DAY_MASK = (1 << DAY_BITS) - 1
+
+
+def pack_day(tasks: Sequence[int]) -> int:
+    value = 0
+    for i, task in enumerate(tasks[:TASKS_PER_DAY]):
+        value |= (task + 1) << (i * TASK_BITS)
+    return value
+
+
+def unpack_day(value: int) -> Tuple[int, ...]:
+    tasks = []
+    while value:
+        tasks.append((value & 0xFF) - 1)
+        value >>= TASK_BITS
+    return tuple(tasks)
+
+
+def pack_days(days: Sequence[Sequence[int]]) -> int:
+    """План на несколько дней в одном int: первый день - младшие биты"""
+    value = 0
+    for i, tasks in enumerate(days):
+        value |= pack_day(tasks) << (i * DAY_BITS)
+    return value
+
+
+def unpack_days(value: int) -> List[Tuple[int, ...]]:
+    days = []
+    while value:
+        days.append(unpack_day(value & DAY_MASK))
+        value >>= DAY_BITS
+    return days
+
+
+def pop_day(value: int) -> Tuple[Tuple[int, ...], int]:
+    """Первый день плана и остаток: (задания, новый план)"""
+    return unpack_day(value & DAY_MASK), value >> DAY_BITS
+
+
+def planned_days(value: int) -> int:
+    return (value.bit_length() + DAY_BITS - 1) // DAY_BITS
+
+
+class TaskPlanner:
+    """Составление наборов заданий на дни вперед
+
+    Каждый день берется по заданию из разных категорий, реже всего
+    встречавшихся в последних днях; внутри категории задание выбирается
+    с учетом весов среди не повторявшихся дольше всего. Задания с весом 0
+    не планируются.
+    """
+
+    def __init__(self, categories: List[Tuple[str, List[int]]],
+                 weights: Optional[Dict[int, float]] = None, per_day: int = TASKS_PER_DAY,
+                 memory: int = 7, rng: Optional[random.Random] = None):
+        weights = weights or {}
+        self.categories = [
+            (name, [task for task in ids if weights.get(task, 1) > 0])
+            for name, ids in categories
+        ]
+        self.categories = [(name, ids) for name, ids in self.categories if ids]
+        self.weights = weights
+        self.per_day = min(per_day, TASKS_PER_DAY, sum(len(ids) for _, ids in self.categories))
+        self.memory = memory
+        self.rng = rng or random.Random()
+        self._pools: Dict[tuple, List[Tuple[int, ...]]] = {}
+
+    def next_day(self, recent: Sequence[Sequence[int]] = ()) -> Tuple[int, ...]:
+        """Набор заданий на следующий день; recent - предыдущие дни (последний - вчера)"""
+        recent = list(recent)[-self.memory:]
+        used: Dict[int, int] = {}  # задание -> сколько дней назад было (1 - вчера)
+        for age, day in enumerate(reversed(recent), 1):
+            for task in day:
+                used.setdefault(task, age)
+
+        # Категории: сначала реже встречавшиеся, при равенстве - случайно
+        usage = [
+            sum(1 for task in ids if task in used) for _, ids in self.categories
+        ]
+        order = sorted(range(len(self.categories)), key=lambda c: (usage[c], self.rng.random()))
+
+        chosen: List[int] = []
+        for i in range(self.per_day):
+            # Если заданий в день больше, чем категорий, идем по кругу
+            for category in order[i % len(order):] + order[:i % len(order)]:
+                task = self._pick(self.categories[category][1], used, chosen)
+                if task is not None:
+                    chosen.append(task)
+                    break
+
+        # Порядок как в каталоге категорий: сообщения, медиа, пожелания
+        rank = {task: i for i, (_, ids) in enumerate(self.categories) for task in ids}
+        return tuple(sorted(chosen, key=lambda task: (rank[task], task)))
+
+    def pooled_day(self, today: tuple = (), size: int = 32) -> Tuple[int, ...]:
+        """Набор на день после today из заранее составленного пула
+
+        Для массовой смены дня и групп без плана: вместо подбора для каждой
+        группы - случайный выбор из size вариантов, составленных next_day.
+        """
+        pool = self._pools.get(today)
+        if pool is None:
+            recent = [today] if today else []
+            pool = self._pools[today] = [self.next_day(recent) for _ in range(size)]
+        return self.rng.choice(pool)
+
+    def _pick(self, ids: List[int], used: Dict[int, int], chosen: List[int]) -> Optional[int]:
+        candidates = [task for task in ids if task not in chosen]
+        if not candidates:
+            return None
+        # Только давно не встречавшиеся: не было в памяти или были раньше всех
+        oldest = max(used.get(task, self.memory + 1) for task in candidates)
+        candidates = [task for task in candidates if used.get(task, self.memory + 1) == oldest]
+        weights = [self.weights.get(task, 1) for task in candidates]
+        return self.rng.choices(candidates, weights)[0]
+
+    def extend(self, schedule: int, today: Sequence[int], days: int) -> int:
+        """Дополнить упакованный план до days дней"""
+        planned = unpack_days(schedule)
+        history = [tuple(today)] + planned
+        while len(planned) < days:
+            day = self.next_day(history)
+            planned.append(day)
+            history.append(day)
+        return pack_days(planned)
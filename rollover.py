@@ -0,0 +1,54 @@
+import base64
+from array import array
+from typing import Iterator, Tuple
+
+# Столбцы пачки смены дня: (имя, typecode array)
+COLUMNS = (
+    ("chat", "q"),     # chat_id
+    ("day", "i"),      # новый день группы (date.toordinal)
+    ("success", "b"),  # засчитан ли прошедший день
+    ("tasks", "I"),    # задания нового дня (planner.pack_day)
+)
+
+
+class RolloverBatch:
+    """Итоги смены дня для пачки групп в столбцах array
+
+    Пишется в журнал одной записью {"op": "rollover", ...} вместо полного
+    состояния каждой группы: при восстановлении переход повторяется по
+    тем же правилам, из журнала берутся только засчитанность дня и новые
+    задания. Столбцы кодируются base64, ~17 байт на группу.
+    """
+
+    def __init__(self):
+        self.chat = array("q")
+        self.day = array("i")
+        self.success = array("b")
+        self.tasks = array("I")
+
+    def __len__(self) -> int:
+        return len(self.chat)
+
+    def add(self, chat_id: int, day: int, success: bool, tasks: int):
+        self.chat.append(chat_id)
+        self.day.append(day)
+        self.success.append(success)
+        self.tasks.append(tasks)
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int, int]]:
+        return zip(self.chat, self.day, self.success, self.tasks)
+
+    def to_op(self) -> dict:
+        op = {"op": "rollover"}
+        for name, _ in COLUMNS:
+            op[name] = base64.b64encode(getattr(self, name).tobytes()).decode("ascii")
+        return op
+
+    @classmethod
+    def from_op(cls, op: dict) -> "RolloverBatch":
+        batch = cls()
+        for name, typecode in COLUMNS:
+            column = array(typecode)
+            column.frombytes(base64.b64decode(op[name]))
+            setattr(batch, name, column)
+        return batch
@@ -0,0 +1,301 @@
+import time
+import heapq
+import asyncio
+import logging
+import contextvars
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = 0.0
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class OutgoingMessage:
+    def __init__(self, chat_id: int, text: str, kwargs: dict, not_before: float = 0.0,
+                 merge: Optional[Callable[[List[str]], str]] = None, coalesce_key: Optional[str] = None,
+                 edit_message_id: Optional[int] = None, render: Optional[Callable[[], str]] = None,
+                 on_sent: Optional[Callable] = None, on_failed: Optional[Callable] = None):
+        self.chat_id = chat_id
+        self.parts = [text]
+        self.kwargs = kwargs
+        self.not_before = not_before
+        self.merge = merge
+        self.coalesce_key = coalesce_key
+        self.edit_message_id = edit_message_id
+        self.render = render
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.attempts = 0
+        self.context: Optional[contextvars.Context] = None  # контекст постановки в очередь
+
+    @property
+    def text(self) -> str:
+        if self.render is not None:
+            return self.render()
+        if self.merge is not None:
+            return self.merge(self.parts)
+        return self.parts[0]
+
+
+class SendQueue:
+    """Очередь исходящих сообщений с учётом лимитов Telegram
+
+    Сообщения одного чата уходят по порядку, разные чаты - параллельно
+    несколькими воркерами. Отложенные сообщения (правки с интервалом,
+    склеиваемые уведомления) не задерживают готовые, стоящие за ними.
+    Частота ограничивается корзинами токенов на чат и на бота целиком;
+    на 429 (RetryAfter) и ошибки сети весь чат откладывается до времени
+    повтора, новые сообщения его не опережают. Уведомления с одинаковым coalesce_key, пришедшие в течение окна,
+    склеиваются в одно сообщение. observer(метод, секунды, результат)
+    вызывается после каждого запроса к Telegram (для метрик) в контексте
+    (contextvars) кода, поставившего сообщение в очередь.
+    """
+
+    def __init__(self, bot: Bot, global_rate: float = 30, group_rate: float = 20 / 60,
+                 private_rate: float = 1, chat_burst: float = 3,
+                 coalesce_window: float = 2.0, workers: int = 4, max_attempts: int = 5,
+                 observer: Optional[Callable[[str, float, str], None]] = None):
+        self.bot = bot
+        self.observer = observer
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.group_rate = group_rate
+        self.private_rate = private_rate
+        self.chat_burst = chat_burst
+        self.coalesce_window = coalesce_window
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._pending: Dict[int, Deque[OutgoingMessage]] = {}
+        self._ready: List[Tuple[float, int]] = []  # (время готовности, chat_id)
+        self._scheduled: Dict[int, float] = {}  # чат -> его актуальное время в _ready
+        self._sending: set = set()  # чаты, сообщение которых сейчас отправляется
+        self._hold: Dict[int, float] = {}  # чат -> время повтора после RetryAfter/ошибки
+        self._pending_edits: Dict[Tuple[int, int], OutgoingMessage] = {}
+        self._last_edit: Dict[Tuple[int, int], float] = {}
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def pending(self) -> int:
+        """Сообщений в очереди"""
+        return sum(len(queue) for queue in self._pending.values())
+
+    def _now(self) -> float:
+        return asyncio.get_running_loop().time()
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if chat_id < 0 else self.private_rate
+            bucket = TokenBucket(rate, self.chat_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _schedule(self, chat_id: int, when: float):
+        if chat_id in self._sending:
+            return  # воркер запланирует чат заново после отправки
+        when = max(when, self._hold.get(chat_id, 0.0))
+        scheduled = self._scheduled.get(chat_id)
+        if scheduled is None or when < scheduled:
+            # Более ранняя запись вытесняет прежнюю, та будет пропущена
+            self._scheduled[chat_id] = when
+            heapq.heappush(self._ready, (when, chat_id))
+            self._wakeup.set()
+
+    def send(self, chat_id: int, text: str, on_sent: Optional[Callable] = None, **kwargs):
+        """Поставить сообщение в очередь (не ждёт отправки)
+
+        on_sent(message) вызывается после успешной отправки (может быть корутиной).
+        """
+        self._enqueue(OutgoingMessage(chat_id, text, kwargs, on_sent=on_sent))
+
+    def edit(self, chat_id: int, message_id: int, render: Callable[[], str],
+             min_interval: float = 0, on_failed: Optional[Callable] = None, **kwargs):
+        """Правка сообщения не чаще min_interval секунд
+
+        Текст получается вызовом render() в момент отправки, поэтому повторные
+        вызовы до отправки ничего не стоят: уйдёт одна правка с последним текстом.
+        """
+        key = (chat_id, message_id)
+        if key in self._pending_edits:
+            return
+        not_before = self._last_edit.get(key, 0.0) + min_interval
+        message = OutgoingMessage(
+            chat_id, "", kwargs, not_before,
+            edit_message_id=message_id, render=render, on_failed=on_failed
+        )
+        self._pending_edits[key] = message
+        self._enqueue(message)
+
+    def notify(self, chat_id: int, key: str, text: str,
+               merge: Callable[[List[str]], str], **kwargs):
+        """Уведомление, склеиваемое с другими с тем же key в пределах окна"""
+        queue = self._pending.get(chat_id)
+        if queue:
+            last = queue[-1]
+            if last.coalesce_key == key and last.attempts == 0:
+                last.parts.append(text)
+                return
+        not_before = self._now() + self.coalesce_window
+        self._enqueue(OutgoingMessage(chat_id, text, kwargs, not_before, merge, key))
+
+    def _enqueue(self, message: OutgoingMessage):
+        if self.observer is not None:
+            message.context = contextvars.copy_context()
+        self._pending.setdefault(message.chat_id, deque()).append(message)
+        self._idle.clear()
+        self._schedule(message.chat_id, message.not_before)
+
+    async def _worker(self):
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = self._now()
+            when, chat_id = self._ready[0]
+            if when > now:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), when - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._ready)
+            if self._scheduled.get(chat_id) != when:
+                continue  # устаревшая запись: чат запланирован на другое время
+            del self._scheduled[chat_id]
+            hold = self._hold.get(chat_id)
+            if hold is not None:
+                if hold > now:
+                    self._schedule(chat_id, hold)
+                    continue
+                del self._hold[chat_id]
+
+            queue = self._pending[chat_id]
+            # Первое готовое сообщение чата; отложенные пропускаются
+            index = next((i for i, message in enumerate(queue) if message.not_before <= now), None)
+            if index is None:
+                self._schedule(chat_id, min(message.not_before for message in queue))
+                continue
+            message = queue[index]
+            delay = max(self._bucket(chat_id).delay(now), self.global_bucket.delay(now))
+            if delay > 0:
+                self._schedule(chat_id, now + delay)
+                continue
+
+            self._bucket(chat_id).take(now)
+            self.global_bucket.take(now)
+            self._sending.add(chat_id)
+            try:
+                retry_at = await self._deliver(message)
+            finally:
+                self._sending.discard(chat_id)
+
+            if retry_at is None:
+                del queue[index]
+            else:
+                self._hold[chat_id] = retry_at
+                if message.edit_message_id is not None:
+                    self._pending_edits.setdefault((chat_id, message.edit_message_id), message)
+            if queue:
+                self._schedule(chat_id, min(message.not_before for message in queue))
+            else:
+                del self._pending[chat_id]
+                if not self._pending:
+                    self._idle.set()
+
+    async def _deliver(self, message: OutgoingMessage) -> Optional[float]:
+        """Отправка; возвращает время повтора или None, если повторять не нужно"""
+        message.attempts += 1
+        edit_key = (message.chat_id, message.edit_message_id)
+        method = "send_message" if message.edit_message_id is None else "edit_message_text"
+        outcome = "ok"
+        started = time.perf_counter()
+        try:
+            if message.edit_message_id is not None:
+                # Новые изменения после этого момента требуют новой правки
+                self._pending_edits.pop(edit_key, None)
+                self._last_edit[edit_key] = self._now()
+                await self.bot.edit_message_text(
+                    text=message.text,
+                    chat_id=message.chat_id,
+                    message_id=message.edit_message_id,
+                    **message.kwargs
+                )
+            else:
+                sent = await self.bot.send_message(chat_id=message.chat_id, text=message.text, **message.kwargs)
+                if message.on_sent is not None:
+                    result = message.on_sent(sent)
+                    if asyncio.iscoroutine(result):
+                        await result
+        except TelegramRetryAfter as e:
+            outcome = "retry_after"
+            logger.warning(f"Flood limit в чате {message.chat_id}, повтор через {e.retry_after} с")
+            return self._now() + e.retry_after
+        except (TelegramNetworkError, TelegramServerError) as e:
+            outcome = "network_error"
+            if message.attempts < self.max_attempts:
+                backoff = min(60, 2 ** message.attempts)
+                logger.warning(f"Ошибка отправки в {message.chat_id}: {e}, повтор через {backoff} с")
+                return self._now() + backoff
+            logger.error(f"Сообщение в {message.chat_id} не отправлено после {message.attempts} попыток")
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                outcome = "bad_request"
+                logger.warning(f"Telegram отклонил сообщение в {message.chat_id}: {e}")
+                if message.on_failed is not None:
+                    message.on_failed(e)
+        except Exception:
+            outcome = "error"
+            logger.exception(f"Не удалось отправить сообщение в {message.chat_id}")
+        finally:
+            if self.observer is not None:
+                message.context.run(self.observer, method, time.perf_counter() - started, outcome)
+        return None
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def drain(self, timeout: float = 10):
+        """Дождаться отправки очереди (при остановке бота)"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не все исходящие сообщения отправлены до остановки")
+        for task in self._tasks:
+            task.cancel()
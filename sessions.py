@@ -0,0 +1,86 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+
+class _Session:
+    __slots__ = ("state", "data", "expires")
+
+    def __init__(self):
+        self.state: Optional[str] = None
+        self.data: Dict[str, Any] = {}
+        self.expires = 0.0
+
+
+class SessionStorage(BaseStorage):
+    """FSM-хранилище в памяти с TTL и вытеснением давно не использованных
+
+    Сессия живет ttl секунд с последнего обращения; сверх max_sessions
+    вытесняются самые старые. Порядок OrderedDict - порядок обращений, он же
+    порядок истечения, поэтому просроченные сессии снимаются с начала за O(1).
+    Реализует интерфейс aiogram BaseStorage, поэтому заменяется на
+    RedisStorage и т.п., если сессии нужно сохранять между перезапусками.
+    """
+
+    def __init__(self, ttl: float = 900, max_sessions: int = 1000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[StorageKey, _Session]" = OrderedDict()
+
+    def __len__(self) -> int:
+        self._expire(time.monotonic())
+        return len(self._sessions)
+
+    def _expire(self, now: float):
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.expires > now:
+                break
+            self._sessions.popitem(last=False)
+
+    def _get(self, key: StorageKey, create: bool = False) -> Optional[_Session]:
+        now = time.monotonic()
+        self._expire(now)
+        session = self._sessions.get(key)
+        if session is None:
+            if not create:
+                return None
+            session = self._sessions[key] = _Session()
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(key)
+        session.expires = now + self.ttl
+        return session
+
+    def _drop_if_empty(self, key: StorageKey, session: _Session):
+        if session.state is None and not session.data:
+            self._sessions.pop(key, None)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        session = self._get(key, create=state is not None)
+        if session is None:
+            return
+        session.state = state.state if isinstance(state, State) else state
+        self._drop_if_empty(key, session)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        session = self._get(key)
+        return session.state if session else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        session = self._get(key, create=bool(data))
+        if session is None:
+            return
+        session.data = dict(data)
+        self._drop_if_empty(key, session)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        session = self._get(key)
+        return dict(session.data) if session else {}
+
+    async def close(self) -> None:
+        self._sessions.clear()
@@ -0,0 +1,134 @@
+import json
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(chat_id: int, shards: int) -> int:
+    """Номер шарда группы, одинаковый во всех процессах"""
+    return (((chat_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32) % shards
+
+
+class ShardWorker:
+    """Процесс-воркер одного шарда; апдейты передаются строками JSON в stdin
+
+    Последние replay переданных апдейтов хранятся: после перезапуска
+    упавшего воркера они передаются заново. Воркер восстанавливает
+    состояние из своего снапшота и журнала и пропускает апдейты, уже
+    учтенные в нем (по сохраненному update_id).
+    """
+
+    def __init__(self, index: int, command: Sequence[str], env: Dict[str, str], replay: int = 10000):
+        self.index = index
+        self.command = list(command)
+        self.env = env
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.sent: Deque[bytes] = deque(maxlen=replay)
+        self.forwarded = 0
+        self.restarts = 0
+        self.started = 0.0
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command, stdin=asyncio.subprocess.PIPE, env=self.env
+        )
+        self.started = asyncio.get_running_loop().time()
+        logger.info(f"Воркер шарда {self.index} запущен (pid {self.process.pid})")
+        if self.sent:
+            for line in self.sent:
+                self.process.stdin.write(line)
+            await self._drain()
+
+    async def send(self, line: bytes):
+        self.sent.append(line)
+        self.forwarded += 1
+        if not self.alive or self.process.stdin.is_closing():
+            return  # будет передан после перезапуска
+        self.process.stdin.write(line)
+        await self._drain()
+
+    async def _drain(self):
+        try:
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # воркер упал, его перезапустит ShardRouter
+
+
+class ShardRouter:
+    """Распределение апдейтов по воркерам-шардам по chat_id
+
+    Воркер, завершившийся не по stop(), перезапускается; если он падает
+    сразу после запуска, пауза перед перезапуском растет до max_delay.
+    Медленный воркер тормозит прием апдейтов (drain), а не копит их в памяти.
+    """
+
+    def __init__(self, shards: int, command: Sequence[str], env: Dict[str, str],
+                 replay: int = 10000, restart_delay: float = 1.0, max_delay: float = 60.0):
+        self.workers = [
+            ShardWorker(index, command, dict(env, SHARD_INDEX=str(index)), replay)
+            for index in range(shards)
+        ]
+        self.restart_delay = restart_delay
+        self.max_delay = max_delay
+        self._stopping = False
+        self._tasks: List[asyncio.Task] = []
+
+    def __len__(self) -> int:
+        return len(self.workers)
+
+    async def start(self):
+        for worker in self.workers:
+            await worker.start()
+            self._tasks.append(asyncio.create_task(self._watch(worker)))
+
+    async def _watch(self, worker: ShardWorker):
+        loop = asyncio.get_running_loop()
+        delay = self.restart_delay
+        while True:
+            code = await worker.process.wait()
+            if self._stopping:
+                return
+            if loop.time() - worker.started > self.max_delay:
+                delay = self.restart_delay  # проработал долго - не цикл падений
+            worker.restarts += 1
+            logger.error(f"Воркер шарда {worker.index} завершился с кодом {code}, перезапуск через {delay:.0f} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+            try:
+                await worker.start()
+            except OSError:
+                logger.exception(f"Не удалось запустить воркер шарда {worker.index}")
+
+    async def route(self, chat_id: int, update: dict):
+        worker = self.workers[shard_of(chat_id, len(self.workers))]
+        line = json.dumps(update, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+        await worker.send(line)
+
+    async def stop(self, timeout: float = 30):
+        """Закрытие stdin воркеров: они дообрабатывают апдейты и пишут снапшот"""
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        for worker in self.workers:
+            if worker.alive:
+                worker.process.stdin.close()
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            try:
+                await asyncio.wait_for(worker.process.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Воркер шарда {worker.index} не завершился за {timeout:.0f} с")
+                worker.process.kill()
+                await worker.process.wait()
+
+    def counts(self, field: str) -> Dict[tuple, float]:
+        """Значения поля воркеров по шардам (для метрик)"""
+        return {(str(worker.index),): getattr(worker, field) for worker in self.workers}
@@ -0,0 +1,232 @@
+import os
+import json
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = "snapshot.json"
+JOURNAL_PREFIX = "journal-"
+JOURNAL_SUFFIX = ".jsonl"
+LOCK_FILE = "lock"
+
+
+class StateStore:
+    """Снапшот состояния групп + журнал изменений (append-only)
+
+    Каждая запись журнала - строка JSON вида [seq, chat_id, op].
+    Журнал разбит на сегменты journal-<первый seq>.jsonl; при компактификации
+    текущий сегмент закрывается, состояние пишется в snapshot.json вместе с
+    последним seq, после чего старые сегменты удаляются. При загрузке записи
+    с seq не больше, чем в снапшоте, пропускаются, поэтому падение в любой
+    момент компактификации не теряет и не дублирует изменения.
+
+    Там же хранится update_id последнего обработанного апдейта: запись
+    [seq, 0, {"op": "offset", ...}] добавляется не чаще раза за flush().
+    Переход на новую нумерацию апдейтов пишется сразу записью offset_reset:
+    при загрузке она заменяет значение, а не сравнивается с ним.
+    """
+
+    def __init__(self, directory: str, fsync_interval: float = 0.2,
+                 snapshot_interval: float = 600, snapshot_every: int = 50000):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_every = snapshot_every
+        self.seq = 0
+        self.snapshot_seq = 0
+        self.update_offset = 0
+        self._offset_written = 0
+        self._file = None
+        self._segment_start = 0
+        self._dirty = False
+        self._compacting = False
+        self._lock = None  # файл блокировки каталога (lock)
+
+    def _segment_path(self, first_seq: int) -> str:
+        return os.path.join(self.directory, f"{JOURNAL_PREFIX}{first_seq:012d}{JOURNAL_SUFFIX}")
+
+    def _segments(self) -> List[Tuple[int, str]]:
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(JOURNAL_PREFIX) and name.endswith(JOURNAL_SUFFIX):
+                first_seq = int(name[len(JOURNAL_PREFIX):-len(JOURNAL_SUFFIX)])
+                segments.append((first_seq, os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def lock(self) -> bool:
+        """Исключительная блокировка каталога; False - его держит другой процесс
+
+        Блокировка (flock) снимается при завершении процесса, в том числе
+        при падении. Без fcntl (Windows) каталог не блокируется.
+        """
+        if self._lock is not None:
+            return True
+        try:
+            import fcntl
+        except ImportError:
+            return True
+        os.makedirs(self.directory, exist_ok=True)
+        f = open(os.path.join(self.directory, LOCK_FILE), "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._lock = f
+        return True
+
+    def load(self) -> Tuple[Dict[int, dict], List[Tuple[int, dict]]]:
+        """Чтение снапшота и хвоста журнала: (группы, [(chat_id, op), ...])"""
+        os.makedirs(self.directory, exist_ok=True)
+        groups: Dict[int, dict] = {}
+        tail: List[Tuple[int, dict]] = []
+
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            self.snapshot_seq = snapshot["seq"]
+            self.update_offset = snapshot.get("update_offset", 0)
+            groups = {int(chat_id): data for chat_id, data in snapshot["groups"].items()}
+        self.seq = self.snapshot_seq
+
+        for _, path in self._segments():
+            with open(path, "rb+") as f:
+                offset = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError
+                        seq, chat_id, op = json.loads(line)
+                    except ValueError:
+                        # Недописанная строка после падения процесса - отрезаем
+                        logger.warning(f"Журнал {path} обрезан после повреждённой записи")
+                        f.truncate(offset)
+                        break
+                    offset += len(line)
+                    if seq <= self.snapshot_seq:
+                        continue
+                    self.seq = seq
+                    if op.get("op") == "offset":
+                        self.update_offset = max(self.update_offset, op["update_id"])
+                        continue
+                    if op.get("op") == "offset_reset":
+                        self.update_offset = op["update_id"]
+                        continue
+                    tail.append((chat_id, op))
+
+        self._offset_written = self.update_offset
+        self._open_segment()
+        return groups, tail
+
+    def _open_segment(self):
+        self._segment_start = self.seq + 1
+        self._file = open(self._segment_path(self._segment_start), "a", encoding="utf-8")
+
+    def append(self, chat_id: int, op: dict):
+        """Запись изменения; на диск попадает при ближайшем flush()"""
+        if self._file is None:
+            return
+        self.seq += 1
+        self._file.write(json.dumps([self.seq, chat_id, op], ensure_ascii=False, separators=(",", ":")))
+        self._file.write("\n")
+        self._dirty = True
+
+    def set_offset(self, update_id: int):
+        """Отметка обработанного апдейта; в журнал попадает при ближайшем flush()"""
+        if update_id > self.update_offset:
+            self.update_offset = update_id
+
+    def reset_offset(self, update_id: int):
+        """Отметка при новой нумерации апдейтов (может быть меньше прежней)"""
+        self.update_offset = self._offset_written = update_id
+        self.append(0, {"op": "offset_reset", "update_id": update_id})
+
+    def _append_offset(self):
+        if self.update_offset != self._offset_written:
+            self._offset_written = self.update_offset
+            self.append(0, {"op": "offset", "update_id": self.update_offset})
+
+    async def flush(self):
+        """Пакетный fsync всех записей с прошлого вызова"""
+        if self._file is None:
+            return
+        self._append_offset()
+        if not self._dirty:
+            return
+        self._dirty = False
+        self._file.flush()
+        await asyncio.get_running_loop().run_in_executor(None, os.fsync, self._file.fileno())
+
+    def _write_snapshot(self, seq: int, groups: Dict[int, dict], update_offset: int):
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"seq": seq, "update_offset": update_offset, "groups": groups},
+                      f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        for first_seq, segment in self._segments():
+            if first_seq <= seq:
+                os.remove(segment)
+        self.snapshot_seq = seq
+
+    def _rotate(self) -> int:
+        """Закрытие текущего сегмента; возвращает последний seq в нём"""
+        seq = self.seq
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._dirty = False
+        self._open_segment()
+        return seq
+
+    async def compact(self, collect: Callable[[], Dict[int, dict]]):
+        """Снапшот текущего состояния и удаление прочитанных сегментов журнала"""
+        if self._file is None or self._compacting or self.seq == self.snapshot_seq:
+            return
+        self._compacting = True
+        try:
+            # Ротация и сбор состояния - синхронно, между обработкой апдейтов
+            self._append_offset()
+            seq = self._rotate()
+            groups = collect()
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._write_snapshot, seq, groups, self._offset_written
+            )
+            logger.info(f"Снапшот состояния записан (seq={seq}, групп: {len(groups)})")
+        finally:
+            self._compacting = False
+
+    async def run(self, collect: Callable[[], Dict[int, dict]]):
+        """Фоновый цикл: fsync пачками и периодические снапшоты"""
+        loop = asyncio.get_running_loop()
+        last_snapshot = loop.time()
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            try:
+                await self.flush()
+                if (self.seq - self.snapshot_seq >= self.snapshot_every
+                        or loop.time() - last_snapshot >= self.snapshot_interval):
+                    await self.compact(collect)
+                    last_snapshot = loop.time()
+            except Exception:
+                logger.exception("Ошибка записи состояния на диск")
+
+    def close(self, collect: Optional[Callable[[], Dict[int, dict]]] = None):
+        """Финальный снапшот и закрытие журнала при остановке"""
+        if self._file is None:
+            return
+        self._append_offset()
+        if collect is not None and self.seq != self.snapshot_seq:
+            seq = self._rotate()
+            self._write_snapshot(seq, collect(), self._offset_written)
+        self._file.close()
+        self._file = None
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+from backends import MemoryBackend, StateBackend
+
+
+def test_backend_without_execute_is_rejected():
+    class Incomplete(StateBackend):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_memory_backend_ops():
+    async def run():
+        backend = MemoryBackend()
+        assert await backend.get("k") is None
+        await backend.set("k", 1)
+        assert await backend.incr("n", 2) == 2
+        assert await backend.compare_and_set("k", 1, 5)
+        assert not await backend.compare_and_set("k", 1, 6)
+        assert await backend.acquire_lock("l", "a", 10)
+        assert not await backend.acquire_lock("l", "b", 10)
+        assert not await backend.release_lock("l", "b")
+        assert await backend.release_lock("l", "a")
+        return await backend.get("k")
+
+    assert asyncio.run(run()) == 5
@@ -0,0 +1,37 @@
+from dedup import ReplayWindow, RingWindow
+
+
+def test_ring_window_duplicates():
+    window = RingWindow(8)
+    assert not window.seen(100)
+    assert not window.seen(101)
+    assert window.seen(100)
+    assert not window.seen(99)  # пришел позже, но в окне
+    assert window.seen(99)
+    assert window.duplicates == 2
+
+
+def test_ring_window_new_numbering():
+    window = RingWindow(8)
+    for number in range(1000, 1010):
+        window.seen(number)
+    # Номер старше окна - новая нумерация, а не повтор
+    assert not window.seen(5)
+    assert window.resets == 1
+    assert window.high == 5
+    assert not window.seen(6)
+    assert window.seen(5)
+    assert not window.seen(1000)
+
+
+def test_replay_window():
+    window = ReplayWindow(4)
+    assert not window.seen("a", 10)
+    assert not window.seen("a", 8)
+    assert window.seen("a", 8)
+    assert window.seen("a", 10)
+    assert not window.seen("b", 8)  # окна чатов независимы
+    assert not window.seen("a", 20)
+    assert window.seen("a", 16)  # старше окна
+    assert not window.seen("a", 17)
+    assert len(window) == 2
@@ -0,0 +1,111 @@
+from datetime import date
+
+from history import DayRecord, HistoryStore, advance_streak, encode_day, new_streak
+
+DAY = date(2024, 3, 1)
+
+
+def record(chat_id, day, success, streak=0):
+    return DayRecord(
+        chat_id, day, [0, 5, 9], [111, 222],
+        [[True, False], [False, True], [True, True]], [12, 3],
+        success, "alive", "alive" if success else "frozen", streak,
+    )
+
+
+def test_encode_matches_day_record():
+    r = record(-100, DAY, True, 4)
+    bits = 0b111001  # ячейка t * members + m
+    assert r.encode() == encode_day(-100, DAY.toordinal(), r.tasks, r.user_ids, bits,
+                                    r.counts, True, "alive", "alive", 4)
+
+
+def test_roundtrip(tmp_path):
+    store = HistoryStore(tmp_path)
+    store.append_many([record(1, DAY, True, 1), record(2, DAY, False)])
+    store.append(record(1, date(2024, 3, 2), False, 1))
+    store.close()
+
+    history = HistoryStore(tmp_path).load()
+    assert len(history) == 3
+    assert history.chat_days(1) == [
+        (DAY.toordinal(), True, (0, 5, 9)),
+        (DAY.toordinal() + 1, False, (0, 5, 9)),
+    ]
+    assert history.member_reliability(1) == {(1, 111): 0.0, (1, 222): 0.0}
+    assert history.completion_rate_by_type({0: "count", 5: "voice", 9: "photo"}, chat_id=2) == {
+        "count": 0.5, "voice": 0.5, "photo": 1.0,
+    }
+    assert history.longest_streaks() == {1: 1, 2: 0}
+
+
+def test_torn_record_is_truncated(tmp_path):
+    store = HistoryStore(tmp_path)
+    store.append(record(1, DAY, True, 1))
+    store.close()
+    with open(store.path, "ab") as f:
+        f.write(record(1, date(2024, 3, 2), True, 2).encode()[:-3])
+
+    store = HistoryStore(tmp_path)
+    store.append(record(1, date(2024, 3, 3), True, 2))
+    store.close()
+    assert [day for day, _, _ in store.load().chat_days(1)] == [DAY.toordinal(), DAY.toordinal() + 2]
+
+
+def test_load_chat_reads_only_the_group(tmp_path):
+    store = HistoryStore(tmp_path)
+    store.append_many([record(chat, date(2024, 3, day), day % 2 == 0) for day in range(1, 6) for chat in (1, 2, 3)])
+    full = store.load()
+    chat = store.load_chat(2)
+    assert chat.chat_days(2) == full.chat_days(2)
+    assert len(chat) == 5
+    assert chat.replay_streaks() == full.replay_streaks(2)
+    store.close()
+
+    # Индекс смещений строится заново при открытии файла
+    assert HistoryStore(tmp_path).load_chat(3).chat_days(3) == full.chat_days(3)
+    assert len(HistoryStore(tmp_path).load_chat(4)) == 0
+
+
+def test_advance_streak():
+    info = new_streak(1)
+    for day, success in enumerate([True, True, False, True, False, False, False], start=1):
+        advance_streak(info, date(2024, 3, day), success)
+        if day == 4:
+            assert info["streak"] == 3 and info["status"] == "alive"
+    assert info["status"] == "dead"
+    assert info["streak"] == 0
+    assert info["longest_streak"] == 3
+    assert info["days"] == 7
+
+
+def test_repeated_day_is_counted_once(tmp_path):
+    # Смена дня повторилась после падения: день записан дважды, берется последняя запись
+    store = HistoryStore(tmp_path)
+    store.append(record(1, DAY, True, 1))
+    store.append(record(1, date(2024, 3, 2), False, 1))
+    store.append(record(1, date(2024, 3, 2), True, 2))
+    store.append(record(2, date(2024, 3, 2), True, 1))
+    for history in (store.load(), store.load_chat(1)):
+        assert [(day, success) for day, success, _ in history.chat_days(1)] == [
+            (DAY.toordinal(), True), (DAY.toordinal() + 1, True),
+        ]
+        info = history.replay_streaks(1)[1]
+        assert info["days"] == 2 and info["streak"] == 2
+    store.close()
+
+
+def test_load_chat_after_external_append(tmp_path):
+    bot = HistoryStore(tmp_path)
+    bot.append(record(1, DAY, True, 1))
+    assert len(bot.load_chat(1)) == 1
+
+    other = HistoryStore(tmp_path)
+    other.append(record(2, DAY, False))
+    other.close()
+    bot.append(record(1, date(2024, 3, 2), True, 2))
+
+    assert bot.load_chat(1).chat_days(1) == HistoryStore(tmp_path).load().chat_days(1)
+    assert len(bot.load_chat(1)) == 2
+    assert bot.load_chat(2).chat_days(2) == [(DAY.toordinal(), False, (0, 5, 9))]
+    bot.close()
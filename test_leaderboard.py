@@ -0,0 +1,70 @@
+import random
+
+import pytest
+
+from leaderboard import Leaderboard, RankIndex
+
+
+def brute_rank(values, value):
+    return 1 + sum(v > value for v in values)
+
+
+def test_rank_index_matches_sorting():
+    random.seed(2)
+    index = RankIndex(size=4)
+    values = {}
+    for key in range(200):
+        values[key] = random.randrange(50)
+        index.add(key, values[key])
+    for key in random.sample(range(200), 50):
+        new = random.randrange(3000)  # с ростом дерева
+        index.move(key, values[key], new)
+        values[key] = new
+
+    for value in set(values.values()):
+        assert index.rank(value) == brute_rank(values.values(), value)
+    ordered = sorted(values.values(), reverse=True)
+    for k in (1, 2, 10, 200):
+        assert index.kth_largest(k) == ordered[k - 1]
+    assert [value for _, value in index.top(20)] == ordered[:20]
+
+
+def test_move_many_matches_move():
+    random.seed(3)
+    one, batch = RankIndex(size=8), RankIndex(size=8)
+    values = {key: random.randrange(10) for key in range(100)}
+    for key, value in values.items():
+        one.add(key, value)
+        batch.add(key, value)
+    moves = [(key, values[key], random.randrange(40)) for key in range(0, 100, 3)]
+    for move in moves:
+        one.move(*move)
+    batch.move_many(moves)
+    assert list(one.top(100)) == list(batch.top(100))
+    assert list(one.tree) == list(batch.tree)
+
+
+def test_leaderboard():
+    board = Leaderboard()
+    board.update_many([(1, 5, 5), (2, 3, 9), (3, 5, 7)])
+    board.update(4, 0, 0)
+    assert board.top(2) == [(1, 5), (3, 5)]
+    assert board.rank(1) == (1, 5, 4)
+    assert board.rank(2) == (3, 3, 4)
+    assert board.rank(2, by="best") == (1, 9, 4)
+    board.update_many([(2, 6, 9), (4, 1, 1)])
+    assert board.top(1) == [(2, 6)]
+    assert board.rank(4) == (4, 1, 4)
+    assert board.rank(99) is None
+
+
+def test_negative_value_is_rejected():
+    board = Leaderboard()
+    board.update(1, 3, 3)
+    with pytest.raises(ValueError):
+        board.update(1, -1, 3)
+    with pytest.raises(ValueError):
+        board.update_many([(1, 2, -5)])
+    with pytest.raises(ValueError):
+        RankIndex().add(1, -1)
+    assert board.rank(1) == (1, 3, 1)
@@ -0,0 +1,157 @@
+import asyncio
+import importlib
+import os
+import sys
+
+import pytest
+
+from storage import StateStore
+
+
+@pytest.fixture(scope="module")
+def main(tmp_path_factory):
+    """Импорт main без группы из окружения, данные во временном каталоге"""
+    os.environ.update({
+        "BOT_TOKEN": "123456:TESTtestTESTtestTESTtestTESTtest",
+        "DATA_DIR": str(tmp_path_factory.mktemp("data")),
+        "GROUP_ID": "0",
+    })
+    for name in ("GROUPS_FILE", "STATE_BACKEND", "WEBHOOK_URL", "SHARDS"):
+        os.environ.pop(name, None)
+    sys.modules.pop("main", None)
+    return importlib.import_module("main")
+
+
+def fire_state(main, chat_id=-1, tasks=None):
+    members = [main.Member(1, "a", "A", "A"), main.Member(2, "b", "B", "B")]
+    state = main.FireState(chat_id, members, 1)
+    if tasks is not None:
+        state.initialize_new_day(tasks)
+    return state
+
+
+def test_counts_met(main):
+    plan = main.TaskPlan((0, 2, 5), 2)  # 10 и 30 сообщений, голосовое
+    state = fire_state(main, tasks=[0, 2, 5])
+    assert not plan.counts_met(state.counters)
+    state.set_member_count(0, 30)
+    state.set_member_count(1, 29)
+    assert not plan.counts_met(state.counters)
+    state.set_member_count(1, 30)
+    assert plan.counts_met(state.counters)
+    # Счетчик у верхней границы не переносит бит в соседнее поле
+    state.set_member_count(0, main.COUNTER_MASK)
+    assert plan.counts_met(state.counters)
+    assert state.get_count(1, 1) == 30
+
+
+def test_done_bits(main):
+    plan = main.TaskPlan((0, 2, 5), 2)
+    state = fire_state(main, tasks=[0, 2, 5])
+    state.set_member_count(0, 15)
+    state.set_member_count(1, 30)
+    state.mark_done(5, 1)
+    state.completed |= 1  # флаг ячейки счетчика не учитывается
+    # Ячейка slot * members + member: 0/1 - 10 сообщений, 2/3 - 30, 4/5 - голосовое
+    assert plan.done_bits(state.completed, state.counters) == 0b100000 | 0b1000 | 0b10 | 0b1
+    assert main.TaskPlan((5, 6, 7), 2).counts_met(0)
+
+
+def test_restore_journals_fresh_groups(main, tmp_path, monkeypatch):
+    def restart():
+        registry = main.GroupRegistry()
+        registry.register(fire_state(main, -1))
+        registry.register(fire_state(main, -2))
+        store = StateStore(tmp_path)
+        monkeypatch.setattr(main, "store", store)
+        main.restore_state(registry, store)
+        store.close()
+        return registry
+
+    first = restart()
+    # Группы нет ни в снапшоте, ни в журнале - задания выбраны заново и
+    # должны попасть в журнал, иначе после перезапуска они будут другими
+    for _ in range(3):
+        registry = restart()
+        for state in registry:
+            assert state.task_indices == first.get(state.chat_id).task_indices
+            assert state.schedule == first.get(state.chat_id).schedule
+
+
+class FakeCallback:
+    def __init__(self, user_id):
+        self.from_user = type("User", (), {"id": user_id})()
+        self.answers = []
+
+    async def answer(self, text=None, show_alert=False):
+        self.answers.append(text)
+
+
+def test_admin_callback_needs_session(main, monkeypatch):
+    registry = main.GroupRegistry()
+    registry.register(fire_state(main, -1))
+    registry.register(fire_state(main, -2))
+    monkeypatch.setattr(main, "registry", registry)
+
+    async def run():
+        # Сессия истекла: не подставлять первую группу админа
+        callback = FakeCallback(1)
+        assert await main.callback_admin_state(callback) is None
+        assert "Сессия истекла" in callback.answers[0]
+
+        await main.set_session(1, {"mode": "admin", "chat_id": -2})
+        assert (await main.callback_admin_state(FakeCallback(1))).chat_id == -2
+
+        stranger = FakeCallback(3)
+        await main.set_session(3, {"mode": "admin", "chat_id": -2})
+        assert await main.callback_admin_state(stranger) is None
+        assert stranger.answers == ["Доступ запрещен"]
+
+    asyncio.run(run())
+
+
+def test_failed_rollover_backs_off(main, monkeypatch):
+    state = fire_state(main, -7)
+    state.current_date -= main.timedelta(days=1)
+    registry = main.GroupRegistry()
+    registry.register(state)
+    monkeypatch.setattr(main, "registry", registry)
+
+    async def broken(states):
+        raise RuntimeError("rollover failed")
+
+    async def working(states):
+        for state in states:
+            state.current_date += main.timedelta(days=1)
+
+    async def fire():
+        await main.on_deadlines("rollover", [(state.chat_id, main.time.time() - 60)])
+
+    monkeypatch.setattr(main, "new_day_tasks", broken)
+    delays = []
+    for _ in range(10):
+        with pytest.raises(RuntimeError):
+            asyncio.run(fire())
+        delays.append(round(main.deadlines.next_deadline(state.chat_id, "rollover") - main.time.time()))
+    # Не срок в прошлом (повтор на каждом тике), а растущая пауза
+    assert delays[:4] == [2, 4, 8, 16]
+    assert delays[-1] == main.ROLLOVER_RETRY_MAX
+
+    monkeypatch.setattr(main, "new_day_tasks", working)
+    asyncio.run(fire())
+    midnight = main.local_timestamp(state.tz, state.current_date + main.timedelta(days=1), 0)
+    assert main.deadlines.next_deadline(state.chat_id, "rollover") == midnight
+    assert state.chat_id not in main.rollover_failures
+
+
+def test_profile_rejects_bad_update_id(main):
+    from aiohttp import web
+    from aiohttp.test_utils import make_mocked_request
+
+    async def profile(query):
+        return await main.handle_profile(make_mocked_request("GET", f"/diagnostics/profile{query}"))
+
+    with pytest.raises(web.HTTPBadRequest):
+        asyncio.run(profile("?update_id=abc"))
+    assert asyncio.run(profile("?update_id=42")).status == 200
+    assert asyncio.run(profile("")).status == 200
@@ -0,0 +1,22 @@
+from phrases import PhraseMatcher
+
+
+def test_match():
+    matcher = PhraseMatcher({
+        "morning": ["доброе утро", "утречко"],
+        "evening": ["спокойной ночи", "сладких снов"],
+        "empty": [""],
+    })
+    assert matcher.match("Доброе УТРО!") == {"morning"}
+    assert matcher.match("утречко и сладких снов") == {"morning", "evening"}
+    assert matcher.match("привет") == frozenset()
+    assert matcher.match("") == frozenset()
+    assert matcher.match_mask("спокойной ночи") == 0b10
+
+
+def test_overlapping_phrases():
+    # Фраза внутри другой и общий суффикс находятся по fail-ссылкам
+    matcher = PhraseMatcher({"a": ["abcd"], "b": ["bc"], "c": ["cde"]})
+    assert matcher.match("abcde") == {"a", "b", "c"}
+    assert matcher.match("abce") == {"b"}
+    assert matcher.match("xbcdex") == {"b", "c"}
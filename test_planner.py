@@ -0,0 +1,34 @@
+import random
+
+from planner import (
+    DAY_BITS, TaskPlanner, pack_day, pack_days, planned_days, pop_day, unpack_day, unpack_days,
+)
+
+
+def test_day_roundtrip():
+    assert unpack_day(pack_day([0, 5, 254])) == (0, 5, 254)
+    assert pack_day([1, 2, 3]) < 1 << DAY_BITS
+    assert pack_day([]) == 0
+
+
+def test_days_roundtrip():
+    days = [(0, 1, 2), (10, 20, 30), (7,), (254, 0, 3)]
+    value = pack_days(days)
+    assert unpack_days(value) == days
+    assert planned_days(value) == len(days)
+
+    first, rest = pop_day(value)
+    assert first == days[0]
+    assert unpack_days(rest) == days[1:]
+
+
+def test_extend_keeps_existing_days():
+    random.seed(1)
+    planner = TaskPlanner([("a", [0, 1, 2]), ("b", [3, 4, 5]), ("c", [6, 7, 8])])
+    schedule = pack_days([(0, 3, 6)])
+    schedule = planner.extend(schedule, (1, 4, 7), 5)
+    days = unpack_days(schedule)
+    assert len(days) == 5
+    assert days[0] == (0, 3, 6)
+    for day in days:
+        assert len(set(day)) == len(day) == 3
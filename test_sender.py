@@ -0,0 +1,63 @@
+import asyncio
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from sender import SendQueue
+
+CHAT = -100
+
+
+class FakeBot:
+    """Записывает (время, текст); первая отправка text получает RetryAfter"""
+
+    def __init__(self, throttle: str, retry_after: float):
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.calls = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        now = asyncio.get_running_loop().time()
+        self.calls.append((now, text))
+        if text == self.throttle:
+            self.throttle = None
+            method = SendMessage(chat_id=chat_id, text=text)
+            raise TelegramRetryAfter(method, "Flood control exceeded", self.retry_after)
+
+
+def test_retry_after_holds_the_chat():
+    async def run():
+        bot = FakeBot("first", 0.3)
+        queue = SendQueue(bot, chat_burst=10)
+        queue.start()
+        start = asyncio.get_running_loop().time()
+        queue.send(CHAT, "first")
+        await asyncio.sleep(0.05)
+        queue.send(CHAT, "second")  # не должен уйти раньше повтора
+        queue.send(CHAT + 1, "other")  # другой чат не ждет
+        await queue.drain(2)
+        return start, bot.calls
+
+    start, calls = asyncio.run(run())
+    texts = [text for _, text in calls]
+    assert texts == ["first", "other", "first", "second"]
+    retry_at = calls[0][0] + 0.3
+    assert calls[1][0] - start < 0.2
+    assert all(at >= retry_at for at, text in calls[2:])
+
+
+def test_delayed_message_does_not_hold_ready_ones():
+    async def run():
+        bot = FakeBot(None, 0)
+        queue = SendQueue(bot, chat_burst=10, coalesce_window=0.3)
+        queue.start()
+        start = asyncio.get_running_loop().time()
+        queue.notify(CHAT, "done", "notice", merge="\n".join)
+        queue.send(CHAT, "reply")
+        await queue.drain(2)
+        return start, bot.calls
+
+    start, calls = asyncio.run(run())
+    assert [text for _, text in calls] == ["reply", "notice"]
+    assert calls[0][0] - start < 0.2
+    assert calls[1][0] - start >= 0.3
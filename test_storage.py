@@ -0,0 +1,96 @@
+import asyncio
+import json
+import os
+
+from storage import SNAPSHOT_FILE, StateStore
+
+
+def reopen(directory):
+    store = StateStore(directory)
+    groups, tail = store.load()
+    return store, groups, tail
+
+
+def test_journal_replay(tmp_path):
+    store, groups, tail = reopen(tmp_path)
+    assert groups == {} and tail == []
+    store.append(1, {"op": "message", "user": "a"})
+    store.append(2, {"op": "done", "task": 5})
+    store.set_offset(42)
+    asyncio.run(store.flush())
+    store.close()
+
+    store, groups, tail = reopen(tmp_path)
+    assert tail == [(1, {"op": "message", "user": "a"}), (2, {"op": "done", "task": 5})]
+    assert store.update_offset == 42
+    assert store.seq == 3  # два изменения и отметка offset
+    store.close()
+
+
+def test_torn_line_is_truncated(tmp_path):
+    store, _, _ = reopen(tmp_path)
+    store.append(1, {"op": "message", "user": "a"})
+    store.close()
+    segment = next(name for name in os.listdir(tmp_path) if name.startswith("journal-"))
+    with open(tmp_path / segment, "ab") as f:
+        f.write(b'[2,1,{"op":')
+
+    store, _, tail = reopen(tmp_path)
+    assert tail == [(1, {"op": "message", "user": "a"})]
+    store.append(1, {"op": "message", "user": "b"})
+    store.close()
+
+    _, _, tail = reopen(tmp_path)
+    assert [op["user"] for _, op in tail] == ["a", "b"]
+
+
+def test_compaction_skips_snapshotted_records(tmp_path):
+    store, _, _ = reopen(tmp_path)
+    store.append(1, {"op": "message", "user": "a"})
+    asyncio.run(store.compact(lambda: {1: {"streak": 3}}))
+    store.append(1, {"op": "message", "user": "b"})
+    store.close()
+
+    with open(tmp_path / SNAPSHOT_FILE, encoding="utf-8") as f:
+        assert json.load(f)["seq"] == 1
+    _, groups, tail = reopen(tmp_path)
+    assert groups == {1: {"streak": 3}}
+    assert tail == [(1, {"op": "message", "user": "b"})]
+
+
+def test_reset_offset_goes_back(tmp_path):
+    store, _, _ = reopen(tmp_path)
+    store.set_offset(1000)
+    store.set_offset(10)
+    assert store.update_offset == 1000
+    store.reset_offset(10)
+    store.close(lambda: {})
+
+    store, _, _ = reopen(tmp_path)
+    assert store.update_offset == 10
+    store.close()
+
+
+def test_reset_offset_survives_crash(tmp_path):
+    store, _, _ = reopen(tmp_path)
+    store.set_offset(1000)
+    asyncio.run(store.flush())
+    store.reset_offset(10)
+    asyncio.run(store.flush())
+    store.set_offset(12)
+    asyncio.run(store.flush())
+    # Падение без close(): снапшот не пишется
+
+    store, _, tail = reopen(tmp_path)
+    assert store.update_offset == 12
+    assert tail == []
+    store.close()
+
+
+def test_directory_lock(tmp_path):
+    bot, _, _ = reopen(tmp_path)
+    assert bot.lock()
+    assert bot.lock()
+    assert not StateStore(tmp_path).lock()
+    bot.close()
+    assert StateStore(tmp_path).lock()